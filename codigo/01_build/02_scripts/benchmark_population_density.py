@@ -0,0 +1,303 @@
+"""
+Benchmark the population density pipeline on synthetic fixtures.
+
+Generates Kontur-like hexagons and GADM-like admin polygons (see
+pipeline/synthetic.py), then times every stage of the batch pipeline
+(read, reproject, sjoin, overlay, aggregate, write) for each combination of
+batch size, chunk size, worker count and pool start method. Each timed stage
+is appended as one JSON line to ``03_output/benchmarks/``, so runs on
+different machines or commits can be compared offline.
+
+Before the sweep it also times process start-up: importing each entry point
+in a fresh interpreter, and spinning up a pool (with the shared admin layer)
+under each start method: the first one-worker pool (which starts the fork
+server) and then one pool per worker count with the server already up.
+It reports the memory per million hexagons of a GeoDataFrame with an admin id
+column against the compact ``HexTable`` (uint64 h3, float32, categorical).
+
+Usage:
+    python benchmark_population_density.py --hexagons 50000 --admin-units 30 \
+        --batch-sizes 5000 20000 --chunk-sizes 1500 5000 --workers 2 8 \
+        --schedulers fixed adaptive --start-methods fork forkserver spawn
+"""
+from pathlib import Path
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+
+from pipeline.admin_layer import AdminLayer, set_worker_admin_layer
+from pipeline.autotune import frame_bytes
+from pipeline.batch_overlay import parallel_intersection
+from pipeline.hextable import HexTable
+from pipeline.pools import pool_context, pool_spinup_seconds
+from pipeline.profiling import MODES as PROFILE_MODES, configure_profiler
+from pipeline.synthetic import synthetic_admin, synthetic_hexagons
+
+output_path = Path(Path(__file__).parent.parent, '03_output')
+BENCHMARK_PATH = output_path / 'benchmarks'
+FIXTURE_PATH = BENCHMARK_PATH / 'fixtures'
+
+# Entry points whose cold import time is reported
+STARTUP_MODULES = ['build', 'pipeline.gpkg_meta', 'population_density_COL']
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageRecorder:
+    """Collect per-stage timings and write them as JSON lines."""
+
+    def __init__(self, results_file, run_info):
+        self.results_file = results_file
+        self.run_info = run_info
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, rows_in=None, **params):
+        record = {'stage': name, 'rows_in': rows_in, **params}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.emit(record)
+
+    def emit(self, record):
+        record = {**self.run_info, **record}
+        self.records.append(record)
+        with open(self.results_file, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+def build_fixtures(n_hexagons, n_admin, vertices_per_edge, seed):
+    """Write (or reuse) the synthetic population and admin GeoPackages."""
+    FIXTURE_PATH.mkdir(parents=True, exist_ok=True)
+    tag = f"h{n_hexagons}_a{n_admin}_v{vertices_per_edge}_s{seed}"
+    pop_path = FIXTURE_PATH / f"population_{tag}.gpkg"
+    admin_path = FIXTURE_PATH / f"admin_{tag}.gpkg"
+
+    if not (pop_path.exists() and admin_path.exists()):
+        print(f"Generating fixtures {tag}...")
+        hexagons = synthetic_hexagons(n_hexagons, seed=seed)
+        admin = synthetic_admin(hexagons, n_admin, vertices_per_edge=vertices_per_edge, seed=seed)
+        hexagons.to_file(pop_path, driver="GPKG")
+        admin.to_file(admin_path, driver="GPKG")
+    return pop_path, admin_path
+
+
+def measure_startup(recorder, admin_path, workers_list, start_methods):
+    """Time cold imports of the entry points and pool spin-up per start method."""
+    for module in STARTUP_MODULES:
+        code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+        with recorder.stage('startup_import', module=module) as rec:
+            run = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parent,
+                                 capture_output=True, text=True)
+            rec['import_seconds'] = float(run.stdout.split()[-1]) if run.returncode == 0 else None
+
+    layer = AdminLayer(gpd.read_file(admin_path))
+    for method in start_methods:
+        context = pool_context(method)
+        # The fork server starts (and preloads) with the first pool of the run and
+        # then stays up, so only that pool is 'first'; every later one is 'steady'
+        spinups = [(1, 'first')] + [(workers, 'steady') for workers in workers_list]
+        for workers, phase in spinups:
+            seconds = pool_spinup_seconds(context, workers, initializer=set_worker_admin_layer,
+                                          initargs=(layer,))
+            recorder.emit({'stage': 'pool_spinup', 'start_method': method, 'workers': workers,
+                           'phase': phase, 'seconds': seconds})
+
+
+def measure_hex_memory(recorder, pop_path, admin_path):
+    """Memory per million hexagons: GeoDataFrame vs HexTable, both with the GID_1 of each hexagon."""
+    hexes = gpd.read_file(pop_path)
+    admin = gpd.read_file(admin_path).to_crs(hexes.crs)
+    layer = AdminLayer(admin)
+    hex_pos, part_pos = layer.tree.query(hexes.geometry.centroid.to_numpy(), predicate='intersects')
+    rows = np.full(len(hexes), -1)
+    rows[hex_pos] = layer.part_row[part_pos]
+
+    table = HexTable.from_frame(hexes).assign(admin, 'GID_1', rows)
+    hexes['GID_1'] = np.asarray(table.zone, dtype=object)
+    for representation, nbytes in [('geodataframe', frame_bytes(hexes)), ('hextable', table.nbytes)]:
+        recorder.emit({'stage': 'hex_memory', 'representation': representation, 'seconds': None,
+                       'rows_in': len(hexes), 'bytes': nbytes,
+                       'mb_per_million': nbytes / len(hexes) * 1e6 / 1024**2})
+
+
+def summarize_startup(records):
+    """Print import and pool spin-up seconds."""
+    df = pd.DataFrame(records)
+    imports = df[df['stage'] == 'startup_import']
+    if not imports.empty:
+        print("\n=== Cold start (fresh interpreter) ===")
+        print(imports.groupby('module')[['seconds', 'import_seconds']].mean().round(3).to_string())
+    memory = df[df['stage'] == 'hex_memory']
+    if not memory.empty:
+        print("\n=== Hexagon table memory (MB per million hexagons) ===")
+        print(memory.set_index('representation')['mb_per_million'].round(1).to_string())
+    spinup = df[df['stage'] == 'pool_spinup']
+    if not spinup.empty:
+        print("\n=== Pool spin-up seconds (all workers initialized) ===")
+        print(spinup.pivot_table(index=['start_method', 'workers'], columns='phase',
+                                 values='seconds').round(3).to_string())
+
+
+def run_pipeline(recorder, pop_path, admin_path, batch_size, chunk_size, workers, scheduler,
+                 start_method):
+    """Run the batch pipeline once, timing each stage of each batch."""
+    params = {'batch_size': batch_size, 'chunk_size': chunk_size, 'workers': workers,
+              'scheduler': scheduler, 'start_method': start_method}
+
+    with recorder.stage('read_admin', **params) as rec:
+        admin = gpd.read_file(admin_path)
+        rec['rows_out'] = len(admin)
+
+    total_rows = pyogrio.read_info(pop_path)['features']
+    results = []
+    for batch_start in range(0, total_rows, batch_size):
+        batch_params = {**params, 'batch_start': batch_start}
+
+        with recorder.stage('read', **batch_params) as rec:
+            batch = gpd.read_file(pop_path, rows=slice(batch_start, batch_start + batch_size))
+            rec['rows_out'] = len(batch)
+
+        with recorder.stage('reproject', rows_in=len(batch), **batch_params) as rec:
+            batch = batch.to_crs(admin.crs)
+            batch['hex_area'] = batch.geometry.area
+            rec['rows_out'] = len(batch)
+
+        with recorder.stage('sjoin', rows_in=len(batch), **batch_params) as rec:
+            matches = gpd.sjoin(batch, admin, predicate='intersects', how='inner')
+            candidates = batch.loc[matches.index.unique()]
+            rec['rows_out'] = len(candidates)
+
+        if len(candidates) == 0:
+            continue
+
+        with recorder.stage('overlay', rows_in=len(candidates), **batch_params) as rec:
+            pieces = parallel_intersection(candidates, admin, chunk_size=chunk_size,
+                                           num_cores=workers, scheduler=scheduler,
+                                           start_method=start_method)
+            rec['rows_out'] = len(pieces)
+        results.append(pieces)
+
+    with recorder.stage('aggregate', rows_in=sum(len(r) for r in results), **params) as rec:
+        intersected = pd.concat(results, ignore_index=True)
+        intersected['adjusted_population'] = (
+            intersected['population'] * intersected.geometry.area / intersected['hex_area']
+        )
+        by_admin = intersected.groupby('GID_1')['adjusted_population'].sum().reset_index()
+        result = admin.merge(by_admin, on='GID_1', how='left')
+        rec['rows_out'] = len(result)
+
+    with recorder.stage('write', rows_in=len(result), **params):
+        out_file = BENCHMARK_PATH / 'scratch_result.gpkg'
+        result.to_file(out_file, driver="GPKG")
+        out_file.unlink()
+
+
+def summarize(records):
+    """Print seconds per configuration and stage (mean over repeats)."""
+    config = ['batch_size', 'chunk_size', 'workers', 'scheduler', 'start_method']
+    df = pd.DataFrame(records).dropna(subset=['batch_size'])  # pipeline stages only
+    df = df.astype({'batch_size': int, 'chunk_size': int, 'workers': int})
+    summary = (
+        df.groupby(config + ['repeat', 'stage'])['seconds'].sum()
+        .groupby(config + ['stage']).mean()
+        .unstack('stage')
+    )
+    summary['total'] = summary.sum(axis=1)
+    print("\n=== Seconds per configuration and stage ===")
+    print(summary.sort_values('total').round(3).to_string())
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--hexagons', type=int, default=20000)
+    parser.add_argument('--admin-units', type=int, default=30)
+    parser.add_argument('--vertices-per-edge', type=int, default=20,
+                        help="Boundary complexity of the synthetic admin polygons")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[5000])
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[1500])
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[max(1, multiprocessing.cpu_count() - 2)])
+    parser.add_argument('--schedulers', nargs='+', default=['adaptive'],
+                        choices=['adaptive', 'fixed'])
+    parser.add_argument('--start-methods', nargs='+', default=[pool_context().get_start_method()],
+                        choices=multiprocessing.get_all_start_methods(),
+                        help="Pool start methods to compare (default: forkserver where available)")
+    parser.add_argument('--skip-startup', action='store_true',
+                        help="Do not time imports and pool spin-up")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', choices=PROFILE_MODES, default=None,
+                        help="Profile the overlay workers and print where their time goes")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    BENCHMARK_PATH.mkdir(parents=True, exist_ok=True)
+    pop_path, admin_path = build_fixtures(args.hexagons, args.admin_units,
+                                          args.vertices_per_edge, args.seed)
+
+    started = datetime.now(timezone.utc)
+    results_file = BENCHMARK_PATH / f"population_density_{started:%Y%m%dT%H%M%S}.jsonl"
+    recorder = StageRecorder(results_file, {
+        'run': started.isoformat(),
+        'commit': git_commit(),
+        'host': platform.node(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'python': platform.python_version(),
+        'geopandas': gpd.__version__,
+        'hexagons': args.hexagons,
+        'admin_units': args.admin_units,
+        'vertices_per_edge': args.vertices_per_edge,
+    })
+
+    profiler = configure_profiler(BENCHMARK_PATH / f"profiles_{started:%Y%m%dT%H%M%S}",
+                                  mode=args.profile)
+
+    if not args.skip_startup:
+        measure_startup(recorder, admin_path, args.workers, args.start_methods)
+    measure_hex_memory(recorder, pop_path, admin_path)
+
+    sweep = list(itertools.product(args.batch_sizes, args.chunk_sizes, args.workers,
+                                   args.schedulers, args.start_methods))
+    for repeat in range(args.repeat):
+        for batch_size, chunk_size, workers, scheduler, start_method in sweep:
+            print(f"\n>>> batch_size={batch_size} chunk_size={chunk_size} workers={workers} "
+                  f"scheduler={scheduler} start_method={start_method} "
+                  f"(repeat {repeat + 1}/{args.repeat})")
+            recorder.run_info['repeat'] = repeat
+            run_pipeline(recorder, pop_path, admin_path, batch_size, chunk_size, workers,
+                         scheduler, start_method)
+
+    summarize_startup(recorder.records)
+    summarize(recorder.records)
+    profiler.summary()
+    print(f"\nResults written to {results_file}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,579 @@
+"""
+Command-line entry point for the build pipeline.
+
+Subcommands:
+    admin      Download GADM and assemble a region's admin GeoPackage
+    density    Population per admin unit (ADM0 up to --level) with a chosen backend
+    delta      Update density totals to a new Kontur release from the changed cells only
+    pyramid    Population and road km per H3 cell at every coarser resolution
+    query      Population and road km inside arbitrary polygons, from the pyramid
+    access     Distance from every hexagon to the nearest road and toll booth
+    reconcile  GADM department/country totals vs Kontur boundary populations
+    maps       Per-country population density maps, skipping unchanged ones
+    publish    GeoParquet/Feather hexagon and department panels for the R scripts
+    roads      Road length, population and toll booths per zone
+
+Examples:
+    python build.py admin --region africa --level 2
+    python build.py density --region southamerica --level 1 --backend partitioned --workers 8 --memory 32GB
+    python build.py density --region COL --level 2 --backend centroid
+    python build.py delta --region COL --level 2 --new ../../../datos/spatial/kontur_population_CO_20241101.gpkg
+    python build.py pyramid --region COL --min-resolution 3
+    python build.py query --region COL --polygons municipios.gpkg --id MPIO_CDPMP --output totals.csv
+    python build.py roads --region COL
+    python build.py access --region COL --hexagons
+    python build.py reconcile --regions southamerica africa
+    python build.py maps --regions southamerica africa --workers 8
+    python build.py publish --region COL --format feather
+
+Regions and their inputs are listed in pipeline/regions.py; --population and
+--admin override them.
+"""
+from pathlib import Path
+import argparse
+import multiprocessing
+import sys
+import time
+
+# Only light modules at the top so --help and argument errors are instant;
+# each subcommand imports the geospatial stack it needs
+from pipeline.instrumentation import LEVELS
+from pipeline.regions import REGIONS, get_region, output_path
+
+BACKENDS = ['overlay', 'raster', 'centroid', 'h3', 'partitioned']
+
+
+def run_admin(args):
+    from pipeline.gadm import assemble_admin
+
+    region = get_region(args.region)
+    output_file = Path(args.output or region['admin'])
+    failed = assemble_admin(
+        args.countries or region['countries'],
+        range(args.level + 1),
+        output_file,
+        download_dir=Path(args.download_dir or Path(args.output_dir) / 'gadm_downloads'),
+        area_crs=region['area_crs'],
+        max_workers=args.workers,
+        overwrite=args.overwrite,
+    )
+    print(f"\nAdmin divisions saved to: {output_file}")
+    return failed
+
+
+def configure_density(args, backend, population):
+    """Point the single-country driver's module constants at this run's inputs and outputs."""
+    import population_density_COL as density
+    from pipeline import hexstore
+    from pipeline.partitioned import parse_bytes
+
+    region = get_region(args.region)
+    tag = f"{args.region}_ADM{args.level}_{backend}"
+    out = Path(args.output_dir)
+
+    density.ADMIN_DIVISIONS_PATH = Path(args.admin or region['admin'])
+    density.POPULATION_DATA_PATH = Path(population)
+    density.AREA_CRS = region['area_crs']
+    density.ADMIN_LEVELS = list(range(args.level + 1))
+    density.ENGINE = backend
+    density.NUM_WORKERS = args.workers
+    density.MEMORY_BUDGET = args.memory
+    density.BATCH_SIZE = args.batch_size
+    density.CHUNK_SIZE = args.chunk_size
+    if args.memory:
+        # The partitioned engine caps each worker; split the budget between them
+        workers = args.workers or max(1, multiprocessing.cpu_count() - 2)
+        density.WORKER_MEMORY_LIMIT = parse_bytes(args.memory) // workers
+    density.RASTER_RESOLUTION = args.raster_resolution
+    density.INSTRUMENTATION_LEVEL = args.instrumentation
+    density.PROFILE_WORKERS = args.profile
+
+    density.output_path = out
+    density.CACHE_PATH = out / 'cache'
+    density.LEDGER_PATH = out / 'ledgers'
+    density.PARTITIONS_PATH = out / 'partitions' / f"{args.region}_ADM{args.level}"
+    density.TRACE_PATH = out / 'traces' / f"build_{tag}.jsonl"
+    density.PROFILE_PATH = out / 'profiles' / f"build_{tag}"
+    density.RESULTS_PATH = out / f"population_density_{tag}.gpkg"
+    density.VALIDATION_PATH = out / f"population_validation_{tag}.csv"
+    hexstore.SCRATCH_DIR = out / 'scratch'
+
+    if not density.ADMIN_DIVISIONS_PATH.exists():
+        raise FileNotFoundError(f"{density.ADMIN_DIVISIONS_PATH} not found; "
+                                f"run: python build.py admin --region {args.region} --level {args.level}")
+    return density
+
+
+def run_density(args):
+    # The single-country driver reads everything from module constants
+    population = args.population or get_region(args.region)['population']
+    return configure_density(args, args.backend, population).main()
+
+
+def run_delta(args):
+    import pandas as pd
+    import pyogrio
+
+    from pipeline.admin_hierarchy import attach_rollups, load_admin_hierarchy
+    from pipeline.admin_layer import AdminLayer
+    from pipeline.cache import SpatialCache
+    from pipeline.releases import (
+        added_cell_shares,
+        change_report,
+        changed_cell_counts,
+        diff_releases,
+        update_shares,
+        zone_deltas,
+    )
+
+    region = get_region(args.region)
+    old_path = Path(args.old or region['population'])
+    new_path = Path(args.new)
+    density = configure_density(args, 'overlay', old_path)
+    levels = density.ADMIN_LEVELS
+    finest_level = max(levels)
+    gid_col = f'GID_{finest_level}'
+
+    # Previous totals: the overlay results for the old release (computed once if missing)
+    baseline_path = Path(args.baseline or density.RESULTS_PATH)
+    if not baseline_path.exists():
+        print(f"No results for {old_path.name} at {baseline_path}; computing them once")
+        density.main()
+    baseline = pyogrio.read_dataframe(baseline_path, layer=f'ADM_{finest_level}',
+                                      columns=[gid_col, 'adjusted_population'], read_geometry=False)
+
+    admin_levels = load_admin_hierarchy(density.ADMIN_DIVISIONS_PATH, levels,
+                                        area_crs=region['area_crs'])
+    admin_divisions = admin_levels[finest_level]
+    cache = SpatialCache(density.CACHE_PATH)
+    shares = density.cell_admin_shares(admin_divisions, finest_level, cache)
+
+    changes = diff_releases(old_path, new_path)
+    added = changes[(changes['status'] == 'added') & (changes['new_population'] > 0)]
+    added_shares = added_cell_shares(new_path, added['fid'].to_numpy(), AdminLayer(admin_divisions),
+                                     gid_col)
+    all_shares = pd.concat([shares, added_shares], ignore_index=True)
+    deltas = zone_deltas(changes, all_shares, gid_col)
+    cell_counts = changed_cell_counts(changes, all_shares, admin_divisions, finest_level, levels)
+    report = change_report(admin_divisions, finest_level, baseline, deltas, levels, cell_counts)
+
+    # Cached under the new release, so the next one is diffed against it without an overlay
+    density.cell_admin_shares(admin_divisions, finest_level, cache, population_path=new_path,
+                              compute=lambda: update_shares(shares, changes, added_shares))
+
+    tag = f"{args.region}_ADM{args.level}_{new_path.stem}"
+    out = Path(args.output_dir)
+    report_file = out / f"population_change_{tag}.csv"
+    pd.concat([totals.assign(level=level) for level, totals in report.items()],
+              ignore_index=True).to_csv(report_file, index=False)
+
+    results_file = out / f"population_density_{tag}.gpkg"
+    results = attach_rollups(admin_levels, report)
+    for level, result in results.items():
+        result.to_file(results_file, layer=f'ADM_{level}', driver="GPKG")
+
+    for level in levels[:2]:
+        key = f'GID_{level}'
+        print(f"\nPopulation change by ADM{level}:")
+        print(report[level][[key, 'old_population', 'new_population', 'population_delta', 'pct_change']]
+              .sort_values('population_delta', key=abs, ascending=False).head(10))
+    print(f"\nChange report saved to: {report_file}")
+    print(f"Updated totals saved to: {results_file}")
+    return report
+
+
+def read_tolls(tolls_path, crs):
+    """Toll booths from the CSV with latitud/longitud columns (None if there is no file)."""
+    import geopandas as gpd
+    import pandas as pd
+
+    if not tolls_path.is_file():
+        return None
+    tolls_df = pd.read_csv(tolls_path).dropna(subset=['latitud', 'longitud'])
+    return gpd.GeoDataFrame(
+        tolls_df,
+        geometry=gpd.points_from_xy(tolls_df['longitud'], tolls_df['latitud']),
+        crs=crs,
+    )
+
+
+def run_roads(args):
+    import geopandas as gpd
+
+    from pipeline.cache import SpatialCache
+    from pipeline.zonal import ZonalEngine
+
+    region = get_region(args.region)
+    if 'roads' not in region and not (args.zones and args.roads):
+        raise ValueError(f"No road inputs configured for {args.region}; pass --zones and --roads")
+    config = region.get('roads', {})
+
+    zones_path = Path(args.zones or config['zones'])
+    zone_id = args.zone_id or config.get('zone_id', 'GID_1')
+    roads_path = Path(args.roads or config['roads'])
+    pop_path = Path(args.population or config.get('population', region['population']))
+    tolls_path = Path(args.tolls or config.get('tolls', ''))
+    output_file = Path(args.output or Path(args.output_dir) / f"road_density_{args.region}.parquet")
+
+    tolls = read_tolls(tolls_path, config.get('tolls_crs', 'EPSG:4326'))
+
+    def compute_zone_stats():
+        engine = ZonalEngine(gpd.read_file(zones_path), zone_id=zone_id, crs=region['area_crs'])
+        engine.add_layer('road', gpd.read_file(roads_path))
+        engine.add_layer('pop', gpd.read_file(pop_path), value_cols=['population'])
+        if tolls is not None:
+            engine.add_layer('peajes', tolls)
+        return engine.result()
+
+    cache = SpatialCache(Path(args.output_dir) / 'cache')
+    stats = cache.cached(
+        'zone_road_stats',
+        compute_zone_stats,
+        inputs=[roads_path, zones_path, pop_path] + ([tolls_path] if tolls is not None else []),
+        params={'zone_id': zone_id, 'crs': region['area_crs']},
+    )
+    stats = stats.rename(columns={
+        'road_length_km': 'total_road_length_km',
+        'pop_population': 'total_population',
+    })
+    stats['road_density'] = stats['total_road_length_km'] / stats['area_km2']
+    stats['pop_density'] = stats['total_population'] / stats['area_km2']
+
+    output_cols = [zone_id, 'area_km2', 'total_road_length_km', 'road_density', 'pop_density']
+    if 'peajes_count' in stats.columns:
+        output_cols.append('peajes_count')
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    stats[output_cols].to_parquet(output_file, index=False)
+    print(f"Road density for {len(stats):,} zones saved to: {output_file}")
+    return stats
+
+
+def run_pyramid(args):
+    from pipeline.h3_pyramid import build_pyramid, road_km_per_cell, write_pyramid
+    from pipeline.hextable import HexTable
+
+    region = get_region(args.region)
+    pop_path = Path(args.population or region['population'])
+    hex_roads = args.hex_roads or region.get('roads', {}).get('hex_roads')
+    output_dir = Path(args.output or Path(args.output_dir) / f"h3_pyramid_{args.region}")
+
+    table = HexTable.from_file(pop_path)
+    road_km = None
+    if hex_roads and Path(hex_roads).is_file():
+        road_km = road_km_per_cell(hex_roads, table.h3)
+    else:
+        print("No per-hexagon road table; road_km is left at 0")
+    pyramid = build_pyramid(table.h3, table.population, road_km,
+                            min_resolution=args.min_resolution)
+    return write_pyramid(pyramid, output_dir)
+
+
+def run_query(args):
+    import geopandas as gpd
+    import shapely
+
+    from pipeline.polygon_query import PolygonQuery
+
+    query = PolygonQuery(args.pyramid or Path(args.output_dir) / f"h3_pyramid_{args.region}")
+    if args.wkt:
+        result = query.totals(shapely.from_wkt(args.wkt), crs=args.crs)
+        print(result)
+        return result
+
+    polygons = gpd.read_file(args.polygons, layer=args.layer)
+    if args.id:
+        polygons = polygons.set_index(args.id)
+    totals = query.totals_frame(polygons)
+    print(totals)
+    print(f"{len(totals):,} polygons, median {totals['seconds'].median() * 1000:.1f} ms per query")
+    if args.output:
+        totals.to_csv(args.output)
+        print(f"Totals saved to: {args.output}")
+    return totals
+
+
+def run_access(args):
+    import geopandas as gpd
+
+    from pipeline.accessibility import AccessibilityEngine, hexagon_accessibility
+
+    region = get_region(args.region)
+    if 'roads' not in region and not (args.zones and args.roads):
+        raise ValueError(f"No road inputs configured for {args.region}; pass --zones and --roads")
+    config = region.get('roads', {})
+    zones_path = Path(args.zones or config['zones'])
+    zone_id = args.zone_id or config.get('zone_id', 'GID_1')
+    pop_path = Path(args.population or config.get('population', region['population']))
+    out = Path(args.output_dir)
+    output_file = Path(args.output or out / f"accessibility_{args.region}.csv")
+    out.mkdir(parents=True, exist_ok=True)
+
+    engine = AccessibilityEngine(
+        gpd.read_file(args.roads or config['roads']),
+        read_tolls(Path(args.tolls or config.get('tolls', '')), config.get('tolls_crs', 'EPSG:4326')),
+        crs=region['area_crs'],
+        spacing=args.spacing,
+    )
+    report = hexagon_accessibility(
+        pop_path, engine, gpd.read_file(zones_path, layer=args.zones_layer), zone_id,
+        workers=args.workers or -1,
+        hexagons_path=out / f"accessibility_{args.region}_hexagons.parquet" if args.hexagons else None,
+    )
+    report.to_csv(output_file, index=False)
+    print(report.sort_values('mean_road_km', ascending=False).head(10))
+    print(f"Accessibility for {len(report):,} zones saved to: {output_file}")
+    return report
+
+
+def run_reconcile(args):
+    import geopandas as gpd
+    import pandas as pd
+
+    from pipeline.reconcile import kontur_departments, reconcile
+
+    out = Path(args.output_dir)
+    all_departments, all_countries = [], []
+    for name in args.regions:
+        region = get_region(name)
+        gadm_path = Path(args.gadm_results or out / f"population_density_{name}_ADM1_{args.backend}.gpkg")
+        kontur_path = Path(args.kontur or region['kontur_boundaries'])
+        if not gadm_path.exists():
+            raise FileNotFoundError(f"{gadm_path} not found; run: python build.py density "
+                                    f"--region {name} --level 1 --backend {args.backend}")
+
+        print(f"\nReconciling {name}: {gadm_path.name} vs {kontur_path.name}")
+        kontur = kontur_departments(gpd.read_file(kontur_path), level=args.kontur_level)
+        departments, countries = reconcile(kontur, gpd.read_file(gadm_path, layer='ADM_1'),
+                                           region['area_crs'])
+        all_departments.append(departments.assign(region=name))
+        all_countries.append(countries.assign(region=name))
+
+    departments = pd.concat(all_departments, ignore_index=True)
+    countries = pd.concat(all_countries, ignore_index=True)
+    out.mkdir(parents=True, exist_ok=True)
+    departments.to_csv(out / 'reconcile_departments.csv', index=False)
+    countries.to_csv(out / 'reconcile_countries.csv', index=False)
+
+    print("\nCountries (GADM vs Kontur boundaries):")
+    print(countries[['region', 'GID_0', 'gadm_population', 'kontur_population', 'pct_difference',
+                     'matched', 'outliers', 'outlier']].to_string(index=False))
+    print(f"\nReports saved to: {out / 'reconcile_departments.csv'} and "
+          f"{out / 'reconcile_countries.csv'}")
+    return departments, countries
+
+
+def run_maps(args):
+    import geopandas as gpd
+
+    from pipeline.cache import SpatialCache
+    from pipeline.maps import (FIGSIZE, PIXEL_TOLERANCE, kontur_map_units, map_geometries,
+                               map_tasks, render_maps, save_manifest)
+    from pipeline.reconcile import kontur_departments
+
+    out = Path(args.output_dir)
+    cache = SpatialCache(out / 'cache')
+    tasks, manifests = [], {}
+    for name in args.regions:
+        region = get_region(name)
+        kontur_path = Path(args.kontur or region['kontur_boundaries'])
+        maps_dir = out / f"{name}_density_plots"
+        maps_dir.mkdir(parents=True, exist_ok=True)
+
+        print(f"\nMaps for {name}: {kontur_path.name}")
+        geometries = cache.cached(
+            'map_geometries',
+            lambda: map_geometries(kontur_map_units(kontur_departments(
+                gpd.read_file(kontur_path), level=args.kontur_level)), region['area_crs'], dpi=args.dpi),
+            inputs=[kontur_path],
+            crs=region['area_crs'],
+            params={'level': args.kontur_level, 'dpi': args.dpi, 'figsize': FIGSIZE,
+                    'pixel_tolerance': PIXEL_TOLERANCE},
+        )
+        region_tasks, manifests[maps_dir] = map_tasks(geometries, maps_dir, region['area_crs'],
+                                                      dpi=args.dpi, force=args.force)
+        tasks.extend(region_tasks)
+
+    # Every region's maps share one pool
+    rendered = render_maps(tasks, workers=args.workers)
+    for maps_dir, manifest in manifests.items():
+        save_manifest(maps_dir, manifest)
+    print(f"Rendered {len(rendered):,} maps, "
+          f"{sum(map(len, manifests.values())) - len(rendered):,} unchanged")
+    return rendered
+
+
+def run_publish(args):
+    import geopandas as gpd
+
+    from pipeline.h3_pyramid import road_km_lookup
+    from pipeline.handoff import publish_panels
+
+    region = get_region(args.region)
+    config = region.get('roads', {})
+    if args.zones or 'zones' in config:
+        zones = gpd.read_file(args.zones or config['zones'], layer=args.zones_layer)
+        zone_id = args.zone_id or config.get('zone_id', 'GID_1')
+    else:
+        # Departments of the region's admin GeoPackage
+        zones = gpd.read_file(region['admin'], layer=args.zones_layer or 'ADM_ADM_1')
+        zone_id = args.zone_id or 'GID_1'
+    name_col = args.name_col or next((col for col in ('NAME_1', 'dpto_cnmbr') if col in zones.columns),
+                                     None)
+    pop_path = Path(args.population or config.get('population', region['population']))
+    hex_roads = args.hex_roads or config.get('hex_roads')
+    if hex_roads and Path(hex_roads).is_file():
+        hex_roads = road_km_lookup(hex_roads)
+    else:
+        print("No per-hexagon road table; road_km is left at 0")
+        hex_roads = None
+
+    return publish_panels(Path(args.output_dir) / 'handoff' / args.region, args.region, pop_path,
+                          zones, zone_id, region['area_crs'], hex_roads=hex_roads, fmt=args.format,
+                          name_col=name_col)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(sub):
+        sub.add_argument('--region', choices=sorted(REGIONS), default='COL')
+        sub.add_argument('--output-dir', default=str(output_path),
+                         help="Directory for results, caches and traces")
+
+    admin = commands.add_parser('admin', help="Assemble a region's GADM admin GeoPackage")
+    add_common(admin)
+    admin.add_argument('--level', type=int, default=1, help="Finest admin level to assemble")
+    admin.add_argument('--countries', nargs='+', help="Override the region's country list")
+    admin.add_argument('--output', help="GeoPackage to write (default: the region's admin file)")
+    admin.add_argument('--download-dir', help="GADM country files (default: <output-dir>/gadm_downloads)")
+    admin.add_argument('--overwrite', action='store_true', help="Replace an existing --output file")
+    admin.add_argument('--workers', type=int, help="Download threads")
+    admin.set_defaults(func=run_admin)
+
+    density = commands.add_parser('density', help="Population per admin unit")
+    add_common(density)
+    density.add_argument('--level', type=int, default=1, help="Finest admin level (ADM0 up to it)")
+    density.add_argument('--backend', choices=BACKENDS, default='overlay')
+    density.add_argument('--workers', type=int, help="Worker processes (default: cpu_count - 2)")
+    density.add_argument('--memory', help="Memory budget for the run, e.g. 24GB "
+                                          "(default: 80%% of the available memory)")
+    density.add_argument('--batch-size', type=int, help="Hexagons per batch (default: from --memory)")
+    density.add_argument('--chunk-size', type=int, help="Hexagons per chunk (default: from --memory)")
+    density.add_argument('--population', help="Kontur population file")
+    density.add_argument('--admin', help="Admin GeoPackage with ADM_ADM_<level> layers")
+    density.add_argument('--raster-resolution', type=float, default=250, help="Metres (raster backend)")
+    density.add_argument('--instrumentation', default='basic', choices=list(LEVELS))
+    density.add_argument('--profile', choices=['cprofile', 'sampling'], help="Profile the workers")
+    density.set_defaults(func=run_density)
+
+    delta = commands.add_parser('delta', help="Update population totals to a new Kontur release")
+    add_common(delta)
+    delta.add_argument('--level', type=int, default=1, help="Finest admin level (ADM0 up to it)")
+    delta.add_argument('--new', required=True, help="Kontur population file of the new release")
+    delta.add_argument('--old', help="Release the current totals were computed from "
+                                     "(default: the region's population file)")
+    delta.add_argument('--baseline', help="Results GeoPackage for --old "
+                                          "(default: the density overlay output)")
+    delta.add_argument('--admin', help="Admin GeoPackage with ADM_ADM_<level> layers")
+    delta.add_argument('--workers', type=int, help="Worker processes if the baseline must be computed")
+    delta.add_argument('--memory', help="Memory budget if the baseline must be computed")
+    delta.add_argument('--instrumentation', default='basic', choices=list(LEVELS))
+    delta.set_defaults(func=run_delta, batch_size=None, chunk_size=None, raster_resolution=250,
+                       profile=None)
+
+    pyramid = commands.add_parser('pyramid', help="H3 pyramid of population and road km")
+    add_common(pyramid)
+    pyramid.add_argument('--population', help="Kontur population file")
+    pyramid.add_argument('--hex-roads', help="Parquet with h3 and total_road_length_km per hexagon")
+    pyramid.add_argument('--min-resolution', type=int, default=0, help="Coarsest H3 level to build")
+    pyramid.add_argument('--output', help="Dataset directory (default: <output-dir>/h3_pyramid_<region>)")
+    pyramid.set_defaults(func=run_pyramid)
+
+    query = commands.add_parser('query', help="Population and road km inside polygons (offline)")
+    add_common(query)
+    query.add_argument('--pyramid', help="Pyramid directory (default: <output-dir>/h3_pyramid_<region>)")
+    target = query.add_mutually_exclusive_group(required=True)
+    target.add_argument('--wkt', help="One polygon as WKT")
+    target.add_argument('--polygons', help="File with the query polygons")
+    query.add_argument('--crs', default='EPSG:4326', help="CRS of --wkt")
+    query.add_argument('--layer', help="Layer of --polygons")
+    query.add_argument('--id', help="Identifier column of --polygons")
+    query.add_argument('--output', help="CSV to write the totals to")
+    query.set_defaults(func=run_query)
+
+    access = commands.add_parser('access', help="Distance to the nearest road and toll booth")
+    add_common(access)
+    access.add_argument('--zones', help="Zone polygons to report (default: departments)")
+    access.add_argument('--zones-layer', help="Layer of --zones")
+    access.add_argument('--zone-id', help="Zone identifier column")
+    access.add_argument('--roads', help="Road lines")
+    access.add_argument('--population', help="Kontur population file")
+    access.add_argument('--tolls', help="Toll booth CSV with latitud/longitud")
+    access.add_argument('--spacing', type=float, default=100,
+                        help="Metres between densified road vertices (distance error <= half)")
+    access.add_argument('--workers', type=int, help="KD-tree query threads (default: all cores)")
+    access.add_argument('--hexagons', action='store_true', help="Also write per-hexagon distances")
+    access.add_argument('--output', help="CSV to write the per-zone report to")
+    access.set_defaults(func=run_access)
+
+    reconcile = commands.add_parser('reconcile', help="GADM totals vs Kontur boundary populations")
+    reconcile.add_argument('--regions', nargs='+', choices=sorted(REGIONS),
+                           default=['southamerica', 'africa'])
+    reconcile.add_argument('--output-dir', default=str(output_path),
+                           help="Directory with the density results; reports are written here")
+    reconcile.add_argument('--backend', choices=BACKENDS, default='overlay',
+                           help="Backend of the ADM1 density results to compare")
+    reconcile.add_argument('--gadm-results', help="ADM1 results GeoPackage (one region only)")
+    reconcile.add_argument('--kontur', help="Kontur boundaries GeoPackage (one region only)")
+    reconcile.add_argument('--kontur-level', type=int, default=4, help="OSM admin_level of departments")
+    reconcile.set_defaults(func=run_reconcile)
+
+    maps = commands.add_parser('maps', help="Population density map per country")
+    maps.add_argument('--regions', nargs='+', choices=sorted(REGIONS),
+                      default=['southamerica', 'africa'])
+    maps.add_argument('--output-dir', default=str(output_path),
+                      help="Maps go to <output-dir>/<region>_density_plots")
+    maps.add_argument('--kontur', help="Kontur boundaries GeoPackage (one region only)")
+    maps.add_argument('--kontur-level', type=int, default=4, help="OSM admin_level of departments")
+    maps.add_argument('--dpi', type=int, default=300)
+    maps.add_argument('--workers', type=int, help="Render processes (default: cpu_count - 2)")
+    maps.add_argument('--force', action='store_true', help="Render maps even if unchanged")
+    maps.set_defaults(func=run_maps)
+
+    publish = commands.add_parser('publish', help="Typed hexagon and department panels for R")
+    add_common(publish)
+    publish.add_argument('--format', choices=['parquet', 'feather'], default='parquet')
+    publish.add_argument('--population', help="Kontur population file")
+    publish.add_argument('--hex-roads', help="Parquet with h3 and total_road_length_km per hexagon")
+    publish.add_argument('--zones', help="Department polygons (default: the region's departments)")
+    publish.add_argument('--zones-layer', help="Layer of --zones")
+    publish.add_argument('--zone-id', help="Department identifier column")
+    publish.add_argument('--name-col', help="Department name column")
+    publish.set_defaults(func=run_publish)
+
+    roads = commands.add_parser('roads', help="Road and population density per zone")
+    add_common(roads)
+    roads.add_argument('--zones', help="Zone polygons")
+    roads.add_argument('--zone-id', help="Zone identifier column")
+    roads.add_argument('--roads', help="Road lines")
+    roads.add_argument('--population', help="Kontur population file")
+    roads.add_argument('--tolls', help="Toll booth CSV with latitud/longitud")
+    roads.add_argument('--output', help="Parquet file to write")
+    roads.set_defaults(func=run_roads)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    start = time.perf_counter()
+    result = args.func(args)
+    print(f"\n{args.command} finished in {time.perf_counter() - start:.1f}s")
+    if args.command == 'admin':
+        # run_admin returns the countries that could not be downloaded
+        sys.exit(1 if result else 0)
+    return result
+
+
+if __name__ == '__main__':
+    main()
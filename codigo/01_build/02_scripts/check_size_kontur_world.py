@@ -1,6 +1,8 @@
-import geopandas as gpd
 from pathlib import Path
-import fiona
+
+# Reads the GeoPackage's SQLite tables directly: no GDAL, geopandas or pandas
+# import, so the check returns in well under a second
+from pipeline.gpkg_meta import gpkg_layers
 
 # Set up paths and directories
 work_dir = Path(Path(__file__).parent.parent.parent.parent)
@@ -13,17 +15,17 @@ POPULATION_DATA_PATH = data_path / 'spatial' / 'kontur_population_CO_20231101.gp
 RESULTS_PATH = output_path / 'population_density_results.gpkg'
 
 
-# First, let's just count the rows using fiona
+# First, let's just count the rows from the GeoPackage metadata
 path = POPULATION_DATA_PATH
 
-with fiona.open(path) as src:
-    total_rows = len(src)
-    print(f"Total number of rows: {total_rows:,}")
-    
+for layer in gpkg_layers(path):
+    print(f"Layer {layer['name']}: {layer['features']:,} rows "
+          f"({layer['geometry_type']}, {layer['crs']})")
+
     # Let's also look at the schema to understand the data structure
     print("\nSchema:")
-    print(src.schema)
-    
-    # And get the file size in GB
-    file_size_gb = Path(path).stat().st_size / (1024**3)
-    print(f"\nFile size: {file_size_gb:.2f} GB")
+    print(layer['columns'])
+
+# And get the file size in GB
+file_size_gb = Path(path).stat().st_size / (1024**3)
+print(f"\nFile size: {file_size_gb:.2f} GB")
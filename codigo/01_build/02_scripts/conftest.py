@@ -0,0 +1 @@
+"""Lets the tests import ``pipeline`` the way the scripts do (run pytest from this directory)."""
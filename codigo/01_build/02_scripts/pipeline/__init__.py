@@ -0,0 +1,6 @@
+"""
+Shared building blocks for the population and road density build scripts.
+
+Scripts in ``codigo/01_build/02_scripts`` import this package directly; scripts
+elsewhere (e.g. ``codigo/descriptive``) add that directory to ``sys.path`` first.
+"""
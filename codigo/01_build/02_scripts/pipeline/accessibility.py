@@ -0,0 +1,175 @@
+"""
+Distance from every Kontur hexagon to the nearest road and toll booth.
+
+Road length per zone says how much infrastructure a department has, not how
+far its people live from it. ``AccessibilityEngine`` answers the latter with
+two KD-trees in an equal-area CRS:
+
+- roads: the vertices of every road line after densifying it to at most
+  ``spacing`` metres between vertices, so the distance to the nearest vertex
+  overestimates the distance to the road by at most ``spacing / 2``
+- toll booths: the booth points
+
+``hexagon_accessibility`` streams the Kontur file in Arrow batches (hexagon
+centroids only), queries both trees for each batch with scipy's worker
+threads, assigns centroids to zones on the shared ``AdminLayer`` tree and
+accumulates population-weighted sums per zone, so memory stays flat however
+many hexagons the file holds. Per-hexagon distances can be streamed to
+Parquet as well.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+
+from pipeline.admin_layer import AdminLayer
+from pipeline.point_assignment import point_zone_rows
+
+AREA_CRS = 'esri:102033'  # South America Albers Equal Area Conic
+DEFAULT_SPACING = 100  # metres between densified road vertices
+DEFAULT_READ_BATCH = 500_000
+ROAD_THRESHOLDS_KM = [1, 5, 10]
+TOLL_THRESHOLDS_KM = [10, 25, 50]
+
+
+def densified_vertices(geoms, spacing=DEFAULT_SPACING):
+    """Vertices of lines densified to at most ``spacing`` CRS units apart."""
+    geoms = np.asarray(geoms)
+    geoms = geoms[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))]
+    return shapely.get_coordinates(shapely.segmentize(geoms, spacing))
+
+
+class AccessibilityEngine:
+    """
+    Nearest-road and nearest-toll distances from KD-trees.
+
+    Args:
+        roads (GeoDataFrame): Road lines
+        tolls (GeoDataFrame): Toll booth points (optional)
+        crs: Equal-area CRS in metres the distances are measured in
+        spacing (float): Maximum metres between densified road vertices
+    """
+
+    def __init__(self, roads, tolls=None, crs=AREA_CRS, spacing=DEFAULT_SPACING):
+        self.crs = crs
+        self.spacing = spacing
+        vertices = densified_vertices(roads.to_crs(crs).geometry.to_numpy(), spacing)
+        self.road_tree = cKDTree(vertices)
+        self.toll_tree = None
+        if tolls is not None and len(tolls):
+            self.toll_tree = cKDTree(shapely.get_coordinates(tolls.to_crs(crs).geometry.to_numpy()))
+        print(f"Road tree: {len(vertices):,} vertices ({spacing} m spacing); "
+              f"toll tree: {0 if self.toll_tree is None else self.toll_tree.n:,} booths")
+
+    def distances(self, x, y, workers=-1):
+        """
+        Metres from each point to the nearest road and toll booth.
+
+        Args:
+            x, y (array): Coordinates in ``crs``
+            workers (int): Query threads (-1: all cores)
+
+        Returns:
+            dict: ``road_m`` and ``toll_m`` arrays (``toll_m`` NaN without booths)
+        """
+        points = np.column_stack([x, y])
+        road_m, _ = self.road_tree.query(points, workers=workers)
+        if self.toll_tree is None:
+            toll_m = np.full(len(points), np.nan)
+        else:
+            toll_m, _ = self.toll_tree.query(points, workers=workers)
+        return {'road_m': road_m, 'toll_m': toll_m}
+
+
+def hexagon_accessibility(pop_path, engine, zones, zone_id, read_batch=DEFAULT_READ_BATCH,
+                          workers=-1, hexagons_path=None, value_col='population', h3_col='h3'):
+    """
+    Population-weighted accessibility per zone from every hexagon's centroid.
+
+    Args:
+        pop_path (Path): Kontur population file
+        engine (AccessibilityEngine): Road and toll trees
+        zones (GeoDataFrame): Zones to report (e.g. departments)
+        zone_id (str): Identifier column of ``zones``
+        workers (int): KD-tree query threads (-1: all cores)
+        hexagons_path (Path): Also write ``h3``, population, zone and both
+            distances per hexagon to this Parquet file
+
+    Returns:
+        DataFrame: One row per zone with ``population``, ``hexagons``,
+        population-weighted ``mean_road_km``/``mean_toll_km`` and
+        ``pop_share_road_<k>km``/``pop_share_toll_<k>km`` for each threshold;
+        population outside every zone in ``.attrs``
+    """
+    layer = AdminLayer(zones.to_crs(engine.crs))
+    n_sums = len(layer.admin) + 1  # slot 0: outside every zone
+    columns = ['population', 'hexagons', 'road_km', 'toll_km'] + [
+        f'road_{km}' for km in ROAD_THRESHOLDS_KM] + [f'toll_{km}' for km in TOLL_THRESHOLDS_KM]
+    sums = {col: np.zeros(n_sums) for col in columns}
+    transformer = Transformer.from_crs(pyogrio.read_info(pop_path)['crs'], engine.crs, always_xy=True)
+    zone_ids = layer.admin[zone_id].to_numpy()
+    zone_labels = zone_ids.astype(str)
+    writer = None
+
+    try:
+        with pyogrio.open_arrow(pop_path, batch_size=read_batch, columns=[h3_col, value_col],
+                                use_pyarrow=True) as (meta, reader):
+            geom_col = meta['geometry_name'] or 'wkb_geometry'
+            for batch in tqdm(reader, desc="Hexagon accessibility"):
+                centroids = shapely.centroid(
+                    shapely.from_wkb(batch.column(geom_col).to_numpy(zero_copy_only=False)))
+                x, y = transformer.transform(shapely.get_x(centroids), shapely.get_y(centroids))
+                population = batch.column(value_col).to_numpy(zero_copy_only=False).astype('float64')
+                rows = point_zone_rows(layer, shapely.points(x, y))
+                dist = engine.distances(x, y, workers=workers)
+                road_km, toll_km = dist['road_m'] / 1000, dist['toll_m'] / 1000
+
+                codes = rows + 1
+
+                def add(col, weights):
+                    sums[col] += np.bincount(codes, weights=weights, minlength=n_sums)
+
+                add('population', population)
+                add('hexagons', np.ones(len(codes)))
+                add('road_km', population * road_km)
+                add('toll_km', population * np.nan_to_num(toll_km))
+                for km in ROAD_THRESHOLDS_KM:
+                    add(f'road_{km}', population * (road_km <= km))
+                for km in TOLL_THRESHOLDS_KM:
+                    add(f'toll_{km}', population * (toll_km <= km))
+
+                if hexagons_path is not None:
+                    table = pa.table({
+                        'h3': batch.column(h3_col),
+                        'population': population,
+                        zone_id: pa.array(np.where(rows >= 0, zone_labels[np.maximum(rows, 0)], None),
+                                          type=pa.string()),
+                        'road_km': road_km,
+                        'toll_km': toll_km,
+                    })
+                    if writer is None:
+                        writer = pq.ParquetWriter(hexagons_path, table.schema)
+                    writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    report = pd.DataFrame({zone_id: zone_ids, **{col: values[1:] for col, values in sums.items()}})
+    report = report.groupby(zone_id, as_index=False).sum()
+    population = report['population'].where(report['population'] > 0)
+    result = report[[zone_id, 'population']].assign(hexagons=report['hexagons'].astype('int64'))
+    result['mean_road_km'] = report['road_km'] / population
+    result['mean_toll_km'] = report['toll_km'] / population if engine.toll_tree is not None else np.nan
+    for km in ROAD_THRESHOLDS_KM:
+        result[f'pop_share_road_{km}km'] = report[f'road_{km}'] / population
+    for km in TOLL_THRESHOLDS_KM:
+        result[f'pop_share_toll_{km}km'] = (report[f'toll_{km}'] / population
+                                            if engine.toll_tree is not None else np.nan)
+    result.attrs['outside_population'] = float(sums['population'][0])
+    print(f"Population outside every zone: {sums['population'][0]:,.0f}")
+    return result
@@ -0,0 +1,94 @@
+"""
+Hierarchical (ADM0/ADM1/ADM2/ADM3) aggregation over GADM layers.
+
+Hexagons are intersected once with the finest requested GADM level. Because
+every finest-level unit carries the GID codes of all its ancestors
+(``GID_2`` rows also hold ``GID_1`` and ``GID_0``), coarser totals are obtained
+by re-grouping the finest sums instead of re-running the overlay.
+"""
+from pipeline.admin_layer import load_valid_admin
+
+GADM_LAYER_TEMPLATE = 'ADM_ADM_{level}'
+AREA_CRS = 'esri:102033'  # South America Albers Equal Area Conic
+
+
+def gid_columns(level):
+    """Return the GID columns identifying a unit at ``level`` (e.g. GID_0, GID_1)."""
+    return [f'GID_{lvl}' for lvl in range(level + 1)]
+
+
+def load_admin_hierarchy(gpkg_path, levels, area_crs=AREA_CRS):
+    """
+    Load several GADM levels from a country GeoPackage.
+
+    Geometries are repaired once per layer and reused (see ``load_valid_admin``).
+
+    Args:
+        gpkg_path (Path): GADM GeoPackage (e.g. gadm41_COL.gpkg)
+        levels (iterable): Admin levels to load, e.g. [0, 1, 2]
+        area_crs (str): Equal-area CRS used to fill ``area_km2`` when missing
+
+    Returns:
+        dict: level -> GeoDataFrame
+    """
+    admin_levels = {}
+    for level in sorted(set(levels)):
+        layer = GADM_LAYER_TEMPLATE.format(level=level)
+        gdf = load_valid_admin(gpkg_path, layer=layer)
+        if 'area_km2' not in gdf.columns:
+            gdf['area_km2'] = gdf.geometry.to_crs(area_crs).area / 1e6
+        admin_levels[level] = gdf
+        print(f"Loaded {layer}: {len(gdf):,} units")
+    return admin_levels
+
+
+def rollup_hierarchy(intersected, levels, value_cols=('adjusted_population',)):
+    """
+    Sum values at the finest level and roll them up to every coarser level.
+
+    Args:
+        intersected (DataFrame): Overlay result against the finest level; must
+            hold GID_0 ... GID_<finest> and the value columns
+        levels (iterable): Admin levels to report
+        value_cols (iterable): Columns to sum
+
+    Returns:
+        dict: level -> DataFrame with GID_0 ... GID_<level> and summed values
+    """
+    levels = sorted(set(levels))
+    value_cols = list(value_cols)
+    finest = levels[-1]
+
+    # One pass over the hexagon-level rows; everything else works on unit sums.
+    # observed=True: categorical GIDs (see HexTable.to_frame) group like strings
+    finest_sums = (
+        intersected.groupby(gid_columns(finest), dropna=False, observed=True)[value_cols]
+        .sum()
+        .reset_index()
+    )
+
+    rollups = {finest: finest_sums}
+    for level in levels[:-1]:
+        rollups[level] = (
+            finest_sums.groupby(gid_columns(level), dropna=False, observed=True)[value_cols]
+            .sum()
+            .reset_index()
+        )
+    return rollups
+
+
+def attach_rollups(admin_levels, rollups, value_col='adjusted_population'):
+    """
+    Merge rolled-up totals back onto each admin layer and compute density.
+
+    Returns:
+        dict: level -> GeoDataFrame with totals and ``population_density``
+    """
+    results = {}
+    for level, totals in rollups.items():
+        key = f'GID_{level}'
+        value_cols = [col for col in totals.columns if not col.startswith('GID_')]
+        result = admin_levels[level].merge(totals[[key] + value_cols], on=key, how='left')
+        result['population_density'] = result[value_col] / result['area_km2']
+        results[level] = result
+    return results
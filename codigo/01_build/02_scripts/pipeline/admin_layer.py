@@ -0,0 +1,187 @@
+"""
+Repaired, indexed admin layers shared by the overlay workers.
+
+GADM polygons occasionally self-intersect, which makes ``gpd.overlay`` throw
+inside the workers, and every chunk used to ship the whole admin layer to a
+worker that rebuilt its spatial index. ``load_valid_admin`` runs
+``make_valid`` once and stores the repaired layer as GeoParquet next to the
+source (``<stem>.<layer>.valid.parquet``, refreshed when the source
+changes). ``AdminLayer`` explodes it into single polygons, builds one STRtree
+and prepares the parts; the pool hands it to each worker once through
+``set_worker_admin_layer``, after which chunks only carry hexagons.
+"""
+from pathlib import Path
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+POLYGON_TYPES = (3, 6)  # Polygon, MultiPolygon
+
+
+def valid_layer_path(path, layer=None):
+    """Where the repaired copy of ``path``/``layer`` is stored."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{layer or 'default'}.valid.parquet")
+
+
+def make_valid_polygons(geoms):
+    """
+    Repair invalid polygons, keeping only their polygonal parts.
+
+    Returns:
+        tuple: (geometries, number of repaired geometries)
+    """
+    geoms = np.asarray(geoms, dtype=object).copy()
+    invalid = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+    if invalid.any():
+        try:
+            geoms[invalid] = shapely.make_valid(geoms[invalid], method='structure',
+                                                keep_collapsed=False)
+        except TypeError:  # shapely < 2.1
+            geoms[invalid] = polygonal_parts(shapely.make_valid(geoms[invalid]))
+    return geoms, int(invalid.sum())
+
+
+def polygonal_parts(geoms):
+    """Drop non-polygonal parts from geometry collections (as ``overlay`` does)."""
+    geoms = np.asarray(geoms, dtype=object).copy()
+    mixed = shapely.get_type_id(geoms) == 7
+    if mixed.any():
+        parts, owner = shapely.get_parts(geoms[mixed], return_index=True)
+        keep = np.isin(shapely.get_type_id(parts), POLYGON_TYPES)
+        polygons = shapely.get_parts(parts[keep])
+        polygon_owner = np.repeat(owner[keep], shapely.get_num_geometries(parts[keep]))
+        rebuilt = np.full(mixed.sum(), shapely.from_wkt('MULTIPOLYGON EMPTY'), dtype=object)
+        if len(polygons):
+            present = np.unique(polygon_owner)
+            rebuilt[present] = shapely.multipolygons(polygons, indices=np.searchsorted(present, polygon_owner))
+        geoms[mixed] = rebuilt
+    return geoms
+
+
+def load_valid_admin(path, layer=None):
+    """
+    Read an admin layer with valid geometries, repairing it only once.
+
+    Args:
+        path (Path): Admin GeoPackage (e.g. south_america_admin_divisions.gpkg)
+        layer (str): Layer name (default: first layer)
+
+    Returns:
+        GeoDataFrame: Same rows and columns as the source, valid geometries
+    """
+    path = Path(path)
+    fixed_path = valid_layer_path(path, layer)
+    meta_path = fixed_path.with_suffix('.json')
+    stat = path.stat()
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'layer': layer}
+
+    if fixed_path.exists() and meta_path.exists():
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['source'] == source:
+            return gpd.read_parquet(fixed_path)
+
+    admin = gpd.read_file(path, layer=layer)
+    geoms, repaired = make_valid_polygons(admin.geometry.values)
+    admin = admin.set_geometry(gpd.GeoSeries(geoms, index=admin.index, crs=admin.crs))
+    print(f"Repaired {repaired:,} of {len(admin):,} admin geometries in {path.name}"
+          f"{f' ({layer})' if layer else ''}; saved to {fixed_path.name}")
+
+    admin.to_parquet(fixed_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'source': source, 'repaired': repaired, 'rows': len(admin)}, f, indent=1)
+    return admin
+
+
+class AdminLayer:
+    """
+    Admin polygons exploded into parts with one STRtree and prepared geometries.
+
+    The tree and the prepared state are built lazily and dropped when the
+    layer is pickled, so a spawned worker rebuilds them once on first use;
+    forked workers inherit them from the parent.
+
+    Args:
+        admin (GeoDataFrame): Valid admin polygons (see ``load_valid_admin``)
+    """
+
+    def __init__(self, admin):
+        self.admin = admin
+        exploded = admin.geometry.reset_index(drop=True).explode(index_parts=False)
+        parts = exploded.to_numpy()
+        keep = ~shapely.is_empty(parts)
+        self.parts = parts[keep]
+        self.part_row = exploded.index.to_numpy()[keep]  # position of the part's admin row
+        self._tree = None
+
+    @classmethod
+    def from_file(cls, path, layer=None, crs=None):
+        admin = load_valid_admin(path, layer=layer)
+        if crs is not None and admin.crs != crs:
+            admin = admin.to_crs(crs)
+        return cls(admin)
+
+    @property
+    def crs(self):
+        return self.admin.crs
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            shapely.prepare(self.parts)
+            self._tree = shapely.STRtree(self.parts)
+        return self._tree
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tree'] = None
+        return state
+
+    def intersect(self, hexes):
+        """
+        Intersect hexagons with the admin layer (``gpd.overlay`` 'intersection').
+
+        Hexagons lying wholly inside one part are kept as they are; only
+        boundary hexagons are clipped. A hexagon touching two parts of the same
+        unit gives two rows, which sum to the same totals.
+
+        Returns:
+            GeoDataFrame: Hexagon columns, admin columns and the piece geometry
+        """
+        geoms = hexes.geometry.to_numpy()
+        hex_pos, part_pos = self.tree.query(geoms, predicate='intersects')
+        pieces = geoms[hex_pos].copy()
+        inside = shapely.contains_properly(self.parts[part_pos], pieces)
+        clip = ~inside
+        pieces[clip] = polygonal_parts(shapely.intersection(pieces[clip], self.parts[part_pos[clip]]))
+
+        keep = ~shapely.is_empty(pieces) & (shapely.area(pieces) > 0)
+        hex_pos, part_pos, pieces = hex_pos[keep], part_pos[keep], pieces[keep]
+
+        left = hexes.drop(columns=hexes.geometry.name).iloc[hex_pos].reset_index(drop=True)
+        right = self.admin.drop(columns=self.admin.geometry.name).iloc[self.part_row[part_pos]]
+        right = right.reset_index(drop=True)
+        shared = left.columns.intersection(right.columns)
+        left = left.rename(columns={col: f'{col}_1' for col in shared})
+        right = right.rename(columns={col: f'{col}_2' for col in shared})
+        return gpd.GeoDataFrame(pd.concat([left, right], axis=1), geometry=pieces, crs=hexes.crs)
+
+
+_worker_layer = None
+
+
+def set_worker_admin_layer(layer):
+    """Pool initializer: keep ``layer`` in the worker for all of its chunks."""
+    global _worker_layer
+    _worker_layer = layer
+
+
+def get_worker_admin_layer():
+    if _worker_layer is None:
+        raise RuntimeError("No admin layer in this process; start the pool with "
+                           "initializer=set_worker_admin_layer")
+    return _worker_layer
@@ -0,0 +1,286 @@
+"""
+Memory-budget batch, chunk and worker sizing for the overlay pipeline.
+
+Replaces the hand-picked ``BATCH_SIZE``/``CHUNK_SIZE``/``cpu_count() - 2``
+settings. ``MemoryTuner.calibrate`` reads a small sample of hexagons and
+intersects part of it with the admin layer in the parent to estimate:
+
+- bytes per hexagon held by the parent (batch frame, sjoin, candidates)
+- bytes per hexagon in a worker (input chunk, overlay pieces, pickles)
+- bytes per admin vertex (polygons, prepared geometries, STRtree), which
+  every worker holds once
+- the fraction of hexagons that survive the sjoin and the bytes their
+  pieces keep in the parent until the end of the run
+
+and ``plan`` turns these into a batch size, chunk size and worker count that
+fit the budget. Between batches ``end_batch`` compares the measured peak
+(parent high-water mark plus each worker's growth past its start-up, from
+per-task peaks so a reused pool does not carry one heavy batch forward) with the
+budget, shrinking the next batch, chunks and pool when it ran hot and
+growing the batch when it ran cold.
+
+Every batch's sizes are appended to ``batches.json`` in the chunk ledger
+directory; a rerun replays them so the chunk keys match and finished chunks
+are reused.
+"""
+from pathlib import Path
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import pyogrio
+import shapely
+
+from pipeline.instrumentation import MB, current_rss, high_water_rss, reset_peak_rss
+from pipeline.partitioned import parse_bytes
+from pipeline.scheduling import MIN_TASK_ROWS
+
+SAMPLE_ROWS = 20_000      # hexagons read to calibrate
+SAMPLE_CHUNK_ROWS = 2_000  # of which intersected in the parent
+SAFETY = 0.8              # share of the budget the plan may use
+WORKER_SHARE = 0.6        # of the free memory, for the pool
+BATCH_COPIES = 4          # batch frame, sjoin result, candidates, chunk copies
+WORKER_COPIES = 3         # unpickled chunk, overlay intermediates, pickled result
+WORKER_BASE_BYTES = 200 * MB  # interpreter and libraries in a spawned worker
+MIN_BYTES_PER_VERTEX = 48
+GEOS_FACTOR = 2.0         # GEOS geometry size relative to its WKB
+MIN_BATCH_ROWS = 10_000
+MAX_CHUNK_ROWS = 5_000
+HIGH_WATER = 0.9          # shrink above this share of the budget
+LOW_WATER = 0.5           # grow below it
+GROWTH = 1.5
+
+
+def available_memory():
+    """Memory available to this run in bytes (psutil, else /proc/meminfo)."""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def frame_bytes(gdf):
+    """Approximate in-memory size of a GeoDataFrame (columns plus GEOS geometries)."""
+    columns = gdf.drop(columns=gdf.geometry.name).memory_usage(deep=True, index=False).sum()
+    geoms = gdf.geometry.to_numpy()
+    wkb = shapely.to_wkb(geoms[~shapely.is_missing(geoms)])
+    return int(columns + GEOS_FACTOR * sum(len(b) for b in wkb))
+
+
+class MemoryTuner:
+    """
+    Sizes batches, chunks and the worker pool from a memory budget.
+
+    Args:
+        memory_budget (int or str): Bytes for the parent and all workers
+            together, e.g. '24GB' (default: 80% of the available memory)
+        num_cores (int): Upper bound on workers (default: cpu_count - 2)
+        batch_rows, chunk_rows, workers (int): Pin a setting instead of tuning it
+        history_path (Path): Where the per-batch sizes are kept for reruns
+    """
+
+    def __init__(self, memory_budget=None, num_cores=None, batch_rows=None, chunk_rows=None,
+                 workers=None, history_path=None):
+        self.budget = parse_bytes(memory_budget) or int(0.8 * available_memory())
+        self.num_cores = num_cores or max(1, multiprocessing.cpu_count() - 2)
+        self.pinned = {'batch_rows': batch_rows, 'chunk_rows': chunk_rows, 'workers': workers}
+        self.batch_rows = batch_rows
+        self.chunk_rows = chunk_rows
+        self.workers = workers
+        self.costs = None
+        self._fork_rss = None  # parent RSS when the (possibly reused) pool was forked
+
+        self.history_path = Path(history_path) if history_path else None
+        self.history = []
+        if self.history_path is not None and self.history_path.exists():
+            self.history = json.loads(self.history_path.read_text())
+            print(f"Replaying {len(self.history)} batch sizes from {self.history_path}")
+        self._replay = {entry['start']: entry for entry in self.history}
+
+    def calibrate(self, pop_path, admin_layer):
+        """
+        Estimate memory costs from a sample of ``pop_path``.
+
+        Args:
+            pop_path (Path): Kontur population file
+            admin_layer (AdminLayer): Repaired admin layer (its tree is built here)
+
+        Returns:
+            dict: The estimated costs (also kept on the tuner)
+        """
+        total_rows = pyogrio.read_info(pop_path)['features']
+
+        # Admin layer: held once by every worker
+        rss = current_rss()
+        admin_layer.tree
+        vertices = int(shapely.get_num_coordinates(admin_layer.parts).sum())
+        admin_bytes = max(current_rss() - rss + frame_bytes(admin_layer.admin),
+                          vertices * MIN_BYTES_PER_VERTEX)
+
+        # Parent side: a batch after reprojection
+        rss = current_rss()
+        sample = pyogrio.read_dataframe(pop_path, max_features=min(SAMPLE_ROWS, total_rows))
+        if sample.crs != admin_layer.crs:
+            sample = sample.to_crs(admin_layer.crs)
+        sample['hex_area'] = sample.geometry.area
+        sample['hex_id'] = np.arange(len(sample))
+        parent_per_hex = max(current_rss() - rss, frame_bytes(sample)) / max(len(sample), 1)
+
+        # Worker side: overlay a slice of the hexagons that touch the admin layer
+        hits = np.unique(admin_layer.tree.query(sample.geometry.to_numpy(), predicate='intersects')[0])
+        hit_fraction = len(hits) / max(len(sample), 1)
+        chunk = sample.iloc[hits[:SAMPLE_CHUNK_ROWS]]
+        pieces = admin_layer.intersect(chunk) if len(chunk) else None
+        result_per_hex = frame_bytes(pieces) / len(chunk) if pieces is not None and len(pieces) else 0
+        chunk_per_hex = frame_bytes(chunk) / len(chunk) if len(chunk) else parent_per_hex
+
+        self.costs = {
+            'total_rows': total_rows,
+            'parent_bytes_per_hex': parent_per_hex,
+            'worker_bytes_per_hex': WORKER_COPIES * (chunk_per_hex + result_per_hex),
+            'result_bytes_per_hex': result_per_hex,
+            'hit_fraction': hit_fraction,
+            'admin_vertices': vertices,
+            'bytes_per_vertex': admin_bytes / max(vertices, 1),
+            'admin_bytes': admin_bytes,
+        }
+        print(f"Memory calibration on {len(sample):,} hexagons: "
+              f"{parent_per_hex:,.0f} B/hexagon in the parent, "
+              f"{self.costs['worker_bytes_per_hex']:,.0f} B/hexagon in a worker, "
+              f"{self.costs['bytes_per_vertex']:,.0f} B/admin vertex "
+              f"({admin_bytes / MB:,.0f} MB per worker), {hit_fraction:.0%} of hexagons touch the admin layer")
+        return self.costs
+
+    def plan(self):
+        """Pick batch size, chunk size and workers for the budget (after ``calibrate``)."""
+        costs = self.costs
+        # Overlay pieces of every batch stay in the parent until the end
+        results = costs['total_rows'] * costs['hit_fraction'] * costs['result_bytes_per_hex']
+        free = SAFETY * self.budget - current_rss() - results
+        if free <= 0:
+            print(f"WARNING: memory budget {self.budget / MB:,.0f} MB is below the estimated "
+                  f"resident need; using minimum sizes")
+            free = 0
+
+        worker_fixed = WORKER_BASE_BYTES + costs['admin_bytes']
+        pool_memory = WORKER_SHARE * free
+        workers = self.pinned['workers'] or int(np.clip(
+            pool_memory // (worker_fixed + MAX_CHUNK_ROWS * costs['worker_bytes_per_hex']),
+            1, self.num_cores,
+        ))
+        chunk_rows = self.pinned['chunk_rows'] or int(np.clip(
+            (pool_memory / workers - worker_fixed) // costs['worker_bytes_per_hex'],
+            MIN_TASK_ROWS, MAX_CHUNK_ROWS,
+        ))
+        pool_used = workers * (worker_fixed + chunk_rows * costs['worker_bytes_per_hex'])
+        batch_rows = self.pinned['batch_rows'] or int(np.clip(
+            (free - pool_used) // (BATCH_COPIES * costs['parent_bytes_per_hex']),
+            MIN_BATCH_ROWS, max(MIN_BATCH_ROWS, costs['total_rows']),
+        ))
+
+        self.batch_rows, self.chunk_rows, self.workers = batch_rows, chunk_rows, workers
+        print(f"Memory plan for {self.budget / MB:,.0f} MB: batches of {batch_rows:,} hexagons, "
+              f"chunks of up to {chunk_rows:,}, {workers} workers")
+        return {'batch_rows': batch_rows, 'chunk_rows': chunk_rows, 'workers': workers}
+
+    def batches(self, total_rows):
+        """Yield ``(start, batch_rows, chunk_rows, workers)``, resizing after every batch."""
+        start = 0
+        while start < total_rows:
+            batch_rows, chunk_rows, workers = self.begin_batch(start)
+            yield start, batch_rows, chunk_rows, workers
+            self.end_batch(min(batch_rows, total_rows - start))
+            start += batch_rows
+
+    def begin_batch(self, start):
+        """
+        Sizes for the batch starting at row ``start`` (replayed on a rerun).
+
+        Returns:
+            tuple: (batch_rows, chunk_rows, workers)
+        """
+        replay = self._replay.get(start)
+        if replay is not None:
+            self.batch_rows, self.chunk_rows, self.workers = (
+                replay['batch_rows'], replay['chunk_rows'], replay['workers'])
+        self._start = start
+        self._tracked = reset_peak_rss()
+        self._samples = [current_rss()]
+        self._worker_peaks = {}
+        return self.batch_rows, self.chunk_rows, self.workers
+
+    def sample(self):
+        """Record the parent's RSS (fallback where the high-water mark cannot be reset)."""
+        self._samples.append(current_rss())
+
+    def pool_started(self, start_method):
+        """Forked workers start with the parent's pages; only their growth is counted."""
+        self.sample()
+        self._fork_rss = self._samples[-1] if start_method == 'fork' else None
+
+    def record_worker(self, timing):
+        """
+        Keep each worker's peak growth in this batch from a chunk timing (see ``timed_call``).
+
+        Growth is over the worker's RSS after start-up (``base_rss_mb``), so
+        pages preloaded in the fork server or inherited from the parent are
+        not counted; without it, over the parent's RSS at fork (else 0).
+        """
+        pid = timing['pid']
+        base = timing.get('base_rss_mb')
+        base = (self._fork_rss or 0) if base is None else base * MB
+        growth = timing['peak_rss_mb'] * MB - base
+        self._worker_peaks[pid] = max(self._worker_peaks.get(pid, 0), growth)
+
+    def end_batch(self, rows):
+        """
+        Compare the batch's peak memory with the budget and resize the next batch.
+
+        Args:
+            rows (int): Hexagons read in the batch
+        """
+        self.sample()
+        parent = max(self._samples)
+        if self._tracked:
+            parent = max(parent, high_water_rss() or 0)
+        workers = sum(max(growth, 0) for growth in self._worker_peaks.values())
+        peak = parent + workers
+        share = peak / self.budget
+
+        entry = {'start': self._start, 'rows': rows, 'batch_rows': self.batch_rows,
+                 'chunk_rows': self.chunk_rows, 'workers': self.workers,
+                 'peak_mb': round(peak / MB, 1)}
+        if self._start not in self._replay:
+            self.history.append(entry)
+            if self.history_path is not None:
+                self.history_path.write_text(json.dumps(self.history, indent=1))
+
+        print(f"Batch memory peak {peak / MB:,.0f} MB ({share:.0%} of budget; "
+              f"parent {parent / MB:,.0f} MB, workers +{workers / MB:,.0f} MB)")
+        if share > HIGH_WATER:
+            scale = (LOW_WATER + HIGH_WATER) / 2 / share
+            if workers > parent and not self.pinned['workers']:
+                self.workers = max(1, int(self.workers * scale))
+            if not self.pinned['chunk_rows']:
+                self.chunk_rows = max(MIN_TASK_ROWS, int(self.chunk_rows * scale))
+            if not self.pinned['batch_rows']:
+                self.batch_rows = max(MIN_BATCH_ROWS // 10, int(self.batch_rows * scale))
+            print(f"Shrinking to batches of {self.batch_rows:,}, chunks of {self.chunk_rows:,}, "
+                  f"{self.workers} workers")
+        elif share < LOW_WATER and not self.pinned['batch_rows']:
+            grown = int(self.batch_rows * GROWTH)
+            if self.costs is not None:
+                grown = min(grown, self.costs['total_rows'])
+            if grown > self.batch_rows:
+                self.batch_rows = grown
+                print(f"Growing batches to {self.batch_rows:,} hexagons")
+        return entry
+
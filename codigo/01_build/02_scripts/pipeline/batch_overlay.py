@@ -0,0 +1,342 @@
+"""
+Batched, parallel overlay of population hexagons with admin divisions.
+
+Shared by the Colombia and South America drivers. ``process_population_in_batches``
+reads the Kontur file in batches sized by ``MemoryTuner``, keeps the hexagons
+that touch an admin unit and hands them to ``parallel_intersection``, which
+cuts them into chunks (see pipeline/scheduling.py), writes them once to a
+memory-mapped ``HexStore`` and overlays the chunks in a worker pool. Chunk
+outcomes go to a ``ChunkLedger`` so a rerun only redoes what failed.
+"""
+import multiprocessing
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+from tqdm import tqdm
+
+from pipeline.admin_layer import AdminLayer, get_worker_admin_layer, set_worker_admin_layer
+from pipeline.autotune import MemoryTuner
+from pipeline.hexstore import HexStore, load_hexes
+from pipeline.instrumentation import get_instrumentation, start_worker
+from pipeline.pools import pool_context
+from pipeline.profiling import get_profiler
+from pipeline.resilience import ChunkLedger, chunk_key, run_chunks
+from pipeline.scheduling import plan_tasks, report_chunk_runtimes
+
+
+def process_chunk(chunk_data):
+    """
+    Process a chunk of data with diagnostic information.
+
+    Errors are not caught here: the pool wrapper reports them to the parent,
+    which repairs and retries the chunk (see pipeline/resilience.py). With
+    no admin divisions in the chunk, the worker's shared AdminLayer is used.
+    Hexagons arrive as a ``HexRange`` of the batch's memory-mapped store.
+    """
+    df_chunk, admin_divisions = chunk_data
+    df_chunk = load_hexes(df_chunk)
+    if admin_divisions is None:
+        result = get_worker_admin_layer().intersect(df_chunk)
+    else:
+        result = gpd.overlay(df_chunk, admin_divisions, how='intersection')
+    if result is not None and len(result) > 0:
+        print(f"Chunk processed successfully: {len(result)} intersections found")
+        return result
+    else:
+        print(f"Warning: Empty result for chunk of size {len(df_chunk)}")
+        return None
+
+
+def chunk_sizes(num_rows, num_chunks):
+    """
+    Row counts of roughly equal chunks for parallel processing.
+
+    Args:
+        num_rows (int): Rows to split
+        num_chunks (int): Number of chunks to split the data into
+
+    Returns:
+        list: Rows per chunk (the first ``num_rows % num_chunks`` get one extra)
+    """
+    chunk_size, remainder = divmod(num_rows, num_chunks)
+    return [chunk_size + (1 if i < remainder else 0) for i in range(num_chunks)]
+
+
+def overlay_pool(num_cores, admin_layer=None, start_method=None, tuner=None):
+    """
+    Worker pool for ``process_chunk``, with ``admin_layer`` installed in every worker.
+
+    Starting workers is not free: under forkserver or spawn the admin layer
+    is pickled to each of them and its STRtree rebuilt there, so one pool
+    should serve every batch of a run (see ``process_population_in_batches``).
+
+    Args:
+        num_cores (int): Worker processes
+        admin_layer (AdminLayer): Shared admin divisions (None: chunks carry their own)
+        start_method (str): Pool start method (default: see pipeline/pools.py)
+        tuner (MemoryTuner): Told the start method, to count forked workers' growth only
+
+    Returns:
+        multiprocessing.pool.Pool: The caller closes it
+    """
+    initializer, initargs = None, ()
+    if admin_layer is not None:
+        # Built once here: forked workers inherit it, others get it once per worker
+        admin_layer.tree
+        initializer, initargs = set_worker_admin_layer, (admin_layer,)
+
+    context = pool_context(start_method)
+    if tuner is not None:
+        tuner.pool_started(context.get_start_method())
+    # start_worker notes each worker's start-up RSS for the tuner
+    return context.Pool(num_cores, initializer=start_worker, initargs=(initializer, initargs))
+
+
+def parallel_intersection(df1, df2, chunk_size=5000, num_cores=None, scheduler='adaptive',
+                          ledger=None, key_prefix='chunk', admin_layer=None, tuner=None,
+                          start_method=None, pool=None):
+    """
+    Parallel intersection with enhanced diagnostics.
+
+    Args:
+        df1 (GeoDataFrame): Hexagons to intersect
+        df2 (GeoDataFrame): Admin divisions (same CRS)
+        chunk_size (int): Maximum hexagons per chunk
+        num_cores (int): Pool size (default: cpu_count - 2)
+        scheduler (str): 'adaptive' cuts spatial chunks by estimated cost and
+            runs the most expensive first; 'fixed' makes equal row chunks
+        ledger (ChunkLedger): Records every chunk outcome; chunks it already
+            holds as finished are reused instead of recomputed
+        key_prefix (str): Prefix of the chunk keys in the ledger (e.g. the batch)
+        admin_layer (AdminLayer): Repaired, indexed ``df2``; handed to each
+            worker once instead of sending admin polygons with every chunk
+        tuner (MemoryTuner): Receives the workers' peak RSS for the next batch's sizes
+        start_method (str): Pool start method (default: forkserver with the
+            heavy modules preloaded, see pipeline/pools.py)
+        pool (Pool): ``overlay_pool`` to run the chunks on, left open; by
+            default one is started for this call and closed after it
+    """
+    print(f"\nStarting parallel intersection:")
+    print(f"Input data size: {len(df1):,} rows")
+    print(f"Number of admin areas: {len(df2):,}")
+
+    num_cores = num_cores or max(1, multiprocessing.cpu_count() - 2)
+
+    if scheduler == 'adaptive':
+        tasks = plan_tasks(df1, df2, num_cores, max_rows=chunk_size)
+        order = np.concatenate([task['rows'] for task in tasks])
+        sizes = [len(task['rows']) for task in tasks]
+        chunk_costs = [task['cost'] for task in tasks]
+    else:
+        num_chunks = max(num_cores * 2, len(df1) // chunk_size)
+        order = None
+        sizes = chunk_sizes(len(df1), num_chunks)
+        chunk_costs = None
+
+    if admin_layer is not None:
+        admin_parts = [None] * len(sizes)
+    elif scheduler == 'adaptive':
+        # Each chunk only carries the admin polygons it can touch
+        admin_parts = [df2.iloc[task['admin_rows']] for task in tasks]
+    else:
+        admin_parts = [df2] * len(sizes)
+
+    # The batch is written once in task order; each chunk is a (start, stop)
+    # range of it that workers memory-map instead of receiving pickled rows
+    store = HexStore.write(df1, order)
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+
+    instr = get_instrumentation()
+    profiler = get_profiler()
+    ledger = ledger if ledger is not None else ChunkLedger()
+    chunks = []
+    for i, admin in enumerate(admin_parts):
+        hexes = store.range(bounds[i], bounds[i + 1])
+        chunks.append({'key': chunk_key(key_prefix, hexes.index), 'hexes': hexes, 'admin': admin,
+                       'cost': None if chunk_costs is None else chunk_costs[i]})
+
+    timings = []
+    timing_costs = []
+    progress = tqdm(total=len(chunks), desc="Processing chunks")
+
+    def on_result(timing, chunk, result):
+        profiler.record(timing, pool='overlay')
+        if tuner is not None:
+            tuner.record_worker(timing)
+        timings.append({**timing, 'tag': len(timings)})
+        timing_costs.append(chunk['cost'])
+        instr.chunk('overlay_chunk', timing, rows_in=len(chunk['hexes']),
+                    rows_out=0 if result is None else len(result),
+                    est_cost=chunk['cost'], attempt=chunk['attempt'], error=timing['error'])
+        if chunk['attempt'] == 'initial':
+            progress.update()
+
+    own_pool = pool is None
+    if own_pool:
+        pool = overlay_pool(num_cores, admin_layer, start_method, tuner)
+
+    try:
+        results = run_chunks(pool, profiler.runner(), process_chunk, chunks, ledger,
+                             on_result=on_result)
+
+    except Exception as e:
+        print(f"Error in parallel processing: {str(e)}")
+        raise
+
+    finally:
+        progress.close()
+        store.remove()
+        if own_pool:
+            pool.terminate()
+
+    report_chunk_runtimes(timings, None if chunk_costs is None else timing_costs)
+
+    if not results:
+        raise ValueError("No valid results obtained from parallel processing")
+
+    combined_result = pd.concat(results, ignore_index=True)
+    print(f"\nParallel processing completed:")
+    print(f"Total intersections found: {len(combined_result):,}")
+    return combined_result
+
+
+def process_population_in_batches(pop_path, admin_divisions, batch_size=None,
+                                  chunk_size=None, num_cores=None, scheduler='adaptive',
+                                  ledger=None, admin_layer=None, memory_budget=None, sketch=None,
+                                  area_crs=None, intermediate_dir=None):
+    """
+    Process population data in batches, timing every stage.
+
+    Args:
+        batch_size, chunk_size, num_cores (int): Fixed sizes; those left as None
+            are picked by MemoryTuner from a sample and adjusted between batches
+        memory_budget (int or str): Memory for the parent and all workers,
+            e.g. '24GB' (default: 80% of the available memory)
+        sketch (DensitySketch): Updated with every batch's pieces, so the
+            density distributions need no second pass
+        area_crs: Equal-area CRS of the sketch's km² (for admin divisions in degrees)
+        intermediate_dir (Path): Where every fifth batch saves the results so
+            far (default: not saved)
+
+    Raises:
+        ConservationError: If some chunks still fail after repair and splitting
+    """
+    instr = get_instrumentation()
+    ledger = ledger if ledger is not None else ChunkLedger()
+    instr.diagnostic("Admin Divisions Input", admin_divisions)
+
+    total_rows = pyogrio.read_info(pop_path)['features']
+    print(f"\nTotal population hexagons to process: {total_rows:,}")
+
+    # Sizes from the memory budget; a rerun replays the sizes recorded in the ledger
+    tuner = MemoryTuner(memory_budget, batch_rows=batch_size, chunk_rows=chunk_size,
+                        workers=num_cores,
+                        history_path=ledger.ledger_dir and ledger.ledger_dir / 'batches.json')
+    if None in (batch_size, chunk_size, num_cores):
+        with instr.stage('calibrate'):
+            tuner.calibrate(pop_path, admin_layer or AdminLayer(admin_divisions))
+            tuner.plan()
+
+    all_results = []
+    total_population = 0
+    # One pool for the run, restarted only when the tuner changes the worker count
+    pool, pool_cores = None, None
+
+    try:
+        for batch_start, batch_size, chunk_size, num_cores in tqdm(tuner.batches(total_rows),
+                                                                   desc="Processing batches"):
+            if num_cores != pool_cores:
+                if pool is not None:
+                    pool.terminate()
+                pool = overlay_pool(num_cores, admin_layer, tuner=tuner)
+                pool_cores = num_cores
+            with instr.stage('batch', batch_start=batch_start, batch_size=batch_size):
+                # Load batch
+                with instr.stage('read', batch_start=batch_start) as rec:
+                    world_pop_batch = gpd.read_file(
+                        pop_path,
+                        rows=slice(batch_start, batch_start + batch_size)
+                    )
+                    rec['rows_out'] = len(world_pop_batch)
+                tuner.sample()
+
+                instr.diagnostic("Batch Input", world_pop_batch)
+
+                # CRS alignment
+                with instr.stage('reproject', rows_in=len(world_pop_batch)) as rec:
+                    if world_pop_batch.crs != admin_divisions.crs:
+                        world_pop_batch = world_pop_batch.to_crs(admin_divisions.crs)
+
+                    # Keep the full hexagon area so overlay pieces can be apportioned
+                    world_pop_batch['hex_area'] = world_pop_batch.geometry.area
+                    # Row number in the Kontur file, for the conservation checks
+                    world_pop_batch['hex_id'] = np.arange(batch_start, batch_start + len(world_pop_batch))
+                    rec['rows_out'] = len(world_pop_batch)
+
+                # Find intersecting hexagons
+                with instr.stage('sjoin', rows_in=len(world_pop_batch)) as rec:
+                    intersecting = gpd.sjoin(
+                        world_pop_batch,
+                        admin_divisions,
+                        predicate='intersects',
+                        how='inner'
+                    )
+                    rec['rows_out'] = len(intersecting)
+                tuner.sample()
+
+                instr.diagnostic("After Spatial Join", intersecting)
+
+                if len(intersecting) == 0:
+                    print(f"WARNING: No intersecting hexagons found in batch starting at {batch_start}")
+                    continue
+
+                # A boundary hexagon matches several admin units; overlay it only once
+                candidates = world_pop_batch.loc[intersecting.index.unique()]
+                with instr.stage('overlay', rows_in=len(candidates)) as rec:
+                    batch_result = parallel_intersection(
+                        candidates,
+                        admin_divisions,
+                        chunk_size=chunk_size,
+                        num_cores=num_cores,
+                        scheduler=scheduler,
+                        ledger=ledger,
+                        key_prefix=f'b{batch_start}',
+                        admin_layer=admin_layer,
+                        tuner=tuner,
+                        pool=pool,
+                    )
+                    rec['rows_out'] = len(batch_result)
+
+                instr.diagnostic("Batch Result", batch_result)
+                all_results.append(batch_result)
+                if sketch is not None:
+                    sketch.update_pieces(batch_result, area_crs)
+
+                # Update total population
+                total_population += batch_result['population'].sum()
+                print(f"Cumulative total population: {total_population:,.0f}")
+
+                # Save intermediate results
+                if intermediate_dir is not None and len(all_results) % 5 == 0:
+                    with instr.stage('write_intermediate') as rec:
+                        intermediate = pd.concat(all_results, ignore_index=True)
+                        intermediate_path = intermediate_dir / f'intermediate_results_batch_{len(all_results)}.gpkg'
+                        print(f"Saving intermediate results to {intermediate_path}")
+                        intermediate.to_file(intermediate_path, driver="GPKG")
+                        rec['rows_out'] = len(intermediate)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    # Fail (after every batch ran) if any hexagon could not be apportioned
+    ledger.conservation_report()
+
+    if not all_results:
+        print("ERROR: No results generated from any batch!")
+        return None
+
+    final_result = pd.concat(all_results, ignore_index=True)
+    instr.diagnostic("Final Combined Results", final_result)
+    return final_result
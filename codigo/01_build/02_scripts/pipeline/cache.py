@@ -0,0 +1,230 @@
+"""
+Content-addressed cache for expensive spatial stages.
+
+A cache entry is keyed by the stage name, a fingerprint of every input file,
+the CRS the stage ran in and its parameters. Changing any of those produces a
+new key, so stale intersections are never reused. Results are stored as
+GeoParquet and evicted least-recently-used first once the cache exceeds its
+size or entry budget.
+"""
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+
+import geopandas as gpd
+import pandas as pd
+
+INDEX_FILE = 'index.json'
+HASH_BLOCK_SIZE = 8 * 1024**2
+DEFAULT_MAX_BYTES = 20 * 1024**3  # 20 GB
+
+
+def _normalize_crs(crs):
+    """Return a stable string for any CRS-like input (pyproj.CRS, 'EPSG:4326', None)."""
+    if crs is None:
+        return None
+    if hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
+    from pyproj import CRS
+    return CRS.from_user_input(crs).to_wkt()
+
+
+class SpatialCache:
+    """
+    LRU cache of GeoDataFrame results stored as GeoParquet files.
+
+    Args:
+        cache_dir (Path or str): Directory holding the parquet files and index
+        max_bytes (int): Total size budget; oldest entries are evicted beyond it
+        max_entries (int): Optional cap on the number of entries
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._index_path = self.cache_dir / INDEX_FILE
+        self._index = self._load_index()
+
+    def _load_index(self):
+        if self._index_path.exists():
+            try:
+                with open(self._index_path) as f:
+                    index = json.load(f)
+                index.setdefault('entries', {})
+                index.setdefault('fingerprints', {})
+                return index
+            except (json.JSONDecodeError, OSError):
+                print(f"WARNING: Cache index {self._index_path} is unreadable, starting fresh")
+        return {'entries': {}, 'fingerprints': {}}
+
+    def _save_index(self):
+        tmp_path = self._index_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._index_path)
+
+    def fingerprint(self, path):
+        """
+        Hash the full contents of a file (or every file under a directory).
+
+        Digests are memoised by (size, mtime) so a multi-GB GeoPackage is only
+        read once per version.
+        """
+        path = Path(path).resolve()
+        if path.is_dir():
+            parts = [
+                f"{p.relative_to(path)}:{self.fingerprint(p)}"
+                for p in sorted(path.rglob('*')) if p.is_file()
+            ]
+            return hashlib.blake2b('\n'.join(parts).encode(), digest_size=16).hexdigest()
+
+        stat = path.stat()
+        known = self._index['fingerprints'].get(str(path))
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['digest']
+
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+
+        self._index['fingerprints'][str(path)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'digest': digest,
+        }
+        self._save_index()
+        return digest
+
+    def make_key(self, stage, inputs=(), crs=None, params=None):
+        """
+        Build the cache key for a stage.
+
+        Args:
+            stage (str): Name of the stage (e.g. 'roads_dpto_intersect')
+            inputs (iterable): Input file paths; shapefile sidecars are picked up automatically
+            crs: CRS the stage runs in
+            params (dict): Any other parameter that changes the result
+
+        Returns:
+            str: '<stage>-<digest>' key identifying the result
+        """
+        input_prints = []
+        for input_path in inputs:
+            input_path = Path(input_path)
+            files = [input_path]
+            if input_path.suffix.lower() == '.shp':
+                files = sorted(input_path.parent.glob(f"{input_path.stem}.*"))
+            input_prints.append([self.fingerprint(p) for p in files])
+
+        payload = json.dumps(
+            {
+                'stage': stage,
+                'inputs': input_prints,
+                'crs': _normalize_crs(crs),
+                'params': params or {},
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return f"{stage}-{hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()}"
+
+    def get(self, key):
+        """Return the cached frame for ``key`` or None on a miss."""
+        entry = self._index['entries'].get(key)
+        if entry is None:
+            return None
+
+        path = self.cache_dir / entry['file']
+        if not path.exists():
+            del self._index['entries'][key]
+            self._save_index()
+            return None
+
+        if entry['geo']:
+            result = gpd.read_parquet(path)
+        else:
+            result = pd.read_parquet(path)
+
+        entry['last_access'] = time.time()
+        self._save_index()
+        return result
+
+    def put(self, key, frame, stage=None):
+        """Store ``frame`` under ``key`` and evict old entries if over budget."""
+        file_name = f"{key}.parquet"
+        path = self.cache_dir / file_name
+        tmp_path = self.cache_dir / f"{file_name}.tmp"
+
+        is_geo = isinstance(frame, gpd.GeoDataFrame)
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+        now = time.time()
+        self._index['entries'][key] = {
+            'file': file_name,
+            'stage': stage or key,
+            'geo': is_geo,
+            'bytes': path.stat().st_size,
+            'created': now,
+            'last_access': now,
+        }
+        self.evict()
+        self._save_index()
+
+    def cached(self, stage, compute, inputs=(), crs=None, params=None):
+        """
+        Return the cached result of a stage, computing and storing it on a miss.
+
+        Args:
+            stage (str): Name of the stage
+            compute (callable): Zero-argument function producing the result
+            inputs, crs, params: See ``make_key``
+
+        Returns:
+            GeoDataFrame or DataFrame
+        """
+        key = self.make_key(stage, inputs=inputs, crs=crs, params=params)
+        result = self.get(key)
+        if result is not None:
+            print(f"Cache hit for {stage} ({key})")
+            return result
+
+        print(f"Cache miss for {stage}, computing...")
+        result = compute()
+        if result is not None:
+            self.put(key, result, stage=stage)
+        return result
+
+    def total_bytes(self):
+        return sum(entry['bytes'] for entry in self._index['entries'].values())
+
+    def evict(self):
+        """Drop least-recently-used entries until size and count budgets hold."""
+        entries = self._index['entries']
+        by_age = sorted(entries, key=lambda k: entries[k]['last_access'])
+
+        total = self.total_bytes()
+        while by_age and (
+            total > self.max_bytes
+            or (self.max_entries is not None and len(entries) > self.max_entries)
+        ):
+            key = by_age.pop(0)
+            entry = entries.pop(key)
+            total -= entry['bytes']
+            (self.cache_dir / entry['file']).unlink(missing_ok=True)
+            print(f"Evicted cache entry {key} ({entry['bytes'] / 1024**2:.1f} MB)")
+
+    def clear(self, stage=None):
+        """Remove every entry, or only those of one stage."""
+        for key in list(self._index['entries']):
+            entry = self._index['entries'][key]
+            if stage is None or entry['stage'] == stage:
+                (self.cache_dir / entry['file']).unlink(missing_ok=True)
+                del self._index['entries'][key]
+        self._save_index()
@@ -0,0 +1,108 @@
+"""
+Download GADM 4.1 country GeoPackages and assemble regional admin layers.
+
+Generalizes the gadm-geopackage-processor-* scripts: countries are fetched in
+parallel threads with retries, and each requested level is written as its own
+``ADM_ADM_<level>`` layer, so the output reads like a GADM country file
+(``load_admin_hierarchy`` works on both).
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import multiprocessing
+import os
+import time
+
+import geopandas as gpd
+import pandas as pd
+from tqdm import tqdm
+
+from pipeline.admin_hierarchy import GADM_LAYER_TEMPLATE
+
+GADM_URL = "https://geodata.ucdavis.edu/gadm/gadm4.1/gpkg/gadm41_{country}.gpkg"
+MAX_RETRIES = 3
+
+
+def download_file(url, filename):
+    """Download a file with retry logic"""
+    import requests
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            with requests.get(url, stream=True) as r:
+                r.raise_for_status()
+                with open(filename, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=8192):
+                        f.write(chunk)
+            return True
+        except requests.exceptions.RequestException as e:
+            if attempt == MAX_RETRIES - 1:
+                print(f"Failed to download {filename} after {MAX_RETRIES} attempts: {str(e)}")
+                return False
+            time.sleep(2 ** attempt)  # Exponential backoff
+    return False
+
+
+def gadm_country_path(country, download_dir):
+    """Path of a country's GADM GeoPackage, downloading it if missing (None on failure)."""
+    path = Path(download_dir) / f"gadm41_{country}.gpkg"
+    if not path.exists() and not download_file(GADM_URL.format(country=country), path):
+        path.unlink(missing_ok=True)
+        return None
+    return path
+
+
+def assemble_admin(countries, levels, output_file, download_dir, area_crs, max_workers=None,
+                   overwrite=False):
+    """
+    Combine the GADM layers of several countries into one GeoPackage.
+
+    Args:
+        countries (list): ISO 3166-1 alpha-3 codes
+        levels (iterable): Admin levels to assemble (one layer each)
+        output_file (Path): GeoPackage to write
+        download_dir (Path): Where the per-country GADM files are cached
+        area_crs (str): Equal-area CRS for the output geometries and ``area_km2``
+        max_workers (int): Download threads
+        overwrite (bool): Replace ``output_file`` if it exists
+
+    Returns:
+        list: Countries that could not be downloaded
+
+    Raises:
+        FileExistsError: If ``output_file`` exists and ``overwrite`` is False
+    """
+    output_file = Path(output_file)
+    if output_file.exists() and not overwrite:
+        raise FileExistsError(f"{output_file} exists; pass overwrite=True (--overwrite) to replace it")
+    max_workers = max_workers or min(32, multiprocessing.cpu_count() * 2)
+    Path(download_dir).mkdir(parents=True, exist_ok=True)
+
+    paths, failed = {}, []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(gadm_country_path, c, download_dir): c for c in countries}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading GADM"):
+            country = futures[future]
+            path = future.result()
+            if path is None:
+                failed.append(country)
+            else:
+                paths[country] = path
+
+    if not paths:
+        raise ValueError("No country data was successfully downloaded")
+    if failed:
+        print(f"\nFailed to download the following countries: {', '.join(sorted(failed))}")
+
+    # Written next to the output and moved into place once every layer is in
+    tmp_file = output_file.with_name(f"{output_file.stem}.tmp{output_file.suffix}")
+    tmp_file.unlink(missing_ok=True)
+    for level in sorted(set(levels)):
+        layer = GADM_LAYER_TEMPLATE.format(level=level)
+        frames = [gpd.read_file(paths[c], layer=layer) for c in countries if c in paths]
+        admin = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=frames[0].crs)
+        admin = admin.to_crs(area_crs)
+        admin['area_km2'] = admin.geometry.area / 1e6
+        admin.to_file(tmp_file, layer=layer, driver="GPKG")
+        print(f"Wrote {layer}: {len(admin):,} units from {len(frames)} countries")
+    os.replace(tmp_file, output_file)
+    return failed
@@ -0,0 +1,56 @@
+"""
+GeoPackage metadata without GDAL.
+
+A GeoPackage is a SQLite database, so layer names, feature counts, columns
+and the CRS can be read with ``sqlite3`` in milliseconds, without importing
+pyogrio (which pulls in geopandas and pandas). Feature counts come from the
+``gpkg_ogr_contents`` table GDAL maintains, falling back to ``COUNT(*)``.
+"""
+from pathlib import Path
+import sqlite3
+
+
+def gpkg_layers(path):
+    """
+    Describe the feature layers of a GeoPackage.
+
+    Args:
+        path (Path): GeoPackage file
+
+    Returns:
+        list: One dict per layer with ``name``, ``features``, ``geometry_column``,
+        ``geometry_type``, ``crs`` (e.g. 'EPSG:3857') and ``columns`` (name -> SQL type)
+    """
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(path)
+
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as con:
+        tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        counts = {}
+        if 'gpkg_ogr_contents' in tables:
+            counts = dict(con.execute("SELECT table_name, feature_count FROM gpkg_ogr_contents"))
+
+        layers = []
+        rows = con.execute(
+            "SELECT c.table_name, g.column_name, g.geometry_type_name, s.organization, "
+            "s.organization_coordsys_id "
+            "FROM gpkg_contents c "
+            "LEFT JOIN gpkg_geometry_columns g ON g.table_name = c.table_name "
+            "LEFT JOIN gpkg_spatial_ref_sys s ON s.srs_id = c.srs_id "
+            "WHERE c.data_type = 'features'"
+        ).fetchall()
+        for name, geom_col, geom_type, organization, code in rows:
+            features = counts.get(name)
+            if features is None:
+                features = con.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+            columns = {col[1]: col[2] for col in con.execute(f'PRAGMA table_info("{name}")')}
+            layers.append({
+                'name': name,
+                'features': features,
+                'geometry_column': geom_col,
+                'geometry_type': geom_type,
+                'crs': f"{organization.upper()}:{code}" if organization else None,
+                'columns': columns,
+            })
+    return layers
@@ -0,0 +1,175 @@
+"""
+Multi-resolution H3 pyramid of population and road length.
+
+Kontur hexagons are H3 cells at resolution 8. Coarser views (country maps,
+density histograms) used to re-aggregate the full table each time.
+``build_pyramid`` sums population and road km from the native resolution up
+to every coarser level once, computing parent ids on the uint64 cell ids with
+bit operations (no per-cell H3 call), and ``write_pyramid`` stores the levels
+as Parquet partitioned by ``resolution``. A coarse query then reads one small
+partition:
+
+    read_pyramid(path, resolution=5)   # thousands of rows, not millions
+
+H3 layout used here: bits 52-55 hold the resolution and the 3-bit digits of
+resolutions 1-15 follow from bit 44 down; digits finer than the cell's
+resolution are all 7.
+"""
+from pathlib import Path
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from pipeline.hextable import h3_to_uint64, uint64_to_h3
+
+RESOLUTION_SHIFT = np.uint64(52)
+RESOLUTION_MASK = np.uint64(0xF) << RESOLUTION_SHIFT
+MAX_RESOLUTION = 15
+
+
+def cell_resolution(ids):
+    """Resolution of each uint64 cell id."""
+    return ((np.asarray(ids, dtype=np.uint64) & RESOLUTION_MASK) >> RESOLUTION_SHIFT).astype(np.int64)
+
+
+def cell_to_parent(ids, resolution):
+    """
+    Parent of every cell at ``resolution`` (vectorized ``h3.cell_to_parent``).
+
+    Args:
+        ids (array): uint64 cell ids at ``resolution`` or finer
+        resolution (int): Parent resolution
+
+    Returns:
+        array: uint64 parent ids
+    """
+    ids = np.asarray(ids, dtype=np.uint64)
+    unused_digits = np.uint64((1 << (3 * (MAX_RESOLUTION - resolution))) - 1)
+    return (ids & ~RESOLUTION_MASK) | (np.uint64(resolution) << RESOLUTION_SHIFT) | unused_digits
+
+
+def cell_areas_km2(ids):
+    """Exact area of each cell in km² (one ``h3.cell_area`` call per cell)."""
+    from h3.api import basic_int as h3
+
+    return np.fromiter((h3.cell_area(int(cell), unit='km^2') for cell in ids), dtype=np.float64,
+                       count=len(ids))
+
+
+def build_pyramid(h3, population, road_km=None, min_resolution=0, areas=True):
+    """
+    Sum population (and road km) per cell at the native and every coarser resolution.
+
+    Args:
+        h3 (array): uint64 cell ids, all at the same resolution
+        population (array): Population per cell
+        road_km (array): Road length per cell (optional)
+        min_resolution (int): Coarsest level to build
+        areas (bool): Add ``area_km2`` and densities (needs the h3 package)
+
+    Returns:
+        dict: resolution -> DataFrame with uint64 ``h3``, ``population``,
+        ``road_km``, ``cells`` (native cells below it) and, with ``areas``,
+        ``area_km2``, ``pop_density`` and ``road_density``
+    """
+    h3 = np.asarray(h3, dtype=np.uint64)
+    resolutions = np.unique(cell_resolution(h3))
+    if len(resolutions) > 1:
+        raise ValueError(f"Cells mix resolutions {resolutions.tolist()}; pass a single resolution")
+    native = int(resolutions[0]) if len(resolutions) else min_resolution
+
+    level = pd.DataFrame({
+        'h3': h3,
+        'population': np.asarray(population, dtype=np.float64),
+        'road_km': np.zeros(len(h3)) if road_km is None else np.asarray(road_km, dtype=np.float64),
+        'cells': np.ones(len(h3), dtype=np.int64),
+    }).groupby('h3', as_index=False, sort=False).sum()
+
+    pyramid = {native: level}
+    for resolution in range(native - 1, min_resolution - 1, -1):
+        # Each level is summed from the one below it, a few times smaller each step
+        parents, inverse = np.unique(cell_to_parent(level['h3'].to_numpy(), resolution),
+                                     return_inverse=True)
+        level = pd.DataFrame({'h3': parents, **{
+            col: np.bincount(inverse, weights=level[col].to_numpy(), minlength=len(parents))
+            for col in ('population', 'road_km', 'cells')
+        }})
+        level['cells'] = level['cells'].astype(np.int64)
+        pyramid[resolution] = level
+
+    for resolution, level in pyramid.items():
+        if areas:
+            level['area_km2'] = cell_areas_km2(level['h3'].to_numpy())
+            level['pop_density'] = level['population'] / level['area_km2']
+            level['road_density'] = level['road_km'] / level['area_km2']
+        print(f"Resolution {resolution:>2}: {len(level):>10,} cells, "
+              f"population {level['population'].sum():,.0f}")
+    return dict(sorted(pyramid.items()))
+
+
+def write_pyramid(pyramid, path):
+    """
+    Write the pyramid as Parquet partitioned by resolution.
+
+    ``h3`` is written as the hex string Kontur and the R scripts use, so the
+    files join directly with the other hexagon tables.
+
+    Args:
+        pyramid (dict): ``build_pyramid`` output
+        path (Path): Dataset directory (replaced)
+
+    Returns:
+        Path: The dataset directory (``resolution=<r>/part-0.parquet``)
+    """
+    path = Path(path)
+    shutil.rmtree(path, ignore_errors=True)
+    for resolution, level in pyramid.items():
+        partition = path / f"resolution={resolution}"
+        partition.mkdir(parents=True)
+        level.assign(h3=uint64_to_h3(level['h3'].to_numpy())).to_parquet(
+            partition / 'part-0.parquet', index=False
+        )
+    print(f"H3 pyramid ({min(pyramid)}-{max(pyramid)}) saved to: {path}")
+    return path
+
+
+def read_pyramid(path, resolution, columns=None):
+    """Read one resolution of a pyramid written by ``write_pyramid``."""
+    return pd.read_parquet(Path(path) / f"resolution={resolution}", columns=columns)
+
+
+def road_km_lookup(hex_roads, h3_col='h3', road_col='total_road_length_km'):
+    """
+    Road km per cell from a per-hexagon road table, indexed by uint64 cell id.
+
+    The table written by ``03_calculate_road_density_hex.R`` repeats each
+    hexagon's total on every road piece, so one row per cell is kept.
+
+    Args:
+        hex_roads (Path or DataFrame): Parquet file or frame with ``h3_col`` and ``road_col``
+
+    Returns:
+        Series: Road km by cell id
+    """
+    if not isinstance(hex_roads, pd.DataFrame):
+        hex_roads = pd.read_parquet(hex_roads, columns=[h3_col, road_col])
+    totals = hex_roads.drop_duplicates(h3_col)
+    return pd.Series(totals[road_col].to_numpy(dtype=np.float64),
+                     index=h3_to_uint64(totals[h3_col].to_numpy()))
+
+
+def road_km_per_cell(hex_roads, h3, h3_col='h3', road_col='total_road_length_km'):
+    """
+    Road km per cell, aligned with ``h3``, from a per-hexagon road table.
+
+    Args:
+        hex_roads (Path, DataFrame or Series): As ``road_km_lookup``, or its result
+        h3 (array): uint64 cell ids to align to
+
+    Returns:
+        array: Road km per cell (0 where the table has none)
+    """
+    if not isinstance(hex_roads, pd.Series):
+        hex_roads = road_km_lookup(hex_roads, h3_col, road_col)
+    return hex_roads.reindex(np.asarray(h3, dtype=np.uint64)).fillna(0.0).to_numpy()
@@ -0,0 +1,327 @@
+"""
+Typed columnar panels for the R analysis scripts.
+
+The R scripts re-read GeoPackages, GeoJSON and shapefiles with
+``sf::read_sf`` on every run, which parses every geometry again and turns
+codes into whatever type the driver guesses. ``publish_panels`` writes what
+they need once, as Arrow data with fixed types:
+
+- ``hexagons``: one row per Kontur hexagon with its department, population,
+  road km, area and densities
+- ``departments``: the hexagon sums per department (each hexagon counted
+  whole in the department of its centroid), with its polygon. The
+  population is therefore ``population_centroid``; the area-weighted
+  ``adjusted_population`` of the density results splits boundary hexagons
+  between departments instead
+
+Both are GeoParquet (or Feather, ``fmt='feather'``, uncompressed so R can
+memory-map it); geometries are WKB tagged as ``geoarrow.wkb`` with their CRS.
+Each publication goes to its own directory, ``v<SCHEMA_VERSION>_<release>``,
+next to a ``manifest.json`` listing every table's file, row count, CRS and
+column types, units and descriptions. ``latest.json`` one level up names the
+newest publication. In R:
+
+    manifest <- jsonlite::read_json(file.path(handoff_dir, "latest.json"))
+    hexagons <- arrow::open_dataset(file.path(handoff_dir, manifest$path, "hexagons.parquet"))
+    departments <- sf::st_as_sf(arrow::read_parquet(...))  # geoarrow registers the WKB type
+
+The hexagon table is streamed batch by batch, so memory stays flat.
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+from pyproj import CRS, Transformer
+from tqdm import tqdm
+
+from pipeline.admin_layer import AdminLayer
+from pipeline.h3_pyramid import road_km_per_cell
+from pipeline.hextable import DEFAULT_READ_BATCH, h3_to_uint64
+from pipeline.point_assignment import point_zone_rows
+
+SCHEMA_VERSION = 2  # bump when a column is renamed, removed or changes type
+MANIFEST_FILE = 'manifest.json'
+LATEST_FILE = 'latest.json'
+FORMATS = {'parquet': '.parquet', 'feather': '.arrow'}
+GEOPARQUET_VERSION = '1.0.0'
+
+# name: (unit, description); every panel column is listed here
+COLUMNS = {
+    'h3': (None, "H3 cell id (hex string), resolution 8"),
+    'population': ('people', "Kontur population"),
+    'population_centroid': ('people', "Population of the hexagons whose centroid falls in the "
+                                      "department (not area-weighted like adjusted_population)"),
+    'road_km': ('km', "Road length"),
+    'area_km2': ('km2', "Area in the region's equal-area CRS"),
+    'pop_density': ('people/km2', "population / area_km2"),
+    'pop_density_centroid': ('people/km2', "population_centroid / area_km2"),
+    'road_density': ('km/km2', "road_km / area_km2"),
+    'hexagons': ('count', "Kontur hexagons whose centroid falls in the department"),
+    'geometry': (None, "WKB geometry"),
+}
+
+
+def geometry_field(name, crs):
+    """WKB field tagged as ``geoarrow.wkb`` with its CRS, for R's geoarrow."""
+    crs = CRS.from_user_input(crs).to_json_dict() if crs is not None else None
+    return pa.field(name, pa.binary(), metadata={
+        'ARROW:extension:name': 'geoarrow.wkb',
+        'ARROW:extension:metadata': json.dumps({'crs': crs}),
+    })
+
+
+def panel_schema(fields, crs, geometry_types=()):
+    """Arrow schema with GeoParquet ``geo`` metadata for the ``geometry`` field."""
+    fields = [geometry_field('geometry', crs) if field.name == 'geometry' else field
+              for field in fields]
+    geo = {
+        'version': GEOPARQUET_VERSION,
+        'primary_column': 'geometry',
+        'columns': {'geometry': {
+            'encoding': 'WKB',
+            'geometry_types': list(geometry_types),
+            'crs': CRS.from_user_input(crs).to_json_dict() if crs is not None else None,
+        }},
+    }
+    return pa.schema(fields, metadata={'geo': json.dumps(geo)})
+
+
+class PanelWriter:
+    """
+    Stream Arrow tables of one schema to a Parquet or Feather file.
+
+    Args:
+        path (Path): File to write (replaced)
+        schema (Schema): ``panel_schema`` output
+        fmt (str): 'parquet' (zstd) or 'feather' (uncompressed, memory-mappable)
+        crs: CRS of the geometry column, for the manifest
+    """
+
+    def __init__(self, path, schema, fmt='parquet', crs=None):
+        self.path = Path(path)
+        self.schema = schema
+        self.crs = crs
+        self.rows = 0
+        if fmt == 'parquet':
+            self._writer = pq.ParquetWriter(self.path, schema, compression='zstd')
+        else:
+            self._writer = pa.ipc.new_file(self.path, schema)
+
+    def write(self, table):
+        table = table.cast(self.schema)
+        if isinstance(self._writer, pq.ParquetWriter):
+            self._writer.write_table(table)
+        else:
+            for batch in table.to_batches():
+                self._writer.write_batch(batch)
+        self.rows += len(table)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def hexagon_panel(pop_path, path, zones, zone_id, area_crs, road_km=None, fmt='parquet',
+                  read_batch=DEFAULT_READ_BATCH, value_col='population', h3_col='h3'):
+    """
+    Stream the hexagon panel and sum it per zone.
+
+    Args:
+        pop_path (Path): Kontur population file
+        path (Path): Panel file to write
+        zones (GeoDataFrame): Departments (or other zones) with ``zone_id``
+        area_crs: Equal-area CRS for the areas and the centroid assignment
+        road_km (Series): ``road_km_lookup`` output (optional)
+
+    Returns:
+        tuple: (DataFrame with ``zone_id``, ``population``, ``road_km`` and
+        ``hexagons`` per zone, the closed ``PanelWriter``)
+    """
+    layer = AdminLayer(zones.to_crs(area_crs))
+    zone_ids = layer.admin[zone_id].to_numpy()
+    zone_labels = zone_ids.astype(str)
+    sums = {col: np.zeros(len(zone_ids) + 1) for col in ('population', 'road_km', 'hexagons')}
+    crs = pyogrio.read_info(pop_path)['crs']
+    transformer = Transformer.from_crs(crs, area_crs, always_xy=True)
+    schema = panel_schema([
+        pa.field('h3', pa.string()),
+        pa.field(zone_id, pa.string()),
+        pa.field('population', pa.float64()),
+        pa.field('road_km', pa.float64()),
+        pa.field('area_km2', pa.float64()),
+        pa.field('pop_density', pa.float64()),
+        pa.field('road_density', pa.float64()),
+        pa.field('geometry', pa.binary()),
+    ], crs, geometry_types=['Polygon'])
+
+    with PanelWriter(path, schema, fmt, crs) as writer, pyogrio.open_arrow(
+            pop_path, batch_size=read_batch, columns=[h3_col, value_col],
+            use_pyarrow=True) as (meta, reader):
+        geom_col = meta['geometry_name'] or 'wkb_geometry'
+        for batch in tqdm(reader, desc="Hexagon panel"):
+            wkb = batch.column(geom_col)
+            projected = shapely.transform(
+                shapely.from_wkb(wkb.to_numpy(zero_copy_only=False)),
+                lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+            rows = point_zone_rows(layer, shapely.centroid(projected))
+            h3 = batch.column(h3_col)
+            population = batch.column(value_col).to_numpy(zero_copy_only=False).astype('float64')
+            roads = (np.zeros(len(population)) if road_km is None
+                     else road_km_per_cell(road_km, h3_to_uint64(h3.to_numpy(zero_copy_only=False))))
+            area_km2 = shapely.area(projected) / 10**6
+
+            codes = rows + 1
+            for col, weights in (('population', population), ('road_km', roads),
+                                 ('hexagons', np.ones(len(codes)))):
+                sums[col] += np.bincount(codes, weights=weights, minlength=len(sums[col]))
+
+            writer.write(pa.table({
+                'h3': h3,
+                zone_id: pa.array(np.where(rows >= 0, zone_labels[np.maximum(rows, 0)], None),
+                                  type=pa.string()),
+                'population': population,
+                'road_km': roads,
+                'area_km2': area_km2,
+                'pop_density': population / area_km2,
+                'road_density': roads / area_km2,
+                'geometry': wkb,
+            }))
+
+    totals = pd.DataFrame({zone_id: zone_ids, **{col: values[1:] for col, values in sums.items()}})
+    totals = totals.groupby(zone_id, as_index=False).sum()
+    totals['hexagons'] = totals['hexagons'].astype('int64')
+    print(f"Hexagon panel: {writer.rows:,} rows; population outside every zone: "
+          f"{sums['population'][0]:,.0f}")
+    return totals, writer
+
+
+def department_panel(path, zones, zone_id, totals, area_crs, fmt='parquet', name_col=None):
+    """
+    Write the per-zone panel with each zone's polygon.
+
+    Hexagons are summed whole into the zone of their centroid, so the
+    population column is ``population_centroid``.
+
+    Args:
+        path (Path): Panel file to write
+        zones (GeoDataFrame): Zones with ``zone_id`` (and ``name_col``)
+        totals (DataFrame): ``hexagon_panel`` sums per zone
+        area_crs: Equal-area CRS for the zone areas
+
+    Returns:
+        PanelWriter: The closed writer
+    """
+    zones = zones.reset_index(drop=True)
+    frame = pd.DataFrame({zone_id: zones[zone_id].astype(str).to_numpy()})
+    if name_col:
+        frame[name_col] = zones[name_col].astype(str).to_numpy()
+    frame = frame.merge(totals.assign(**{zone_id: totals[zone_id].astype(str)}), on=zone_id,
+                        how='left')
+    frame = frame.rename(columns={'population': 'population_centroid'})
+    sums = ['population_centroid', 'road_km', 'hexagons']
+    frame[sums] = frame[sums].fillna(0)
+    frame['area_km2'] = zones.to_crs(area_crs).area.to_numpy() / 10**6
+    frame['pop_density_centroid'] = frame['population_centroid'] / frame['area_km2']
+    frame['road_density'] = frame['road_km'] / frame['area_km2']
+    frame['geometry'] = shapely.to_wkb(zones.geometry.to_numpy())
+
+    fields = [pa.field(zone_id, pa.string())] + ([pa.field(name_col, pa.string())] if name_col else [])
+    fields += [pa.field(col, pa.float64()) for col in ('population_centroid', 'road_km')]
+    fields += [pa.field('hexagons', pa.int64())]
+    fields += [pa.field(col, pa.float64())
+               for col in ('area_km2', 'pop_density_centroid', 'road_density')]
+    fields += [pa.field('geometry', pa.binary())]
+    types = sorted(set(zones.geometry.geom_type.dropna()))
+    schema = panel_schema(fields, zones.crs, geometry_types=types)
+
+    with PanelWriter(path, schema, fmt, zones.crs) as writer:
+        writer.write(pa.Table.from_pandas(frame[schema.names], preserve_index=False))
+    return writer
+
+
+def table_manifest(writer, keys):
+    """Manifest entry of one panel: file, rows, CRS and typed, documented columns."""
+    return {
+        'file': writer.path.name,
+        'rows': writer.rows,
+        'key': keys,
+        'crs': CRS.from_user_input(writer.crs).to_string() if writer.crs is not None else None,
+        'columns': [{
+            'name': field.name,
+            'type': 'wkb' if field.name == 'geometry' else str(field.type),
+            'unit': COLUMNS.get(field.name, (None, None))[0],
+            'description': COLUMNS.get(field.name, (None, "Zone identifier or name"))[1],
+        } for field in writer.schema],
+    }
+
+
+def write_manifest(handoff_dir, version_dir, manifest):
+    """Write the publication's manifest and point ``latest.json`` at it."""
+    for path, content in ((version_dir / MANIFEST_FILE, manifest),
+                          (handoff_dir / LATEST_FILE, {**manifest, 'path': version_dir.name})):
+        tmp_path = path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f, indent=1)
+        os.replace(tmp_path, path)
+
+
+def publish_panels(handoff_dir, region, pop_path, zones, zone_id, area_crs, hex_roads=None,
+                   fmt='parquet', name_col=None, read_batch=DEFAULT_READ_BATCH):
+    """
+    Publish the hexagon and department panels of a region with their manifest.
+
+    Args:
+        handoff_dir (Path): Region's handoff directory (publications go below it)
+        region (str): Region name, recorded in the manifest
+        pop_path (Path): Kontur population file; its stem names the release
+        zones (GeoDataFrame): Department polygons with ``zone_id``
+        hex_roads (Series): ``road_km_lookup`` output (optional)
+        fmt (str): 'parquet' or 'feather'
+
+    Returns:
+        Path: The publication directory
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}; choose one of {sorted(FORMATS)}")
+    handoff_dir = Path(handoff_dir)
+    pop_path = Path(pop_path)
+    version_dir = handoff_dir / f"v{SCHEMA_VERSION}_{pop_path.stem}"
+    version_dir.mkdir(parents=True, exist_ok=True)
+    suffix = FORMATS[fmt]
+
+    totals, hexagons = hexagon_panel(pop_path, version_dir / f"hexagons{suffix}", zones, zone_id,
+                                     area_crs, road_km=hex_roads, fmt=fmt, read_batch=read_batch)
+    departments = department_panel(version_dir / f"departments{suffix}", zones, zone_id, totals,
+                                   area_crs, fmt=fmt, name_col=name_col)
+
+    stat = pop_path.stat()
+    write_manifest(handoff_dir, version_dir, {
+        'schema_version': SCHEMA_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'region': region,
+        'release': pop_path.stem,
+        'format': fmt,
+        'area_crs': str(area_crs),
+        'inputs': {'population': {'file': pop_path.name, 'bytes': stat.st_size,
+                                  'modified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+                                  .isoformat(timespec='seconds')},
+                   'road_km': hex_roads is not None},
+        'tables': {
+            'hexagons': table_manifest(hexagons, ['h3']),
+            'departments': table_manifest(departments, [zone_id]),
+        },
+    })
+    print(f"Published {hexagons.rows:,} hexagons and {departments.rows:,} departments to: {version_dir}")
+    return version_dir
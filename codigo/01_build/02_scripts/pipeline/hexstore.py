@@ -0,0 +1,276 @@
+"""
+Memory-mapped hexagon batches shared by the worker pools.
+
+Sending every chunk as a pickled GeoDataFrame slice copied the batch twice in
+the parent (``iloc`` copies, then pickles) and once more per worker.
+``HexStore.write`` instead writes the batch once, in task order, as plain
+``.npy`` files:
+
+- one file per attribute column, plus the index (chunk keys hash it)
+- the geometry as shapely ragged arrays: a coordinate buffer and one offset
+  array per nesting level (rings, polygons, ...), or WKB offsets and a byte
+  buffer for types ragged arrays cannot hold
+
+Each chunk is then a ``HexRange``: the store path and ``(start, stop)``,
+a few dozen bytes pickled. Workers map the files read-only and decode only
+their rows; the page cache holds one copy of the batch for every process.
+
+Object columns must hold strings: they are stored fixed-width, with a
+``<array>_missing`` mask where a row is None/NaN so the missing values come
+back as None rather than the text 'None' or 'nan'.
+"""
+from pathlib import Path
+import json
+import shutil
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Where batch stores are written; a batch can be several GB, more than a
+# tmpfs /tmp may hold (build.py points it at <output-dir>/scratch)
+SCRATCH_DIR = Path(__file__).parent.parent.parent / '03_output' / 'scratch'
+
+_open_stores = {}  # per process: path -> HexStore (at most the current batch's)
+
+
+class HexStore:
+    """
+    A batch of hexagons in memory-mapped NumPy files.
+
+    Args:
+        directory (Path): A store written by ``HexStore.write``
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.meta = json.loads((self.directory / 'meta.json').read_text())
+        self.arrays = {
+            name: np.load(self.directory / f"{name}.npy", mmap_mode='r')
+            for name in self.meta['arrays']
+        }
+
+    @classmethod
+    def write(cls, gdf, order=None, directory=None):
+        """
+        Write ``gdf`` (rows in ``order`` if given) to a new store.
+
+        Columns are copied one at a time, so the parent never holds a second
+        copy of the whole batch.
+
+        Args:
+            gdf (GeoDataFrame): Hexagons
+            order (array): Row positions in the order chunks will read them
+            directory (Path): Target directory (default: a new temporary one)
+
+        Returns:
+            HexStore
+        """
+        if directory is None:
+            Path(SCRATCH_DIR).mkdir(parents=True, exist_ok=True)
+            directory = tempfile.mkdtemp(prefix='hexstore-', dir=SCRATCH_DIR)
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        take = (lambda values: values) if order is None else (lambda values: values[order])
+
+        geom_col = gdf.geometry.name
+        columns = [col for col in gdf.columns if col != geom_col]
+        arrays = []
+
+        def save(name, values, label=None):
+            values = np.asarray(values)
+            if values.dtype == object:
+                if pd.api.types.infer_dtype(values, skipna=True) not in ('string', 'empty'):
+                    raise TypeError(f"Column {label or name!r} holds non-string objects; "
+                                    f"HexStore stores numbers and strings only")
+                missing = pd.isna(values)
+                if missing.any():
+                    save(f"{name}_missing", missing)
+                # Fixed-width, so it can be mapped
+                values = np.where(missing, '', values).astype(str)
+            np.save(directory / f"{name}.npy", values)
+            arrays.append(name)
+
+        for i, col in enumerate(columns):
+            save(f"col{i}", take(gdf[col].to_numpy()), label=col)
+        save('index', take(gdf.index.to_numpy()), label='index')
+
+        geoms = take(gdf.geometry.to_numpy())
+        try:
+            geom_type, coords, offsets = shapely.to_ragged_array(geoms)
+            save('coords', coords)
+            for level, level_offsets in enumerate(offsets):
+                save(f"offsets{level}", level_offsets)
+            geometry = {'encoding': 'ragged', 'type': int(geom_type), 'levels': len(offsets)}
+        except (ValueError, TypeError):
+            # Collections, mixed types or missing geometries
+            wkb = shapely.to_wkb(geoms)
+            lengths = np.array([0 if blob is None else len(blob) for blob in wkb], dtype=np.int64)
+            save('wkb_offsets', np.concatenate([[0], np.cumsum(lengths)]))
+            save('wkb', np.frombuffer(b''.join(blob for blob in wkb if blob is not None), dtype=np.uint8))
+            geometry = {'encoding': 'wkb'}
+
+        meta = {
+            'rows': len(gdf),
+            'columns': columns,
+            'geometry_name': geom_col,
+            'geometry': geometry,
+            'crs': gdf.crs.to_wkt() if gdf.crs is not None else None,
+            'arrays': arrays,
+        }
+        (directory / 'meta.json').write_text(json.dumps(meta))
+        return cls(directory)
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def range(self, start, stop):
+        return HexRange(str(self.directory), int(start), int(stop))
+
+    def _values(self, name, start, stop):
+        values = self.arrays[name][start:stop]
+        missing = self.arrays.get(f"{name}_missing")
+        if missing is None:
+            return values
+        return np.where(missing[start:stop], None, values.astype(object))
+
+    def column(self, col, start, stop):
+        """Rows ``[start, stop)`` of an attribute column (read-only view, or a copy with missing strings)."""
+        return self._values(f"col{self.meta['columns'].index(col)}", start, stop)
+
+    def geometries(self, start, stop):
+        geometry = self.meta['geometry']
+        if geometry['encoding'] == 'wkb':
+            offsets = self.arrays['wkb_offsets'][start:stop + 1]
+            buffer = self.arrays['wkb']
+            return np.array([
+                None if lo == hi else shapely.from_wkb(buffer[lo:hi].tobytes())
+                for lo, hi in zip(offsets[:-1], offsets[1:])
+            ], dtype=object)
+
+        # Walk the offsets from geometries down to coordinates, rebasing each level
+        offsets = [self.arrays[f"offsets{level}"] for level in range(geometry['levels'])]
+        lo, hi = start, stop
+        sliced = []
+        for level_offsets in reversed(offsets):
+            part = np.asarray(level_offsets[lo:hi + 1])
+            sliced.append(part - part[0])
+            lo, hi = int(part[0]), int(part[-1])
+        coords = np.asarray(self.arrays['coords'][lo:hi])
+        return shapely.from_ragged_array(shapely.GeometryType(geometry['type']), coords,
+                                         tuple(reversed(sliced)) or None)
+
+    def nbytes(self, start, stop):
+        """Bytes of the mapped files that ``read(start, stop)`` touches."""
+        rows = stop - start
+        geometry = self.meta['geometry']
+        row_arrays = [name for name in self.arrays
+                      if name.startswith('col') or name.startswith('index')]
+        total = sum(self.arrays[name].itemsize * rows for name in row_arrays)
+        if geometry['encoding'] == 'wkb':
+            offsets = self.arrays['wkb_offsets']
+            return total + offsets.itemsize * (rows + 1) + int(offsets[stop] - offsets[start])
+        lo, hi = start, stop
+        for level in reversed(range(geometry['levels'])):
+            level_offsets = self.arrays[f"offsets{level}"]
+            total += level_offsets.itemsize * (hi - lo + 1)
+            lo, hi = int(level_offsets[lo]), int(level_offsets[hi])
+        coords = self.arrays['coords']
+        return total + coords.itemsize * coords.shape[1] * (hi - lo)
+
+    def read(self, start, stop):
+        """Rows ``[start, stop)`` as a GeoDataFrame with the original index."""
+        data = {col: self.column(col, start, stop) for col in self.meta['columns']}
+        data[self.meta['geometry_name']] = self.geometries(start, stop)
+        return gpd.GeoDataFrame(data, index=pd.Index(self._values('index', start, stop)),
+                                geometry=self.meta['geometry_name'], crs=self.meta['crs'])
+
+    def close(self):
+        """Drop the memory maps (views still in use keep theirs until released)."""
+        self.arrays = {}
+
+    def remove(self):
+        """Delete the store's files (open maps stay valid until released)."""
+        store = _open_stores.pop(str(self.directory), None)
+        if store is not None:
+            store.close()
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def open_store(path):
+    """
+    The process's cached ``HexStore`` for ``path`` (opened on first use).
+
+    Pool workers outlive batches, and the parent deletes each batch's store
+    when it is done; a mapped file keeps its disk space and counts towards
+    the worker's RSS until unmapped. Opening a new store therefore closes
+    the ones opened before, so a worker maps only the current batch.
+    """
+    store = _open_stores.get(path)
+    if store is None:
+        for old in _open_stores.values():
+            old.close()
+        _open_stores.clear()
+        store = _open_stores[path] = HexStore(path)
+    return store
+
+
+class HexRange:
+    """
+    Rows ``[start, stop)`` of a ``HexStore``; pickles to the path and bounds.
+
+    Supports what the ledger needs without decoding geometries: ``len``,
+    column access (``rng['population'].sum()``) and ``index``.
+    """
+
+    __slots__ = ('path', 'start', 'stop')
+
+    def __init__(self, path, start, stop):
+        self.path = path
+        self.start = start
+        self.stop = stop
+
+    def __getstate__(self):
+        return (self.path, self.start, self.stop)
+
+    def __setstate__(self, state):
+        self.path, self.start, self.stop = state
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, col):
+        return open_store(self.path).column(col, self.start, self.stop)
+
+    @property
+    def index(self):
+        return open_store(self.path)._values('index', self.start, self.stop)
+
+    def load(self):
+        return open_store(self.path).read(self.start, self.stop)
+
+    @property
+    def nbytes(self):
+        """Bytes ``load`` reads from the mapped store."""
+        return open_store(self.path).nbytes(self.start, self.stop)
+
+    def split(self):
+        """Two halves of the range."""
+        middle = self.start + len(self) // 2
+        return [HexRange(self.path, self.start, middle), HexRange(self.path, middle, self.stop)]
+
+
+def load_hexes(hexes):
+    """A GeoDataFrame for ``hexes``, decoding it if it is a ``HexRange``."""
+    return hexes.load() if isinstance(hexes, HexRange) else hexes
+
+
+def split_hexes(hexes):
+    """Two halves of a ``HexRange`` or GeoDataFrame."""
+    if isinstance(hexes, HexRange):
+        return hexes.split()
+    half = len(hexes) // 2
+    return [hexes.iloc[:half], hexes.iloc[half:]]
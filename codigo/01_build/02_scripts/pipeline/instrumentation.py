@@ -0,0 +1,299 @@
+"""
+Structured stage timing and memory instrumentation for the build scripts.
+
+Replaces the ``print_diagnostic`` helpers. Every stage is timed with a
+context manager that also samples RSS and peak RSS and records rows in/out;
+worker chunks are timed inside the worker and reported back with their pid.
+Events are written either as JSON lines (one object per event, appended as
+they happen) or as a Chrome trace (``.json``, open in chrome://tracing or
+Perfetto) with one track per worker process.
+
+Levels:
+    off       nothing is recorded or printed
+    basic     stage timings, RSS, row counts (cheap; meant for production)
+    detailed  + vectorized population statistics in ``diagnostic``
+    debug     + deep ``memory_usage`` and ``head(2)`` samples (expensive)
+"""
+from contextlib import contextmanager
+from pathlib import Path
+import atexit
+import json
+import os
+import sys
+import time
+
+LEVELS = {'off': 0, 'basic': 1, 'detailed': 2, 'debug': 3}
+MB = 1024**2
+
+_worker_base_rss = None  # RSS of this pool worker right after start-up (see start_worker)
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset this process's high-water mark (Linux); False if unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def high_water_rss():
+    """Peak RSS since the last ``reset_peak_rss`` (VmHWM), or None."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def task_peak_rss(tracked):
+    """Peak RSS since ``reset_peak_rss`` when it succeeded (``tracked``), else the lifetime peak."""
+    return (tracked and high_water_rss()) or peak_rss()
+
+
+def start_worker(initializer=None, initargs=()):
+    """
+    Pool initializer: note the worker's RSS, then run ``initializer``.
+
+    The RSS after start-up (interpreter and preloaded modules, shared with
+    the fork server or parent) is reported with every task as
+    ``base_rss_mb``, so memory accounting counts only what the worker adds.
+    """
+    global _worker_base_rss
+    _worker_base_rss = current_rss()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def worker_base_rss_mb():
+    """``start_worker``'s RSS in MB, or None outside such a worker."""
+    return None if _worker_base_rss is None else _worker_base_rss / MB
+
+
+def timed_call(task):
+    """
+    Run ``func(arg)`` in a worker and return its result with timing metadata.
+
+    ``task`` is a ``(func, arg)`` or ``(func, arg, tag)`` tuple so it can be
+    sent through ``Pool.imap_unordered``; ``tag`` comes back unchanged to tell
+    which chunk finished. ``func`` must be a module-level function.
+
+    An exception in ``func`` does not kill the pool iteration: the result is
+    None and ``error`` holds the exception text, so the parent decides
+    whether to retry or fail.
+
+    ``peak_rss_mb`` is the worker's peak during this task where the
+    high-water mark can be reset (Linux), so a long-lived pool worker does
+    not carry an earlier task's peak forward.
+    """
+    func, arg, *tag = task
+    tracked = reset_peak_rss()
+    start = time.time()
+    t0 = time.perf_counter()
+    result, error = call_isolated(func, arg)
+    return {
+        'tag': tag[0] if tag else None,
+        'pid': os.getpid(),
+        'start': start,
+        'seconds': time.perf_counter() - t0,
+        'peak_rss_mb': task_peak_rss(tracked) / MB,
+        'base_rss_mb': worker_base_rss_mb(),
+        'result': result,
+        'error': error,
+    }
+
+
+def call_isolated(func, arg):
+    """Return ``(func(arg), None)``, or ``(None, '<Exception>: message')`` if it raises."""
+    try:
+        return func(arg), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+class Instrumentation:
+    """
+    Recorder for stage, chunk and diagnostic events.
+
+    Args:
+        path (Path or str): Output file; '.json' writes a Chrome trace,
+            anything else JSON lines. None only prints.
+        level (str or int): One of LEVELS
+        echo (callable): Used for the human-readable one-line summaries
+            (``print`` by default, ``logging.info`` in logging scripts)
+    """
+
+    def __init__(self, path=None, level='basic', echo=print):
+        self.level = LEVELS[level] if isinstance(level, str) else level
+        self.path = Path(path) if path else None
+        self.chrome = self.path is not None and self.path.suffix == '.json'
+        self.echo = echo
+        self._events = []
+        self._stack = []
+        if self.path is not None and self.level > 0:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.chrome:
+                atexit.register(self.close)
+
+    def enabled(self, level='basic'):
+        return self.level >= (LEVELS[level] if isinstance(level, str) else level)
+
+    def _emit(self, kind, record, start, seconds, tid=None):
+        record = {'event': kind, 'ts': start, 'seconds': seconds, **record}
+        if self.path is None:
+            return
+        if self.chrome:
+            self._events.append({
+                'name': record.get('stage') or record.get('phase') or kind,
+                'cat': kind,
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': seconds * 1e6,
+                'pid': os.getpid(),
+                'tid': tid or os.getpid(),
+                'args': {k: v for k, v in record.items() if k not in ('ts', 'seconds')},
+            })
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    @contextmanager
+    def stage(self, name, rows_in=None, **attrs):
+        """
+        Time a stage. Set ``rows_out`` (or anything else) on the yielded dict.
+
+        Example:
+            with instr.stage('sjoin', rows_in=len(batch)) as rec:
+                joined = gpd.sjoin(batch, admin)
+                rec['rows_out'] = len(joined)
+        """
+        record = {'stage': name, 'rows_in': rows_in, **attrs}
+        if not self.enabled('basic'):
+            yield record
+            return
+
+        if self._stack:
+            record['parent'] = self._stack[-1]
+        self._stack.append(name)
+        rss_before = current_rss()
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - t0
+            self._stack.pop()
+            rss = current_rss()
+            record.update({
+                'rss_mb': round(rss / MB, 1),
+                'rss_delta_mb': round((rss - rss_before) / MB, 1),
+                'peak_rss_mb': round(peak_rss() / MB, 1),
+            })
+            self._emit('stage', record, start, seconds)
+            rows = f", {record['rows_in']:,} -> {record['rows_out']:,} rows" if (
+                record.get('rows_in') is not None and record.get('rows_out') is not None
+            ) else ''
+            self.echo(f"[{name}] {seconds:.2f}s{rows}, RSS {record['rss_mb']:,.0f} MB "
+                      f"(peak {record['peak_rss_mb']:,.0f} MB)")
+
+    def chunk(self, name, timing, rows_in=None, rows_out=None, **attrs):
+        """Record a worker chunk from the metadata returned by ``timed_call``."""
+        if not self.enabled('basic'):
+            return
+        record = {
+            'stage': name,
+            'worker_pid': timing['pid'],
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'worker_peak_rss_mb': round(timing['peak_rss_mb'], 1),
+            **attrs,
+        }
+        if self._stack:
+            record['parent'] = self._stack[-1]
+        self._emit('chunk', record, timing['start'], timing['seconds'], tid=timing['pid'])
+
+    def diagnostic(self, phase, gdf, group_col='GID_1', pop_col='population'):
+        """
+        Level-gated replacement for ``print_diagnostic``.
+
+        ``basic`` only records the row count; ``detailed`` adds population
+        statistics computed as vectorized reductions; ``debug`` adds the deep
+        memory usage and a two-row sample.
+        """
+        if not self.enabled('basic'):
+            return
+        record = {'phase': phase, 'rows': len(gdf)}
+
+        if self.enabled('detailed'):
+            if pop_col in gdf.columns:
+                pop = gdf[pop_col].to_numpy(dtype='float64', na_value=float('nan'))
+                nan = pop != pop
+                record.update({
+                    'total_population': float(pop[~nan].sum()),
+                    'nonzero_rows': int((pop > 0).sum()),
+                    'zero_rows': int((pop == 0).sum()),
+                    'nan_rows': int(nan.sum()),
+                })
+            if group_col in gdf.columns:
+                record['unique_groups'] = int(gdf[group_col].nunique())
+
+        if self.enabled('debug'):
+            record['memory_mb'] = round(gdf.memory_usage(deep=True).sum() / MB, 2)
+            record['columns'] = gdf.columns.tolist()
+            self.echo(f"\n=== Diagnostic Report: {phase} ===\n{gdf.head(2)}")
+
+        self._emit('diagnostic', record, time.time(), 0.0)
+        details = ', '.join(f"{k}={v:,}" if isinstance(v, (int, float)) else f"{k}={v}"
+                            for k, v in record.items() if k not in ('phase', 'columns'))
+        self.echo(f"[{phase}] {details}")
+
+    def close(self):
+        """Write the Chrome trace (JSON lines are written as they happen)."""
+        if self.chrome and self._events:
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': self._events, 'displayTimeUnit': 'ms'}, f)
+            self._events = []
+
+
+_instrumentation = Instrumentation(level='basic')
+
+
+def configure(path=None, level='basic', echo=print):
+    """Replace the process-wide instrumentation and return it."""
+    global _instrumentation
+    _instrumentation.close()
+    _instrumentation = Instrumentation(path=path, level=level, echo=echo)
+    return _instrumentation
+
+
+def get_instrumentation():
+    return _instrumentation
@@ -0,0 +1,215 @@
+"""
+Per-country population density maps, rendered in parallel from cached geometries.
+
+``create_population_density_plots`` in the analysis notebook reprojected the
+whole continent and drew the countries one after another at full Kontur
+vertex resolution, so a 300 dpi map spent most of its time on vertices
+closer together than a pixel. Here:
+
+1. ``map_geometries`` reprojects the department units once, computes their
+   areas from the full geometries and simplifies each country to
+   ``PIXEL_TOLERANCE`` of a pixel at the map's scale (its extent over
+   ``FIGSIZE * dpi``). The result is cached in the ``SpatialCache`` under the
+   input file, CRS and scale, so it is only recomputed when one changes.
+2. ``map_tasks`` gives every country a digest of exactly what its map shows
+   (geometries, populations, title and render settings). Maps whose digest
+   matches the manifest of the previous run, and whose PNG still exists, are
+   skipped.
+3. ``render_maps`` draws the rest in a process pool, one country per task.
+"""
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from pipeline.reconcile import normalize_hasc
+
+FIGSIZE = 15  # inches, square as in the notebook
+DEFAULT_DPI = 300
+PIXEL_TOLERANCE = 0.5  # simplification tolerance, in pixels of the rendered map
+MANIFEST_FILE = 'maps_manifest.json'
+QUINTILE_LABELS = ['Q1 (Lowest)', 'Q2', 'Q3', 'Q4', 'Q5 (Highest)']
+CMAP = 'YlOrRd'
+RENDER_VERSION = 1  # bump when the map layout changes to re-render every map
+
+
+def density_quintiles(density):
+    """
+    Quintile label of each value, ranking ties in order of appearance.
+
+    Unlike ``pd.qcut`` on the values, this never fails on repeated densities
+    or countries with fewer than five units.
+    """
+    density = pd.Series(density)
+    ranks = density.rank(method='first')
+    codes = np.ceil(len(QUINTILE_LABELS) * ranks / ranks.count()) - 1
+    labels = pd.Categorical.from_codes(codes.fillna(-1).astype(int), categories=QUINTILE_LABELS)
+    return pd.Series(labels, index=density.index)
+
+
+def kontur_map_units(kontur, country_col='country'):
+    """Kontur units with the country of their HASC code (units without one are dropped)."""
+    country = normalize_hasc(kontur['hasc'].to_numpy()).str[:2].to_numpy()
+    units = kontur.assign(**{country_col: country})
+    missing = units[country_col].isna()
+    if missing.any():
+        print(f"Dropping {missing.sum():,} Kontur units without a HASC code")
+    return units[~missing].reset_index(drop=True)
+
+
+def map_geometries(units, crs, dpi=DEFAULT_DPI, country_col='country'):
+    """
+    Project, measure and simplify department units to each country's map scale.
+
+    Args:
+        units (GeoDataFrame): Units with ``country_col`` and ``population``
+        crs: Equal-area CRS the maps are drawn in
+        dpi (int): Resolution the tolerance is computed for
+
+    Returns:
+        GeoDataFrame: ``country_col``, ``name``, ``population``, ``area_km2``
+        (from the full geometries), ``pop_density`` and the simplified geometry
+    """
+    projected = units.to_crs(crs)
+    geoms = projected.geometry.to_numpy()
+    frame = projected[[country_col, 'population']].copy()
+    frame['name'] = projected['name'].to_numpy() if 'name' in projected.columns else None
+    frame['area_km2'] = shapely.area(geoms) / 10**6
+    frame['pop_density'] = frame['population'] / frame['area_km2'].where(frame['area_km2'] > 0)
+
+    # One pixel per country: its larger side over the figure width in pixels
+    bounds = pd.DataFrame(shapely.bounds(geoms), columns=['minx', 'miny', 'maxx', 'maxy'],
+                          index=frame.index).groupby(frame[country_col])
+    extent = np.maximum(bounds['maxx'].max() - bounds['minx'].min(),
+                        bounds['maxy'].max() - bounds['miny'].min())
+    tolerance = frame[country_col].map(PIXEL_TOLERANCE * extent / (FIGSIZE * dpi)).to_numpy()
+
+    simplified = shapely.simplify(geoms, np.nan_to_num(tolerance), preserve_topology=True)
+    before, after = shapely.get_num_coordinates(geoms).sum(), shapely.get_num_coordinates(simplified).sum()
+    print(f"Simplified {len(frame):,} units for {dpi} dpi maps: {before:,} -> {after:,} vertices")
+    return frame.set_geometry(simplified, crs=projected.crs)
+
+
+def map_digest(frame, title, caption, dpi):
+    """
+    Digest of everything a map shows; equal digests render identical PNGs.
+
+    ``frame`` must already hold its ``density_quintile`` (see ``map_tasks``).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([title, caption, dpi, FIGSIZE, CMAP, RENDER_VERSION]).encode())
+    for wkb in shapely.to_wkb(frame.geometry.to_numpy()):
+        digest.update(wkb)
+    digest.update(frame['population'].to_numpy(dtype='float64').tobytes())
+    # The colours: quintiles of pop_density, which also depends on area_km2
+    digest.update(frame['density_quintile'].cat.codes.to_numpy(dtype='int64').tobytes())
+    return digest.hexdigest()
+
+
+def load_manifest(output_dir):
+    path = Path(output_dir) / MANIFEST_FILE
+    if path.exists():
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            print(f"WARNING: Map manifest {path} is unreadable, rendering every map")
+    return {}
+
+
+def save_manifest(output_dir, manifest):
+    path = Path(output_dir) / MANIFEST_FILE
+    tmp_path = path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def map_tasks(geometries, output_dir, crs_label, dpi=DEFAULT_DPI, country_col='country',
+              force=False):
+    """
+    One render task per country whose map is missing or out of date.
+
+    Args:
+        geometries (GeoDataFrame): ``map_geometries`` output
+        output_dir (Path): Directory of the PNGs and their manifest
+        crs_label (str): Projection named in the caption
+        force (bool): Render every map regardless of the manifest
+
+    Returns:
+        tuple: (tasks, manifest) where ``manifest`` maps each PNG name to the
+        digest it will have once the tasks are rendered
+    """
+    output_dir = Path(output_dir)
+    previous = load_manifest(output_dir)
+    manifest, tasks = {}, []
+    for country, frame in geometries.groupby(country_col, sort=True):
+        if frame['pop_density'].isna().all():
+            print(f"Skipping {country}: no population density values")
+            continue
+        frame = frame.assign(density_quintile=density_quintiles(frame['pop_density']))
+        file_name = f"{str(country).replace(' ', '_')}_density.png"
+        title = f"Population Density by Administrative Division\n{country}"
+        caption = f"Total Population: {frame['population'].sum():,.0f}\nProjection: {crs_label}"
+        digest = map_digest(frame, title, caption, dpi)
+        manifest[file_name] = digest
+        if not force and previous.get(file_name) == digest and (output_dir / file_name).exists():
+            continue
+        tasks.append({'frame': frame, 'path': output_dir / file_name, 'title': title,
+                      'caption': caption, 'dpi': dpi})
+    print(f"{len(manifest) - len(tasks):,} of {len(manifest):,} maps unchanged in {output_dir}")
+    return tasks, manifest
+
+
+def render_map(task):
+    """Draw one country's quintile map to its PNG (runs in a pool worker)."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    fig, ax = plt.subplots(1, 1, figsize=(FIGSIZE, FIGSIZE))
+    task['frame'].plot(column='density_quintile', categorical=True, legend=True, ax=ax, cmap=CMAP,
+                       legend_kwds={'title': 'Population Density\nQuintiles',
+                                    'bbox_to_anchor': (1.3, 1), 'frameon': False,
+                                    'fontsize': 12, 'title_fontsize': 14})
+    ax.set_title(task['title'], pad=20, size=16)
+    fig.text(0.5, 0.02, task['caption'], ha='center', bbox=dict(facecolor='white', alpha=0.8))
+    ax.axis('off')
+    fig.tight_layout()
+    fig.savefig(task['path'], bbox_inches='tight', dpi=task['dpi'])
+    plt.close(fig)
+    return task['path'], time.perf_counter() - start
+
+
+def render_maps(tasks, workers=None):
+    """
+    Render the tasks in a process pool.
+
+    Args:
+        tasks (list): ``map_tasks`` output (of one or several regions)
+        workers (int): Processes (default: cpu_count - 2, at most one per map)
+
+    Returns:
+        list: Paths of the rendered PNGs
+    """
+    from pipeline.pools import PRELOAD_MODULES, pool_context
+
+    if not tasks:
+        return []
+    workers = min(workers or max(1, os.cpu_count() - 2), len(tasks))
+    # Biggest maps first so the slowest one does not start last
+    tasks = sorted(tasks, key=lambda task: -shapely.get_num_coordinates(
+        task['frame'].geometry.to_numpy()).sum())
+    rendered = []
+    context = pool_context(preload=PRELOAD_MODULES + ['matplotlib'])
+    with context.Pool(workers) as pool:
+        for path, seconds in pool.imap_unordered(render_map, tasks):
+            print(f"  {path.name} ({seconds:.1f}s)")
+            rendered.append(path)
+    return rendered
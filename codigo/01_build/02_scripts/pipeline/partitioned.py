@@ -0,0 +1,289 @@
+"""
+Partitioned, out-of-core population aggregation for continent/world runs.
+
+The Kontur file is streamed once in Arrow batches and every hexagon is
+written to a spatial tile on disk (by centroid), so no step holds more than
+one batch or one tile in memory. Tiles are then apportioned to admin units
+independently by a pool of local worker processes under a per-worker memory
+limit; each tile leaves a small per-admin partial on disk (written to a
+``.tmp`` file and renamed into place), and reruns skip tiles whose partial
+already exists. Tiles and partials are keyed on the ``SpatialCache``
+content fingerprints of the population and admin files, so an edited input
+is never matched with results of its previous version.
+
+With ``dask.distributed`` installed the tiles run on a ``LocalCluster``
+(which spills to ``workdir``); otherwise a ``ProcessPoolExecutor`` with an
+address-space limit per worker is used. Neither needs an outside service.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import json
+import multiprocessing
+import os
+import re
+import shutil
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+from tqdm import tqdm
+
+from pipeline.admin_layer import make_valid_polygons
+from pipeline.cache import SpatialCache
+from pipeline.pools import pool_context
+from pipeline.zonal import AREA_CRS, ZonalEngine
+
+DEFAULT_GRID = 32  # tiles per axis over the file's total bounds
+DEFAULT_READ_BATCH = 500_000
+META_FILE = '_partitions.json'
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def parse_bytes(value):
+    """Turn 4 * 1024**3, '4GB' or '512 MB' into a number of bytes."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)  # setrlimit only takes integers
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', value.upper())
+    if not match:
+        raise ValueError(f"Cannot parse memory size {value!r}")
+    number, unit = match.groups()
+    return int(float(number) * _UNITS[unit])
+
+
+def partition_population(pop_path, workdir, grid=DEFAULT_GRID, read_batch=DEFAULT_READ_BATCH,
+                         cache=None):
+    """
+    Stream the population file once and spill hexagons into spatial tiles.
+
+    Existing tiles are reused only for a file with the same contents (its
+    ``SpatialCache`` fingerprint) and grid.
+
+    Args:
+        pop_path (Path): Kontur population GeoPackage
+        workdir (Path): Directory receiving ``tiles/<tx>_<ty>/part-*.parquet``
+        grid (int): Number of tiles along each axis of the file's bounds
+        read_batch (int): Features per Arrow batch
+        cache (SpatialCache): Cache whose index memoises the fingerprint
+            (default: one in ``workdir/cache``)
+
+    Returns:
+        list: Tile directories containing data
+    """
+    workdir = Path(workdir)
+    tiles_dir = workdir / 'tiles'
+    meta_path = workdir / META_FILE
+    cache = cache or SpatialCache(workdir / 'cache')
+
+    info = pyogrio.read_info(pop_path)
+    source = {'fingerprint': cache.fingerprint(pop_path), 'grid': grid}
+    if meta_path.exists():
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['source'] == source:
+            print(f"Reusing {len(meta['tiles'])} existing partitions in {tiles_dir}")
+            return [tiles_dir / tile for tile in meta['tiles']]
+    # No (or stale) metadata: tiles left by an interrupted run are incomplete
+    shutil.rmtree(tiles_dir, ignore_errors=True)
+    shutil.rmtree(workdir / 'partials', ignore_errors=True)
+
+    tiles_dir.mkdir(parents=True, exist_ok=True)
+    # An empty layer has no bounds; it yields no tiles and no partials
+    xmin, ymin, xmax, ymax = info['total_bounds'] if info['total_bounds'] is not None else (0, 0, 1, 1)
+    tile_size = max(xmax - xmin, ymax - ymin) / grid
+
+    tiles = set()
+    with pyogrio.open_arrow(pop_path, batch_size=read_batch, use_pyarrow=True) as (meta, reader):
+        geom_col = meta['geometry_name'] or 'wkb_geometry'
+        for batch_no, batch in enumerate(tqdm(reader, desc="Partitioning hexagons")):
+            geoms = shapely.from_wkb(batch.column(geom_col).to_numpy(zero_copy_only=False))
+            centroids = shapely.centroid(geoms)
+            tx = np.clip(((shapely.get_x(centroids) - xmin) // tile_size).astype(int), 0, grid - 1)
+            ty = np.clip(((shapely.get_y(centroids) - ymin) // tile_size).astype(int), 0, grid - 1)
+            tile_ids = tx * grid + ty
+
+            table = pa.Table.from_batches([batch])
+            for tile_id in np.unique(tile_ids):
+                name = f"{tile_id // grid}_{tile_id % grid}"
+                tile_dir = tiles_dir / name
+                tile_dir.mkdir(exist_ok=True)
+                pq.write_table(
+                    table.filter(pa.array(tile_ids == tile_id)),
+                    tile_dir / f"part-{batch_no:05d}.parquet",
+                )
+                tiles.add(name)
+
+    tmp_path = meta_path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'source': source, 'crs': info['crs'], 'geometry': geom_col,
+                   'tiles': sorted(tiles)}, f, indent=1)
+    os.replace(tmp_path, meta_path)
+    print(f"Wrote {len(tiles)} partitions to {tiles_dir}")
+    return [tiles_dir / tile for tile in sorted(tiles)]
+
+
+def aggregate_partition(tile_dir, admin_path, zone_id='GID_1', admin_layer=None,
+                        area_crs=AREA_CRS, value_col='population'):
+    """
+    Apportion one tile's hexagons to admin units and write a per-admin partial.
+
+    Returns:
+        dict: Tile name, hexagon count, input population and partial path
+    """
+    tile_dir = Path(tile_dir)
+    workdir = tile_dir.parent.parent
+    partial_path = workdir / 'partials' / f"{tile_dir.name}.parquet"
+    with open(workdir / META_FILE) as f:
+        meta = json.load(f)
+
+    table = pq.read_table(tile_dir)
+    hexes = gpd.GeoDataFrame(
+        table.drop_columns([meta['geometry']]).to_pandas(),
+        geometry=shapely.from_wkb(table.column(meta['geometry']).to_numpy(zero_copy_only=False)),
+        crs=meta['crs'],
+    )
+    summary = {'tile': tile_dir.name, 'hexagons': len(hexes),
+               'input_population': float(hexes[value_col].sum())}
+
+    # Only the admin units overlapping this tile are read
+    admin_crs = pyogrio.read_info(admin_path, layer=admin_layer)['crs']
+    tile_bounds = gpd.GeoSeries([shapely.box(*hexes.total_bounds)], crs=hexes.crs).to_crs(admin_crs)
+    admin = gpd.read_file(admin_path, layer=admin_layer, bbox=tuple(tile_bounds.total_bounds))
+    # Same repair as load_valid_admin, so self-intersecting GADM units don't abort the tile
+    geoms, _ = make_valid_polygons(admin.geometry.values)
+    admin = admin.set_geometry(gpd.GeoSeries(geoms, index=admin.index, crs=admin.crs))
+
+    if len(admin) == 0:
+        partial = pd.DataFrame({zone_id: pd.Series(dtype='object'),
+                                'adjusted_population': pd.Series(dtype='float64')})
+    else:
+        engine = ZonalEngine(admin, zone_id=zone_id, crs=area_crs)
+        engine.add_polygons('pop', hexes, value_cols=[value_col])
+        partial = engine.result()[[zone_id, f'pop_{value_col}']]
+        partial = partial.rename(columns={f'pop_{value_col}': 'adjusted_population'})
+
+    # Written aside and renamed, so an interrupted tile never leaves a partial that looks done
+    tmp_path = partial_path.with_suffix('.parquet.tmp')
+    partial.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, partial_path)
+    summary['partial'] = str(partial_path)
+    summary['output_population'] = float(partial['adjusted_population'].sum())
+    return summary
+
+
+def _limit_worker_memory(memory_limit):
+    """Cap the worker's address space so a runaway tile raises MemoryError."""
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _run_with_processes(tiles, n_workers, memory_limit, task_kwargs):
+    summaries = []
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=pool_context(),  # fresh processes, so the memory cap is per worker
+        initializer=_limit_worker_memory,
+        initargs=(memory_limit,),
+    ) as pool:
+        futures = {pool.submit(aggregate_partition, tile, **task_kwargs): tile for tile in tiles}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Aggregating partitions"):
+            summaries.append(future.result())
+    return summaries
+
+
+def _run_with_dask(tiles, n_workers, memory_limit, task_kwargs, workdir):
+    from dask.distributed import Client, LocalCluster
+
+    with LocalCluster(
+        n_workers=n_workers,
+        threads_per_worker=1,
+        processes=True,
+        memory_limit=memory_limit or 'auto',
+        local_directory=str(Path(workdir) / 'dask-spill'),
+        dashboard_address=None,
+    ) as cluster, Client(cluster) as client:
+        futures = client.map(aggregate_partition, tiles, pure=False, **task_kwargs)
+        return client.gather(futures)
+
+
+def run_partitioned(pop_path, admin_path, workdir, zone_id='GID_1', admin_layer=None,
+                    n_workers=None, memory_limit=None, grid=DEFAULT_GRID,
+                    scheduler='auto', area_crs=AREA_CRS, cache=None):
+    """
+    Partition, aggregate per tile on local workers and combine the partials.
+
+    Args:
+        pop_path (Path): Kontur population file
+        admin_path (Path): Admin divisions GeoPackage
+        workdir (Path): Spill directory for tiles and partials
+        zone_id (str): Admin identifier column
+        admin_layer (str): Layer in ``admin_path`` (default: first layer)
+        n_workers (int): Worker processes (default: cpu_count - 2)
+        memory_limit (int or str): Per-worker memory cap, e.g. '4GB'
+        grid (int): Tiles per axis
+        scheduler (str): 'dask', 'processes' or 'auto'
+        cache (SpatialCache): Cache whose index memoises the input fingerprints
+            (default: one in ``workdir/cache``)
+
+    Returns:
+        DataFrame: ``zone_id`` and ``adjusted_population``
+    """
+    workdir = Path(workdir)
+    n_workers = n_workers or max(1, multiprocessing.cpu_count() - 2)
+    memory_limit = parse_bytes(memory_limit)
+    cache = cache or SpatialCache(workdir / 'cache')
+
+    tiles = partition_population(pop_path, workdir, grid=grid, cache=cache)
+
+    # Partials are only reusable for the same admin contents, layer and zoning
+    task_kwargs = {'admin_path': str(admin_path), 'zone_id': zone_id,
+                   'admin_layer': admin_layer, 'area_crs': area_crs}
+    task = {'admin': cache.fingerprint(admin_path), 'zone_id': zone_id,
+            'admin_layer': admin_layer, 'area_crs': area_crs}
+    partials_dir = workdir / 'partials'
+    task_path = partials_dir / '_task.json'
+    if task_path.exists() and json.loads(task_path.read_text()) != task:
+        shutil.rmtree(partials_dir)
+    partials_dir.mkdir(exist_ok=True)
+    task_path.write_text(json.dumps(task))
+    for tmp_path in partials_dir.glob('*.parquet.tmp'):
+        tmp_path.unlink()
+
+    pending = [tile for tile in tiles if not (partials_dir / f"{tile.name}.parquet").exists()]
+    print(f"{len(tiles) - len(pending)} partitions already aggregated, {len(pending)} to go")
+
+    if scheduler == 'auto':
+        try:
+            import dask.distributed  # noqa: F401
+            scheduler = 'dask'
+        except ImportError:
+            scheduler = 'processes'
+
+    if pending:
+        print(f"Aggregating with {n_workers} '{scheduler}' workers"
+              f"{f', {memory_limit / 1024**3:.1f} GB each' if memory_limit else ''}")
+        if scheduler == 'dask':
+            summaries = _run_with_dask(pending, n_workers, memory_limit, task_kwargs, workdir)
+        else:
+            summaries = _run_with_processes(pending, n_workers, memory_limit, task_kwargs)
+
+        input_pop = sum(s['input_population'] for s in summaries)
+        output_pop = sum(s['output_population'] for s in summaries)
+        print(f"Aggregated population {output_pop:,.0f} of {input_pop:,.0f} in processed tiles")
+
+    partials = [pd.read_parquet(path) for path in sorted(partials_dir.glob('*.parquet'))]
+    if not partials:
+        return pd.DataFrame({zone_id: pd.Series(dtype='object'),
+                             'adjusted_population': pd.Series(dtype='float64')})
+    return (
+        pd.concat(partials, ignore_index=True)
+        .groupby(zone_id, as_index=False)['adjusted_population']
+        .sum()
+    )
@@ -0,0 +1,84 @@
+"""
+Worker pool start-up: forkserver template with the heavy modules preloaded.
+
+Importing geopandas, pandas, pyogrio and shapely costs roughly half a second
+per process. With 'spawn' (macOS, Windows) and 'forkserver' (the Linux default
+from Python 3.14) every pool worker paid it again, and every batch starts a
+new pool. ``pool_context`` returns a 'forkserver' context whose server imports
+``PRELOAD_MODULES`` once; each worker is then forked from that warm template
+instead of re-importing. Unlike 'fork', workers do not copy the parent's
+batch frames or threads.
+
+Entry points keep the geospatial stack out of their top-level imports (see
+``build.py`` and ``pipeline/gpkg_meta.py``) so light commands start instantly.
+"""
+import multiprocessing
+import os
+import time
+
+# Start method for the overlay and partition pools: 'forkserver', 'fork' or
+# 'spawn' (None: the platform default); PIPELINE_START_METHOD overrides it
+START_METHOD = 'forkserver'
+
+PRELOAD_MODULES = [
+    'numpy',
+    'pandas',
+    'shapely',
+    'pyproj',
+    'geopandas',
+    'pyogrio',
+    'pyarrow.parquet',
+    'pipeline.admin_layer',
+    'pipeline.batch_overlay',
+    'pipeline.hexstore',
+    'pipeline.instrumentation',
+    'pipeline.profiling',
+    'pipeline.resilience',
+]
+
+
+def start_method(method=None):
+    """Start method to use: argument, then PIPELINE_START_METHOD, then START_METHOD."""
+    method = method or os.environ.get('PIPELINE_START_METHOD') or START_METHOD
+    if method not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_start_method()
+    return method
+
+
+def pool_context(method=None, preload=PRELOAD_MODULES):
+    """
+    Multiprocessing context for worker pools.
+
+    Args:
+        method (str): 'forkserver', 'fork' or 'spawn' (see ``start_method``)
+        preload (list): Modules the fork server imports once for all workers
+
+    Returns:
+        BaseContext: Use its ``Pool`` or pass it as ``mp_context``
+    """
+    context = multiprocessing.get_context(start_method(method))
+    if context.get_start_method() == 'forkserver':
+        # The server is started by the first pool; later pools reuse it
+        context.set_forkserver_preload(list(preload))
+    return context
+
+
+def _ready(barrier, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    barrier.wait()
+
+
+def pool_spinup_seconds(context, workers, initializer=None, initargs=()):
+    """
+    Seconds until ``workers`` processes of ``context`` have all started and run
+    ``initializer``.
+
+    Used by the benchmark to compare start methods; includes the fork server's
+    own start (and preload) the first time it is called.
+    """
+    start = time.perf_counter()
+    barrier = context.Barrier(workers + 1)
+    with context.Pool(workers, initializer=_ready, initargs=(barrier, initializer, initargs)):
+        barrier.wait(timeout=300)
+        return time.perf_counter() - start
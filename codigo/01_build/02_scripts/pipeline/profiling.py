@@ -0,0 +1,369 @@
+"""
+Opt-in profiling of multiprocessing pool workers.
+
+``WorkerProfiler.runner()`` returns a drop-in replacement for
+``instrumentation.timed_call``: each worker task runs under ``cProfile`` (or a
+stack sampler) and dumps its profile to ``profile_dir/<pid>-<tag>-<start>.*``. It
+also measures what the pool spends pickling each chunk in and each result
+out, by re-serializing them in the worker, and how many bytes each task reads
+from the memory-mapped batch store (chunks only pickle a ``HexRange``
+handle). ``summary()`` merges every
+per-process profile and prints the hot functions, the time per library
+(GEOS/shapely, pandas, geopandas, pickle, ...) and the serialization
+overhead compared with compute time.
+
+Modes:
+    cprofile  deterministic; exact call counts, adds overhead to small calls
+    sampling  SIGPROF stack sampler (Unix only); low overhead, writes
+              collapsed stacks usable by flamegraph.pl / speedscope
+"""
+from collections import Counter
+from functools import partial
+from pathlib import Path
+import cProfile
+import io
+import os
+import pickle
+import pstats
+import time
+
+from pipeline.hexstore import HexRange
+from pipeline.instrumentation import (
+    MB,
+    call_isolated,
+    reset_peak_rss,
+    task_peak_rss,
+    timed_call,
+    worker_base_rss_mb,
+)
+
+MODES = ('cprofile', 'sampling')
+SAMPLE_INTERVAL = 0.005  # seconds of CPU time between samples
+
+# Library a profiled function belongs to, matched on its source path
+CATEGORIES = [
+    ('shapely/GEOS', ('shapely',)),
+    ('geopandas', ('geopandas',)),
+    ('pandas', ('pandas',)),
+    ('numpy', ('numpy',)),
+    ('pyogrio/arrow', ('pyogrio', 'pyarrow')),
+    ('pickle/ipc', ('pickle', 'multiprocessing', 'copyreg', 'socket', 'connection')),
+]
+
+
+def categorize(filename):
+    """Map a profiled function's file to a library category."""
+    if filename.startswith('<built-in') or filename == '~':
+        return 'builtins'
+    for category, markers in CATEGORIES:
+        if any(marker in filename for marker in markers):
+            return category
+    return 'other'
+
+
+class _StackSampler:
+    """Count Python stacks every ``interval`` seconds of CPU time (SIGPROF)."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        import signal
+        self.signal = signal
+        self.interval = interval
+        self.counts = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.signal.signal(self.signal.SIGPROF, self._sample)
+        self.signal.setitimer(self.signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        self.signal.setitimer(self.signal.ITIMER_PROF, 0)
+        self.signal.signal(self.signal.SIGPROF, self.signal.SIG_DFL)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.items():
+                f.write(f"{stack} {count}\n")
+
+
+def _serialization_cost(obj):
+    """Pickled size and the time to pickle and unpickle ``obj`` once."""
+    t0 = time.perf_counter()
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    t1 = time.perf_counter()
+    pickle.loads(payload)
+    return len(payload), t1 - t0, time.perf_counter() - t1
+
+
+def _mapped_bytes(arg):
+    """Bytes the task reads from ``HexStore`` files through the ``HexRange`` handles in ``arg``."""
+    if isinstance(arg, HexRange):
+        return arg.nbytes
+    if isinstance(arg, (tuple, list)):
+        return sum(_mapped_bytes(item) for item in arg)
+    return 0
+
+
+def profiled_call(task, profile_dir, mode='cprofile'):
+    """
+    ``timed_call`` with a per-task profile and serialization measurements.
+
+    Returns the ``timed_call`` dictionary plus ``arg_pickle_mb``,
+    ``arg_pickle_s``, ``arg_unpickle_s``, ``arg_mapped_mb``, ``result_mb``,
+    ``result_pickle_s`` and ``result_unpickle_s``. For a ``HexRange`` chunk
+    the pickled argument is only the handle; ``arg_mapped_mb`` is the chunk
+    data the worker reads from the mapped store.
+    """
+    func, arg, *tag = task
+    tag = tag[0] if tag else None
+    arg_bytes, arg_dump, arg_load = _serialization_cost(arg)
+    mapped_bytes = _mapped_bytes(arg)
+
+    profiler = _StackSampler() if mode == 'sampling' else cProfile.Profile()
+    tracked = reset_peak_rss()
+    start = time.time()
+    t0 = time.perf_counter()
+    if mode == 'sampling':
+        profiler.start()
+        try:
+            result, error = call_isolated(func, arg)
+        finally:
+            profiler.stop()
+    else:
+        result, error = profiler.runcall(call_isolated, func, arg)
+    seconds = time.perf_counter() - t0
+
+    # Tags restart at 0 for every batch, so the start time keeps names unique
+    name = f"{os.getpid()}-{tag}-{int(start * 1e6)}"
+    if mode == 'sampling':
+        profiler.dump(Path(profile_dir) / f"{name}.stacks")
+    else:
+        profiler.dump_stats(Path(profile_dir) / f"{name}.prof")
+
+    result_bytes, result_dump, result_load = _serialization_cost(result)
+    return {
+        'tag': tag,
+        'pid': os.getpid(),
+        'start': start,
+        'seconds': seconds,
+        'peak_rss_mb': task_peak_rss(tracked) / MB,
+        'base_rss_mb': worker_base_rss_mb(),
+        'arg_pickle_mb': arg_bytes / MB,
+        'arg_mapped_mb': mapped_bytes / MB,
+        'arg_pickle_s': arg_dump,
+        'arg_unpickle_s': arg_load,
+        'result_mb': result_bytes / MB,
+        'result_pickle_s': result_dump,
+        'result_unpickle_s': result_load,
+        'result': result,
+        'error': error,
+    }
+
+
+class WorkerProfiler:
+    """
+    Profile pool workers and merge their profiles.
+
+    Args:
+        profile_dir (Path or str): Where per-task profiles are written. Old
+            profiles in it are removed.
+        mode (str): 'cprofile', 'sampling' or None (disabled; ``runner()``
+            is then plain ``timed_call`` and nothing is recorded)
+        profile_parent (bool): Also profile the parent process (pd.concat,
+            result unpickling, ...) between ``start()`` and ``summary()``
+
+    Example:
+        profiler = configure_profiler(PROFILE_PATH, mode='cprofile')
+        for timing in pool.imap_unordered(profiler.runner(), tasks):
+            profiler.record(timing)
+        profiler.summary()
+    """
+
+    def __init__(self, profile_dir=None, mode=None, profile_parent=True):
+        if mode is not None and mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}; use one of {MODES}")
+        if mode == 'sampling' and os.name == 'nt':
+            print("Sampling profiler needs SIGPROF; falling back to cProfile")
+            mode = 'cprofile'
+        self.mode = mode
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.timings = []
+        self._parent = None
+
+        if self.enabled:
+            if self.profile_dir is None:
+                raise ValueError("profile_dir is required when profiling is enabled")
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            for old in self.profile_dir.glob('*'):
+                if old.suffix in ('.prof', '.stacks'):
+                    old.unlink()
+            if profile_parent:
+                self._parent = cProfile.Profile()
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def start(self):
+        if self._parent is not None:
+            self._parent.enable()
+
+    def runner(self):
+        """Callable to pass to ``Pool.imap``/``imap_unordered`` instead of ``timed_call``."""
+        if not self.enabled:
+            return timed_call
+        return partial(profiled_call, profile_dir=str(self.profile_dir), mode=self.mode)
+
+    def record(self, timing, pool=None):
+        """Keep a worker's timing/serialization metadata (without its result)."""
+        if self.enabled:
+            self.timings.append({k: v for k, v in timing.items() if k != 'result'}
+                                | {'pool': pool})
+
+    def merged_stats(self):
+        """All worker cProfile dumps merged into one ``pstats.Stats`` (None if none)."""
+        files = sorted(str(p) for p in self.profile_dir.glob('*.prof')
+                       if p.name not in ('parent.prof', 'workers_merged.prof'))
+        if not files:
+            return None
+        stats = pstats.Stats(files[0], stream=io.StringIO())
+        for path in files[1:]:
+            stats.add(path)
+        stats.dump_stats(self.profile_dir / 'workers_merged.prof')
+        return stats
+
+    def merged_stacks(self):
+        """All worker stack samples merged into one Counter (collapsed-stack keys)."""
+        counts = Counter()
+        for path in self.profile_dir.glob('*.stacks'):
+            if path.name == 'workers_merged.stacks':
+                continue
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    counts[stack] += int(count)
+        if counts:
+            with open(self.profile_dir / 'workers_merged.stacks', 'w') as f:
+                for stack, count in counts.most_common():
+                    f.write(f"{stack} {count}\n")
+        return counts
+
+    def _category_table(self, stats=None, counts=None):
+        totals = Counter()
+        if stats is not None:
+            for (filename, _, _), (_, _, tottime, _, _) in stats.stats.items():
+                totals[categorize(filename)] += tottime
+        else:
+            for stack, count in counts.items():
+                leaf = stack.rsplit(';', 1)[-1]
+                filename = leaf[leaf.rfind('(') + 1:leaf.rfind(':')]
+                totals[categorize(filename)] += count * SAMPLE_INTERVAL
+        return totals
+
+    def _print_hot_stacks(self, counts, top):
+        self_time, inclusive = Counter(), Counter()
+        for stack, count in counts.items():
+            frames = stack.split(';')
+            self_time[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+        total = sum(counts.values())
+        print(f"\nTop {top} functions by self samples ({total:,} samples, "
+              f"{SAMPLE_INTERVAL * 1000:g} ms CPU each):")
+        for frame, count in self_time.most_common(top):
+            print(f"  {100 * count / total:5.1f}% self  {100 * inclusive[frame] / total:5.1f}% incl  {frame}")
+
+    def _print_serialization(self):
+        import pandas as pd
+
+        timings = pd.DataFrame(self.timings)
+        timings['serialization_s'] = timings[[
+            'arg_pickle_s', 'arg_unpickle_s', 'result_pickle_s', 'result_unpickle_s'
+        ]].sum(axis=1)
+        by_pool = timings.groupby('pool', dropna=False).agg(
+            tasks=('seconds', 'size'),
+            workers=('pid', 'nunique'),
+            compute_s=('seconds', 'sum'),
+            serialization_s=('serialization_s', 'sum'),
+            arg_pickle_mb=('arg_pickle_mb', 'sum'),
+            arg_mapped_mb=('arg_mapped_mb', 'sum'),
+            result_mb=('result_mb', 'sum'),
+        )
+        by_pool['serialization_pct'] = 100 * by_pool['serialization_s'] / (
+            by_pool['compute_s'] + by_pool['serialization_s'])
+        print("\n=== Parent <-> worker serialization (estimated by re-pickling in the worker) ===")
+        print(by_pool.round(3).to_string())
+        print("arg_pickle_mb is what the pool pickles (only a handle for store-backed chunks); "
+              "arg_mapped_mb is what workers read from the memory-mapped batch stores")
+
+        per_worker = timings.groupby('pid')['seconds'].agg(['size', 'sum', 'max'])
+        print("\nCompute seconds per worker (tasks, total, slowest task):")
+        print(per_worker.round(3).to_string())
+
+    def summary(self, top=25):
+        """Merge worker (and parent) profiles and print the report."""
+        if not self.enabled:
+            return None
+        print(f"\n=== Worker profile summary ({self.mode}, {self.profile_dir}) ===")
+
+        if self._parent is not None:
+            self._parent.disable()
+            self._parent.dump_stats(self.profile_dir / 'parent.prof')
+
+        categories = None
+        if self.mode == 'sampling':
+            counts = self.merged_stacks()
+            if counts:
+                self._print_hot_stacks(counts, top)
+                categories = self._category_table(counts=counts)
+        else:
+            stats = self.merged_stats()
+            if stats is not None:
+                stream = io.StringIO()
+                stats.stream = stream
+                stats.sort_stats('tottime').print_stats(top)
+                print(f"\nTop {top} worker functions by own time:")
+                print(stream.getvalue().split('\n\n', 1)[-1].rstrip())
+                categories = self._category_table(stats=stats)
+
+        if categories:
+            total = sum(categories.values()) or 1.0
+            print("\nWorker time by library:")
+            for category, seconds in categories.most_common():
+                print(f"  {category:<15} {seconds:9.2f}s  {100 * seconds / total:5.1f}%")
+
+        if self._parent is not None:
+            parent = pstats.Stats(str(self.profile_dir / 'parent.prof'), stream=io.StringIO())
+            parent_categories = self._category_table(stats=parent)
+            total = sum(parent_categories.values()) or 1.0
+            print("\nParent process time by library:")
+            for category, seconds in parent_categories.most_common():
+                print(f"  {category:<15} {seconds:9.2f}s  {100 * seconds / total:5.1f}%")
+
+        if self.timings:
+            self._print_serialization()
+
+        print(f"\nProfiles written to {self.profile_dir} "
+              f"(open workers_merged.* with snakeviz or speedscope)")
+        return self.timings
+
+
+_profiler = WorkerProfiler()
+
+
+def configure_profiler(profile_dir=None, mode=None, profile_parent=True):
+    """Replace the process-wide worker profiler, start it and return it."""
+    global _profiler
+    _profiler = WorkerProfiler(profile_dir, mode=mode, profile_parent=profile_parent)
+    _profiler.start()
+    return _profiler
+
+
+def get_profiler():
+    return _profiler
@@ -0,0 +1,213 @@
+"""
+Raster-based population aggregation.
+
+The admin layer is rasterized once onto a fine equal-area grid as an array of
+zone codes (0 = outside every zone). Hexagons are then assigned to zones by
+array indexing at their centroid, or at several sub-sample points per
+hexagon, and summed with ``np.bincount``. No polygon overlay is needed, at
+the cost of an error bounded by the grid resolution along boundaries;
+``compare_with_exact`` reports that error against the vector overlay.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+from pyproj import Transformer
+from tqdm import tqdm
+
+from pipeline.zonal import AREA_CRS
+
+DEFAULT_RESOLUTION = 250  # metres
+DEFAULT_READ_BATCH = 500_000
+
+
+class ZoneRaster:
+    """
+    Zone-id grid for an admin layer.
+
+    Attributes:
+        codes (ndarray): int32 array (rows, cols); 0 = no zone, i = zone_ids[i - 1]
+        zone_ids (ndarray): Zone identifiers in code order
+        xmin, ymax (float): Upper-left corner of the grid in ``crs``
+        resolution (float): Cell size in ``crs`` units
+    """
+
+    def __init__(self, codes, zone_ids, xmin, ymax, resolution, crs=AREA_CRS):
+        self.codes = codes
+        self.zone_ids = np.asarray(zone_ids)
+        self.xmin = xmin
+        self.ymax = ymax
+        self.resolution = resolution
+        self.crs = crs
+
+    @classmethod
+    def from_admin(cls, admin, zone_id='GID_1', resolution=DEFAULT_RESOLUTION, crs=AREA_CRS):
+        """Rasterize ``admin`` (any CRS) onto a ``resolution`` grid in ``crs``."""
+        admin = admin.dissolve(by=zone_id, as_index=False).to_crs(crs)
+        xmin, ymin, xmax, ymax = admin.total_bounds
+        width = int(np.ceil((xmax - xmin) / resolution))
+        height = int(np.ceil((ymax - ymin) / resolution))
+        print(f"Rasterizing {len(admin)} zones onto {width:,} x {height:,} cells "
+              f"({resolution:g} m)")
+
+        try:
+            from rasterio.features import rasterize
+            from rasterio.transform import from_origin
+
+            codes = rasterize(
+                zip(admin.geometry, range(1, len(admin) + 1)),
+                out_shape=(height, width),
+                transform=from_origin(xmin, ymax, resolution, resolution),
+                fill=0,
+                dtype='int32',
+            )
+        except ImportError:
+            codes = _rasterize_with_shapely(admin.geometry.values, xmin, ymax,
+                                            resolution, height, width)
+
+        return cls(codes, admin[zone_id].to_numpy(), xmin, ymax, resolution, crs)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, codes=self.codes, zone_ids=self.zone_ids.astype(str),
+            origin=np.array([self.xmin, self.ymax, self.resolution]), crs=np.array(self.crs),
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        xmin, ymax, resolution = data['origin']
+        return cls(data['codes'], data['zone_ids'], xmin, ymax, resolution, str(data['crs']))
+
+    def lookup(self, x, y):
+        """Return zone codes for coordinates in the grid CRS (0 outside the grid)."""
+        cols = np.floor((x - self.xmin) / self.resolution).astype(np.int64)
+        rows = np.floor((self.ymax - y) / self.resolution).astype(np.int64)
+        height, width = self.codes.shape
+        valid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        codes = np.zeros(len(x), dtype=np.int32)
+        codes[valid] = self.codes[rows[valid], cols[valid]]
+        return codes
+
+
+def _rasterize_with_shapely(geoms, xmin, ymax, resolution, height, width):
+    """Fallback when rasterio is missing: test cell centres polygon by polygon."""
+    codes = np.zeros((height, width), dtype=np.int32)
+    shapely.prepare(geoms)
+    for code, geom in enumerate(tqdm(geoms, desc="Rasterizing zones"), start=1):
+        gxmin, gymin, gxmax, gymax = geom.bounds
+        c0 = max(int((gxmin - xmin) // resolution), 0)
+        c1 = min(int(np.ceil((gxmax - xmin) / resolution)), width)
+        r0 = max(int((ymax - gymax) // resolution), 0)
+        r1 = min(int(np.ceil((ymax - gymin) / resolution)), height)
+        xs = xmin + (np.arange(c0, c1) + 0.5) * resolution
+        ys = ymax - (np.arange(r0, r1) + 0.5) * resolution
+        xx, yy = np.meshgrid(xs, ys)
+        inside = shapely.contains_xy(geom, xx, yy)
+        codes[r0:r1, c0:c1][inside] = code
+    return codes
+
+
+def load_or_build_zone_raster(admin, admin_path, cache, zone_id='GID_1',
+                              resolution=DEFAULT_RESOLUTION, crs=AREA_CRS):
+    """Rasterize once per admin file version; reuse the .npz afterwards."""
+    key = cache.make_key('zone_raster', inputs=[admin_path], crs=crs,
+                         params={'zone_id': zone_id, 'resolution': resolution})
+    path = Path(cache.cache_dir) / f"{key}.npz"
+    if path.exists():
+        print(f"Loading zone raster from {path}")
+        return ZoneRaster.load(path)
+    raster = ZoneRaster.from_admin(admin, zone_id=zone_id, resolution=resolution, crs=crs)
+    raster.save(path)
+    return raster
+
+
+def sample_points(geoms, samples='centroid'):
+    """
+    Sample points for each polygon.
+
+    Args:
+        geoms (ndarray): Shapely polygons
+        samples (str): 'centroid' (one point) or 'subsample' (centroid plus the
+            midpoint between it and each exterior vertex)
+
+    Returns:
+        tuple: (x, y, owner, weight) arrays; ``weight`` sums to 1 per polygon
+    """
+    centroids = shapely.centroid(geoms)
+    cx, cy = shapely.get_x(centroids), shapely.get_y(centroids)
+    owner = np.arange(len(geoms))
+    if samples == 'centroid':
+        return cx, cy, owner, np.ones(len(geoms))
+
+    coords, vertex_owner = shapely.get_coordinates(shapely.get_exterior_ring(geoms), return_index=True)
+    # Drop each ring's closing vertex (it repeats the first one)
+    keep = np.ones(len(vertex_owner), dtype=bool)
+    keep[:-1] = vertex_owner[:-1] == vertex_owner[1:]
+    keep[-1] = False
+    coords, vertex_owner = coords[keep], vertex_owner[keep]
+
+    x = np.concatenate([cx, (coords[:, 0] + cx[vertex_owner]) / 2])
+    y = np.concatenate([cy, (coords[:, 1] + cy[vertex_owner]) / 2])
+    owner = np.concatenate([owner, vertex_owner])
+    weight = 1.0 / np.bincount(owner, minlength=len(geoms))[owner]
+    return x, y, owner, weight
+
+
+def raster_population_totals(pop_path, raster, samples='centroid', read_batch=DEFAULT_READ_BATCH,
+                             value_col='population'):
+    """
+    Stream a Kontur file and sum population per zone through the zone raster.
+
+    Returns:
+        DataFrame: zone id column ``zone_id`` and ``adjusted_population``, plus
+        ``outside_population`` in ``.attrs`` for hexagons falling in no zone
+    """
+    pop_crs = pyogrio.read_info(pop_path)['crs']
+    transformer = Transformer.from_crs(pop_crs, raster.crs, always_xy=True)
+    sums = np.zeros(len(raster.zone_ids) + 1)
+
+    with pyogrio.open_arrow(pop_path, batch_size=read_batch, use_pyarrow=True) as (meta, reader):
+        geom_col = meta['geometry_name'] or 'wkb_geometry'
+        for batch in tqdm(reader, desc=f"Raster aggregation ({samples})"):
+            geoms = shapely.from_wkb(batch.column(geom_col).to_numpy(zero_copy_only=False))
+            population = batch.column(value_col).to_numpy(zero_copy_only=False).astype('float64')
+
+            x, y, owner, weight = sample_points(geoms, samples)
+            x, y = transformer.transform(x, y)
+            codes = raster.lookup(np.asarray(x), np.asarray(y))
+            sums += np.bincount(codes, weights=population[owner] * weight, minlength=len(sums))
+
+    totals = pd.DataFrame({'zone_id': raster.zone_ids, 'adjusted_population': sums[1:]})
+    totals.attrs['outside_population'] = float(sums[0])
+    print(f"Population outside every zone: {sums[0]:,.0f}")
+    return totals
+
+
+def compare_with_exact(raster_totals, exact_totals, zone_id='GID_1', value_col='adjusted_population'):
+    """
+    Report how far raster totals are from the exact overlay, per zone and overall.
+
+    Returns:
+        DataFrame: zone, exact, raster, abs_diff and pct_diff columns
+    """
+    comparison = exact_totals[[zone_id, value_col]].merge(
+        raster_totals.rename(columns={'zone_id': zone_id})[[zone_id, value_col]],
+        on=zone_id, how='outer', suffixes=('_exact', '_raster'),
+    ).fillna(0)
+    exact = comparison[f'{value_col}_exact']
+    raster = comparison[f'{value_col}_raster']
+    comparison['abs_diff'] = raster - exact
+    comparison['pct_diff'] = np.where(exact > 0, 100 * comparison['abs_diff'] / exact, np.nan)
+
+    total_exact, total_raster = exact.sum(), raster.sum()
+    print("\n=== Raster vs exact overlay ===")
+    print(f"Total exact:  {total_exact:,.0f}")
+    print(f"Total raster: {total_raster:,.0f} "
+          f"({100 * (total_raster - total_exact) / total_exact:+.3f}%)")
+    print(f"Median |zone diff|: {comparison['pct_diff'].abs().median():.3f}%, "
+          f"max: {comparison['pct_diff'].abs().max():.3f}%")
+    print(comparison.reindex(comparison['pct_diff'].abs().sort_values(ascending=False).index).head(5))
+    return comparison
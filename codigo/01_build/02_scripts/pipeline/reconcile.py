@@ -0,0 +1,217 @@
+"""
+Reconcile GADM-based population totals with Kontur boundary populations.
+
+Kontur publishes its own admin boundaries with a population per unit. The
+notebooks compared them with the GADM results country by country, slicing
+``hasc`` strings and summing with ``groupby(...).apply``. ``reconcile``
+does it for every country of the inputs in one pass:
+
+1. Match each Kontur department to a GADM ADM1 unit by HASC code
+   (``CO.AN`` against ``HASC_1``).
+2. Match the Kontur units left over (missing or changed codes) by spatial
+   overlap: one STRtree over the GADM polygons, and the unit covering the
+   largest share of the Kontur unit's area wins if it covers at least
+   ``MIN_OVERLAP``.
+3. Sum both populations per GADM unit and per country with plain groupbys,
+   and flag departments whose log ratio is an outlier (robust z-score over
+   all departments) or whose difference exceeds ``PCT_TOLERANCE``.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+
+from pipeline.admin_layer import make_valid_polygons
+
+KONTUR_LEVEL_COL = 'admin_level'
+KONTUR_DEPARTMENT_LEVEL = 4  # OSM admin_level of departments/states/provinces
+MIN_OVERLAP = 0.5
+OUTLIER_Z = 3.5
+PCT_TOLERANCE = 25  # percent difference flagged regardless of the z-score
+COUNTRY_PCT_TOLERANCE = 5
+
+
+def normalize_hasc(codes):
+    """Upper-case HASC codes without spaces; missing or empty codes become NaN."""
+    codes = pd.Series(codes, dtype='object').str.strip().str.upper()
+    return codes.where(codes.str.len() > 0)
+
+
+def kontur_departments(kontur, level=KONTUR_DEPARTMENT_LEVEL, level_col=KONTUR_LEVEL_COL):
+    """Department-level Kontur units (``admin_level`` or ``osm_admin_level`` == ``level``)."""
+    if level_col not in kontur.columns:
+        level_col = 'osm_admin_level'
+    levels = pd.to_numeric(kontur[level_col], errors='coerce')
+    return kontur[levels == level].reset_index(drop=True)
+
+
+def match_units(kontur, gadm, area_crs, min_overlap=MIN_OVERLAP, kontur_hasc='hasc',
+                gadm_hasc='HASC_1', gadm_id='GID_1'):
+    """
+    Match Kontur units to GADM units, by HASC code first and by overlap after.
+
+    Args:
+        kontur (GeoDataFrame): Kontur units with ``kontur_hasc``
+        gadm (GeoDataFrame): GADM units with ``gadm_id`` and ``gadm_hasc``
+        area_crs: Equal-area CRS for the overlap shares
+
+    Returns:
+        DataFrame: One row per Kontur unit with ``gadm_id`` (NaN if unmatched),
+        ``match`` ('hasc', 'overlap' or 'unmatched') and ``overlap_share``
+    """
+    matches = pd.DataFrame({gadm_id: pd.Series(np.nan, index=kontur.index, dtype='object'),
+                            'match': 'unmatched', 'overlap_share': np.nan})
+
+    # 1. HASC codes, where they identify a single GADM unit
+    if gadm_hasc in gadm.columns and kontur_hasc in kontur.columns:
+        codes = pd.DataFrame({'hasc': normalize_hasc(gadm[gadm_hasc].to_numpy()),
+                              gadm_id: gadm[gadm_id].to_numpy()}).dropna()
+        codes = codes.drop_duplicates('hasc', keep=False).set_index('hasc')[gadm_id]
+        by_code = normalize_hasc(kontur[kontur_hasc].to_numpy()).map(codes)
+        by_code.index = kontur.index
+        hit = by_code.notna()
+        matches.loc[hit, gadm_id] = by_code[hit]
+        matches.loc[hit, 'match'] = 'hasc'
+
+    # 2. Largest overlap for the rest
+    rest = np.flatnonzero(matches['match'].to_numpy() == 'unmatched')
+    if len(rest):
+        kontur_geoms, _ = make_valid_polygons(kontur.geometry.to_crs(area_crs).to_numpy()[rest])
+        gadm_geoms, _ = make_valid_polygons(gadm.geometry.to_crs(area_crs).to_numpy())
+        tree = shapely.STRtree(gadm_geoms)
+        k_pos, g_pos = tree.query(kontur_geoms, predicate='intersects')
+        shares = (shapely.area(shapely.intersection(kontur_geoms[k_pos], gadm_geoms[g_pos]))
+                  / shapely.area(kontur_geoms[k_pos]))
+        pairs = pd.DataFrame({'k': k_pos, 'g': g_pos, 'share': shares})
+        best = pairs.sort_values('share', ascending=False).drop_duplicates('k')
+        best = best[best['share'] >= min_overlap]
+        rows = kontur.index[rest[best['k'].to_numpy()]]
+        matches.loc[rows, gadm_id] = gadm[gadm_id].to_numpy()[best['g'].to_numpy()]
+        matches.loc[rows, 'match'] = 'overlap'
+        matches.loc[rows, 'overlap_share'] = best['share'].to_numpy()
+
+    counts = matches['match'].value_counts()
+    print(f"Matched {len(kontur):,} Kontur units: {counts.get('hasc', 0):,} by HASC, "
+          f"{counts.get('overlap', 0):,} by overlap, {counts.get('unmatched', 0):,} unmatched")
+    return matches
+
+
+def robust_z(values):
+    """(x - median) / (1.4826 * MAD), NaN where the spread is zero."""
+    values = pd.Series(values, dtype='float64')
+    median = values.median()
+    mad = 1.4826 * (values - median).abs().median()
+    return (values - median) / mad if mad > 0 else values * np.nan
+
+
+def reconcile(kontur, gadm, area_crs, value_col='adjusted_population', kontur_value='population',
+              min_overlap=MIN_OVERLAP, outlier_z=OUTLIER_Z, pct_tolerance=PCT_TOLERANCE):
+    """
+    Department and country discrepancies between GADM totals and Kontur boundaries.
+
+    Args:
+        kontur (GeoDataFrame): Kontur department units (see ``kontur_departments``)
+        gadm (GeoDataFrame): GADM ADM1 results with GID_0, GID_1, HASC_1 and ``value_col``
+        area_crs: Equal-area CRS for the overlap fallback
+
+    Returns:
+        tuple: (departments, countries) DataFrames with ``gadm_population``,
+        ``kontur_population``, ``difference``, ``pct_difference`` and the
+        ``outlier`` flag; departments also carry ``match``, ``kontur_units``,
+        ``log_ratio`` and ``robust_z``, plus one row per unmatched Kontur unit
+    """
+    matches = match_units(kontur, gadm, area_crs, min_overlap=min_overlap)
+    units = pd.DataFrame({
+        'GID_1': matches['GID_1'],
+        'match': matches['match'],
+        'kontur_name': kontur['name'].to_numpy() if 'name' in kontur.columns else None,
+        'kontur_hasc': kontur['hasc'].to_numpy() if 'hasc' in kontur.columns else None,
+        'kontur_population': kontur[kontur_value].to_numpy(dtype='float64'),
+    })
+
+    # Several Kontur units can fall on one GADM unit (overlap matches)
+    matched = units.assign(all_hasc=units['match'] == 'hasc')[units['match'] != 'unmatched']
+    kontur_totals = matched.groupby('GID_1', as_index=False).agg(
+        kontur_population=('kontur_population', 'sum'),
+        kontur_units=('kontur_population', 'size'),
+        all_hasc=('all_hasc', 'all'),
+    )
+    kontur_totals['match'] = np.where(kontur_totals.pop('all_hasc'), 'hasc', 'overlap')
+    for col in ('kontur_name', 'kontur_hasc'):
+        kontur_totals[col] = kontur_totals['GID_1'].map(joined_values(matched, 'GID_1', col))
+    name_cols = [col for col in ('NAME_1', 'HASC_1') if col in gadm.columns]
+    departments = pd.DataFrame(gadm[['GID_0', 'GID_1'] + name_cols + [value_col]]).rename(
+        columns={value_col: 'gadm_population'})
+    departments = departments.merge(kontur_totals, on='GID_1', how='left')
+    departments['match'] = departments['match'].fillna('unmatched')
+    departments['kontur_units'] = departments['kontur_units'].fillna(0).astype('int64')
+
+    # Kontur units with no GADM counterpart, kept so nothing disappears silently
+    unmatched = units[units['match'] == 'unmatched']
+    if len(unmatched):
+        country = normalize_hasc(unmatched['kontur_hasc'].to_numpy()).str[:2].map(iso2_to_gid0(gadm))
+        departments = pd.concat([departments, pd.DataFrame({
+            'GID_0': country.to_numpy(),
+            'match': 'kontur_only',
+            'kontur_population': unmatched['kontur_population'].to_numpy(),
+            'kontur_units': 1,
+            'kontur_name': unmatched['kontur_name'].to_numpy(),
+            'kontur_hasc': unmatched['kontur_hasc'].to_numpy(),
+        })], ignore_index=True)
+
+    add_discrepancy(departments)
+    both = departments['gadm_population'].gt(0) & departments['kontur_population'].gt(0)
+    departments['log_ratio'] = np.log(departments['gadm_population'].where(both)
+                                      / departments['kontur_population'].where(both))
+    departments['robust_z'] = robust_z(departments['log_ratio'])
+    departments['outlier'] = (departments['robust_z'].abs() > outlier_z) | (
+        departments['pct_difference'].abs() > pct_tolerance)
+
+    is_matched = departments['match'].isin(['hasc', 'overlap'])
+    countries = departments.assign(is_matched=is_matched).groupby(
+        'GID_0', as_index=False, dropna=False).agg(
+        gadm_population=('gadm_population', 'sum'),
+        kontur_population=('kontur_population', 'sum'),
+        departments=('GID_1', 'count'),
+        matched=('is_matched', 'sum'),
+        outliers=('outlier', 'sum'),
+    )
+    add_discrepancy(countries)
+    countries['outlier'] = countries['pct_difference'].abs() > COUNTRY_PCT_TOLERANCE
+    print(f"{departments['outlier'].sum():,} of {len(departments):,} departments and "
+          f"{countries['outlier'].sum():,} of {len(countries):,} countries flagged")
+    return departments, countries
+
+
+def joined_values(frame, key, col, sep='; '):
+    """
+    Non-missing ``col`` values of each ``key``, joined with ``sep``.
+
+    Most keys have a single value, which is taken as is; only the keys with
+    several values are grouped and joined.
+    """
+    values = frame[[key, col]].dropna()
+    values[col] = values[col].astype(str)
+    several = values[key].duplicated(keep=False)
+    return pd.concat([
+        values[~several].set_index(key)[col],
+        values[several].groupby(key)[col].agg(sep.join),
+    ])
+
+
+def add_discrepancy(frame):
+    """``difference`` (GADM - Kontur) and ``pct_difference`` relative to Kontur, in place."""
+    frame['difference'] = frame['gadm_population'].fillna(0) - frame['kontur_population'].fillna(0)
+    frame['pct_difference'] = 100 * frame['difference'] / frame['kontur_population'].where(
+        frame['kontur_population'] > 0)
+
+
+def iso2_to_gid0(gadm, hasc_col='HASC_1'):
+    """ISO2 prefix of the HASC codes -> GID_0, from the GADM units themselves."""
+    if hasc_col not in gadm.columns:
+        return {}
+    prefix = normalize_hasc(gadm[hasc_col].to_numpy()).str[:2]
+    pairs = pd.DataFrame({'iso2': prefix.to_numpy(), 'GID_0': gadm['GID_0'].to_numpy()}).dropna()
+    # Most frequent GID_0 per prefix (ties: the first in sort order, as Series.mode)
+    counts = pairs.groupby(['iso2', 'GID_0']).size().reset_index(name='units')
+    mode = counts.sort_values(['iso2', 'units', 'GID_0'], ascending=[True, False, True])
+    return mode.drop_duplicates('iso2').set_index('iso2')['GID_0'].to_dict()
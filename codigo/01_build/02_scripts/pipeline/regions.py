@@ -0,0 +1,72 @@
+"""
+Regions the build pipeline knows how to run.
+
+Each entry lists the GADM countries assembled into the region's admin
+GeoPackage, the Kontur population file and boundaries, the equal-area CRS used for areas
+and, where available, the inputs of the road density step. Paths are
+relative to ``datos/`` (inputs) or ``codigo/01_build/03_output`` (admin
+layers built by ``build.py admin``).
+
+The admin GeoPackages are files of their own (``*_admin_levels.gpkg``, one
+``ADM_ADM_<level>`` layer per level): the single-layer files and the GADM
+download the standalone scripts read are never rewritten.
+"""
+from pathlib import Path
+
+work_dir = Path(Path(__file__).parent.parent.parent.parent.parent)
+output_path = Path(Path(__file__).parent.parent.parent, '03_output')
+data_path = Path(work_dir, 'datos')
+
+SOUTH_AMERICA = ['ARG', 'BOL', 'BRA', 'CHL', 'COL', 'ECU', 'GUF', 'GUY', 'PRY', 'PER',
+                 'SUR', 'URY', 'VEN']
+
+AFRICA = [
+    'DZA', 'AGO', 'BEN', 'BWA', 'BFA', 'BDI', 'CMR', 'CPV', 'CAF', 'TCD',
+    'COM', 'COG', 'COD', 'DJI', 'EGY', 'GNQ', 'ERI', 'ETH', 'GAB', 'GMB',
+    'GHA', 'GIN', 'GNB', 'CIV', 'KEN', 'LSO', 'LBR', 'LBY', 'MDG', 'MWI',
+    'MLI', 'MRT', 'MUS', 'MAR', 'MOZ', 'NAM', 'NER', 'NGA', 'RWA', 'STP',
+    'SEN', 'SYC', 'SLE', 'SOM', 'ZAF', 'SSD', 'SDN', 'SWZ', 'TZA', 'TGO',
+    'TUN', 'UGA', 'ZMB', 'ZWE',
+]
+
+REGIONS = {
+    'COL': {
+        'countries': ['COL'],
+        'admin': output_path / 'COL_admin_levels.gpkg',
+        'population': data_path / 'spatial' / 'kontur_population_CO_20231101.gpkg',
+        'area_crs': 'esri:102033',  # South America Albers Equal Area Conic
+        'kontur_boundaries': data_path / 'spatial' / 'kontur_boundaries_CO_20230628.gpkg',
+        'roads': {
+            'zones': data_path / 'spatial' / 'MGN2023_DPTO_POLITICO' / 'MGN_ADM_DPTO_POLITICO.shp',
+            'zone_id': 'dpto_ccdgo',
+            'roads': data_path / 'spatial' / 'colombia_roads.gpkg',
+            'population': data_path / 'population' / 'colombia' / 'kontur_population_CO_20231101.gpkg',
+            'tolls': data_path / 'spatial' / 'Peajes_data.csv',
+            'tolls_crs': 'EPSG:4686',
+            # Road km per Kontur hexagon (03_calculate_road_density_hex.R)
+            'hex_roads': data_path / 'spatial' / 'colombia-hex_road_pop.parquet',
+        },
+    },
+    'southamerica': {
+        'countries': SOUTH_AMERICA,
+        'admin': output_path / 'southamerica_admin_levels.gpkg',
+        'population': data_path / 'spatial' / 'kontur_population_bboxsouthamerica.gpkg',
+        'area_crs': 'esri:102033',
+        'kontur_boundaries': data_path / 'spatial' / 'kontur_boundaries_southamerica_20230628.gpkg',
+    },
+    'africa': {
+        'countries': AFRICA,
+        'admin': output_path / 'africa_admin_levels.gpkg',
+        'population': data_path / 'spatial' / 'kontur_population_world.gpkg',
+        'area_crs': 'esri:102022',  # Africa Albers Equal Area Conic
+        'kontur_boundaries': data_path / 'spatial' / 'kontur_boundaries_africa_20230628.gpkg',
+    },
+}
+
+
+def get_region(name):
+    """Return the region entry, with a readable error for unknown names."""
+    try:
+        return REGIONS[name]
+    except KeyError:
+        raise ValueError(f"Unknown region {name!r}; choose one of {sorted(REGIONS)}") from None
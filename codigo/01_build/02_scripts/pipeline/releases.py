@@ -0,0 +1,209 @@
+"""
+Incremental updates between Kontur population releases.
+
+A new Kontur release changes the population of a minority of cells and adds
+or drops a few more. Instead of rerunning the overlay, ``diff_releases``
+reads only the ``h3`` and population columns of both files and keeps the
+cells whose population changed. The deltas are then spread over admin units
+with the cached share of each cell per unit (``cell_shares``, the overlay's
+area fractions), so only cells new in the later release are intersected
+(``added_cell_shares``).
+
+``change_report`` applies the deltas to the previous per-unit totals and
+rolls them up the admin hierarchy (e.g. municipality, department, country).
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+from tqdm import tqdm
+
+from pipeline.admin_hierarchy import gid_columns, rollup_hierarchy
+from pipeline.hextable import DEFAULT_READ_BATCH, h3_to_uint64
+
+
+def read_release(pop_path, value_col='population', h3_col='h3', read_batch=DEFAULT_READ_BATCH):
+    """
+    Read a release's cells without geometry.
+
+    Returns:
+        DataFrame: uint64 ``h3``, float64 ``population`` and the feature ``fid``
+    """
+    parts = []
+    with pyogrio.open_arrow(pop_path, batch_size=read_batch, columns=[h3_col, value_col],
+                            read_geometry=False, return_fids=True,
+                            use_pyarrow=True) as (meta, reader):
+        fid_col = meta.get('fid_column') or 'fid'
+        for batch in tqdm(reader, desc=f"Reading {Path(pop_path).name}"):
+            parts.append(pd.DataFrame({
+                'h3': h3_to_uint64(batch.column(h3_col).to_numpy(zero_copy_only=False)),
+                'population': batch.column(value_col).to_numpy(zero_copy_only=False).astype('float64'),
+                'fid': batch.column(fid_col).to_numpy(zero_copy_only=False).astype('int64'),
+            }))
+    if not parts:
+        return pd.DataFrame({'h3': np.zeros(0, dtype=np.uint64), 'population': np.zeros(0),
+                             'fid': np.zeros(0, dtype=np.int64)})
+    return pd.concat(parts, ignore_index=True)
+
+
+def diff_releases(old_path, new_path, value_col='population', h3_col='h3', tolerance=0.0):
+    """
+    Cells whose population differs between two releases.
+
+    Args:
+        old_path, new_path (Path): Kontur GeoPackages
+        tolerance (float): Absolute change below which a cell counts as unchanged
+
+    Returns:
+        DataFrame: ``h3``, ``fid`` (in the new release), ``old_population``,
+        ``new_population``, ``delta`` and ``status`` ('added', 'removed' or
+        'changed')
+    """
+    old = read_release(old_path, value_col, h3_col).rename(columns={'population': 'old_population'})
+    new = read_release(new_path, value_col, h3_col).rename(columns={'population': 'new_population'})
+    cells = old.drop(columns='fid').merge(new, on='h3', how='outer', indicator=True)
+
+    cells['status'] = cells['_merge'].map({'left_only': 'removed', 'right_only': 'added',
+                                           'both': 'changed'}).astype(str)
+    cells[['old_population', 'new_population']] = cells[['old_population', 'new_population']].fillna(0.0)
+    cells['delta'] = cells['new_population'] - cells['old_population']
+    changes = cells[(cells['status'] != 'changed') | (cells['delta'].abs() > tolerance)]
+    changes = changes.drop(columns='_merge').reset_index(drop=True)
+
+    counts = changes['status'].value_counts()
+    print(f"Release diff: {len(old):,} -> {len(new):,} cells; "
+          f"{counts.get('changed', 0):,} changed, {counts.get('added', 0):,} added, "
+          f"{counts.get('removed', 0):,} removed; net {changes['delta'].sum():+,.0f} people")
+    return changes
+
+
+def cell_shares(pieces, zone_id, h3_col='h3'):
+    """
+    Share of each cell's population going to each unit.
+
+    Args:
+        pieces (DataFrame): Overlay pieces with ``h3_col``, ``zone_id`` and ``area_fraction``
+
+    Returns:
+        DataFrame: uint64 ``h3``, ``zone_id`` and float32 ``share``; shares of a
+        cell sum to less than 1 where part of it lies outside every unit
+    """
+    shares = pd.DataFrame({
+        'h3': h3_to_uint64(pieces[h3_col].to_numpy()),
+        zone_id: pieces[zone_id].to_numpy(),
+        'share': pieces['area_fraction'].to_numpy(),
+    })
+    shares = shares.groupby(['h3', zone_id], as_index=False, sort=False)['share'].sum()
+    shares['share'] = shares['share'].astype('float32')
+    return shares
+
+
+def added_cell_shares(pop_path, fids, admin_layer, zone_id):
+    """
+    Intersect only the given cells of a release with the admin layer.
+
+    Args:
+        pop_path (Path): Release holding the cells
+        fids (array): Feature ids of the cells (``diff_releases``' ``fid``)
+        admin_layer (AdminLayer): Finest admin level
+
+    Returns:
+        DataFrame: As ``cell_shares``
+    """
+    if len(fids) == 0:
+        return pd.DataFrame({'h3': np.zeros(0, dtype=np.uint64), zone_id: [],
+                             'share': np.zeros(0, dtype=np.float32)})
+    cells = pyogrio.read_dataframe(pop_path, fids=np.asarray(fids)).to_crs(admin_layer.crs)
+    # Same convention as the batch overlay: areas in the admin layer's CRS
+    cells['hex_area'] = cells.geometry.area
+    pieces = admin_layer.intersect(cells)
+    pieces['area_fraction'] = shapely.area(pieces.geometry.to_numpy()) / pieces['hex_area']
+    print(f"Intersected {len(cells):,} new cells: {len(pieces):,} pieces")
+    return cell_shares(pieces, zone_id)
+
+
+def update_shares(shares, changes, added):
+    """Shares for the new release: drop removed cells, add the new ones."""
+    removed = changes.loc[changes['status'] == 'removed', 'h3'].to_numpy()
+    kept = shares[~np.isin(shares['h3'].to_numpy(), removed)]
+    return pd.concat([kept, added], ignore_index=True)
+
+
+def zone_deltas(changes, shares, zone_id):
+    """
+    Population change per unit.
+
+    Returns:
+        DataFrame: ``zone_id`` and ``population_delta``, with the change
+        falling outside every unit in ``.attrs['outside_delta']``
+    """
+    pieces = changes[['h3', 'delta']].merge(shares, on='h3', how='inner')
+    pieces['population_delta'] = pieces['delta'] * pieces['share'].astype('float64')
+    deltas = pieces.groupby(zone_id, as_index=False)['population_delta'].sum()
+    deltas.attrs['outside_delta'] = float(changes['delta'].sum() - deltas['population_delta'].sum())
+    print(f"Population change outside every zone: {deltas.attrs['outside_delta']:+,.0f}")
+    return deltas
+
+
+def changed_cell_counts(changes, shares, admin_divisions, finest_level, levels):
+    """
+    Changed cells per unit at every level.
+
+    A cell split between two units counts once in each, but once in their
+    common parent, so the counts are taken per level from the distinct
+    (cell, unit) pairs rather than summed from the finest level.
+
+    Returns:
+        dict: level -> DataFrame with ``GID_<level>`` and ``changed_cells``
+    """
+    gid_col = f'GID_{finest_level}'
+    units = admin_divisions[gid_columns(finest_level)].drop_duplicates(gid_col)
+    pairs = changes[['h3']].merge(shares[['h3', gid_col]], on='h3', how='inner')
+    pairs = pairs.merge(units, on=gid_col, how='inner')
+    return {
+        level: pairs.groupby(f'GID_{level}', as_index=False, observed=True)['h3'].nunique()
+        .rename(columns={'h3': 'changed_cells'})
+        for level in levels
+    }
+
+
+def change_report(admin_divisions, finest_level, baseline, deltas, levels, cell_counts,
+                  value_col='adjusted_population'):
+    """
+    Apply per-unit deltas to the previous totals and roll them up.
+
+    Args:
+        admin_divisions (DataFrame): Finest level with its ancestor GIDs
+        baseline (DataFrame): Previous totals with ``GID_<finest>`` and ``value_col``
+        deltas (DataFrame): ``zone_deltas`` on ``GID_<finest>``
+        levels (iterable): Admin levels to report
+        cell_counts (dict): ``changed_cell_counts`` for the same levels
+
+    Returns:
+        dict: level -> DataFrame with the GID columns, ``old_population``,
+        ``new_population``, ``population_delta``, ``pct_change``,
+        ``changed_cells`` and ``value_col`` (the new total, for
+        ``attach_rollups``)
+    """
+    gid_col = f'GID_{finest_level}'
+    units = admin_divisions[gid_columns(finest_level)].drop_duplicates(gid_col)
+    units = units.merge(baseline[[gid_col, value_col]].rename(columns={value_col: 'old_population'}),
+                        on=gid_col, how='left')
+    units = units.merge(deltas, on=gid_col, how='left')
+    units[['old_population', 'population_delta']] = (
+        units[['old_population', 'population_delta']].fillna(0)
+    )
+    units['new_population'] = units['old_population'] + units['population_delta']
+
+    rollups = rollup_hierarchy(units, levels, value_cols=['old_population', 'new_population',
+                                                          'population_delta'])
+    for level, totals in rollups.items():
+        totals['pct_change'] = 100 * totals['population_delta'] / totals['old_population'].where(
+            totals['old_population'] != 0)
+        totals = totals.merge(cell_counts[level], on=f'GID_{level}', how='left')
+        totals['changed_cells'] = totals['changed_cells'].fillna(0).astype('int64')
+        totals[value_col] = totals['new_population']
+        rollups[level] = totals
+    return rollups
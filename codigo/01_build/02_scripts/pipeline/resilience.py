@@ -0,0 +1,260 @@
+"""
+Failure isolation, retries and a per-chunk ledger for the overlay pool.
+
+A chunk that raises in a worker is not dropped. It is retried once after
+repairing its geometries (``make_valid``, or ``buffer(0)`` when nothing is
+flagged invalid), then split in halves until the failing hexagons are
+isolated. Every chunk outcome goes into a ``ChunkLedger``; with a directory
+the ledger and each successful chunk result are persisted, so a rerun loads
+finished chunks and only recomputes the ones that failed.
+``ChunkLedger.conservation_report`` compares the population that went into
+the chunks with what came out and raises ``ConservationError`` if any
+hexagon could not be processed.
+"""
+from pathlib import Path
+import hashlib
+import json
+import time
+import warnings
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from pipeline.hexstore import load_hexes, split_hexes
+
+
+class ConservationError(RuntimeError):
+    """Raised when some hexagons could not be apportioned to any admin unit."""
+
+
+def chunk_key(prefix, index):
+    """Stable key for a chunk from its batch prefix and hexagon index values."""
+    hashed = pd.util.hash_pandas_object(pd.Series(np.asarray(index)), index=False)
+    digest = hashlib.blake2b(hashed.to_numpy().tobytes(), digest_size=8).hexdigest()
+    return f"{prefix}-{digest}"
+
+
+def apportioned_population(pieces, pop_col='population'):
+    """Population carried by overlay pieces (area-weighted when ``hex_area`` is present)."""
+    if pieces is None or len(pieces) == 0:
+        return 0.0
+    if 'hex_area' in pieces.columns:
+        # Same CRS as hex_area, so the fraction is right even in degrees
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            area = pieces.geometry.area
+        return float((pieces[pop_col] * area / pieces['hex_area']).sum())
+    return float(pieces[pop_col].sum())
+
+
+def repair_geometries(gdf):
+    """
+    Return a copy with invalid geometries fixed.
+
+    Invalid geometries go through ``make_valid`` keeping only polygonal parts
+    (``buffer(0)`` on shapely < 2.1). If none is flagged invalid, every
+    geometry is passed through ``buffer(0)``, which also clears most
+    robustness errors GEOS reports on technically valid input.
+    """
+    geoms = gdf.geometry.values.copy()
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        try:
+            fixed = shapely.make_valid(geoms[invalid], method='structure', keep_collapsed=False)
+        except TypeError:
+            fixed = shapely.buffer(geoms[invalid], 0)
+        geoms[invalid] = fixed
+    else:
+        geoms = shapely.buffer(geoms, 0)
+    repaired = gdf.copy()
+    repaired.geometry = gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs)
+    return repaired
+
+
+class ChunkLedger:
+    """
+    Outcome of every chunk: ok, split (superseded by its halves) or failed.
+
+    Args:
+        ledger_dir (Path or str): Directory for ``ledger.jsonl`` and the
+            ``results/<key>.parquet`` of finished chunks. None keeps the
+            ledger in memory only (no reuse across runs).
+        pop_col (str): Population column used for the conservation report
+    """
+
+    def __init__(self, ledger_dir=None, pop_col='population'):
+        self.ledger_dir = Path(ledger_dir) if ledger_dir else None
+        self.pop_col = pop_col
+        self.entries = {}
+        self.session = []  # entries recorded or reused in this run, in order
+        if self.ledger_dir is not None:
+            (self.ledger_dir / 'results').mkdir(parents=True, exist_ok=True)
+            ledger_file = self.ledger_dir / 'ledger.jsonl'
+            if ledger_file.exists():
+                with open(ledger_file) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        self.entries[entry['key']] = entry
+                done = sum(entry['status'] == 'ok' for entry in self.entries.values())
+                print(f"Chunk ledger {self.ledger_dir}: {done} finished chunks from earlier runs")
+
+    def done(self, key):
+        return self.entries.get(key, {}).get('status') == 'ok'
+
+    def load(self, key):
+        """Reuse a finished chunk: record it in this session and return its result."""
+        entry = self.entries[key]
+        self.session.append({**entry, 'reused': True})
+        if entry.get('result') is None:
+            return None
+        return gpd.read_parquet(self.ledger_dir / 'results' / entry['result'])
+
+    def record(self, key, status, hexes, result=None, attempt='initial', error=None, seconds=None):
+        entry = {
+            'key': key,
+            'status': status,
+            'attempt': attempt,
+            'rows': len(hexes),
+            'input_population': float(hexes[self.pop_col].sum()),
+            'output_population': apportioned_population(result, self.pop_col),
+            'error': error,
+            'seconds': seconds,
+            'result': None,
+            'ts': time.time(),
+        }
+        if status == 'ok' and result is not None and len(result) and self.ledger_dir is not None:
+            entry['result'] = f"{key}.parquet"
+            result.to_parquet(self.ledger_dir / 'results' / entry['result'])
+        self.entries[key] = entry
+        self.session.append(entry)
+        if self.ledger_dir is not None:
+            with open(self.ledger_dir / 'ledger.jsonl', 'a') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
+        return entry
+
+    def summary(self):
+        """Entries of this run as a DataFrame (one row per chunk attempt)."""
+        return pd.DataFrame(self.session)
+
+    def conservation_report(self, raise_on_failure=True):
+        """
+        Print population in vs out for this run and fail if coverage is incomplete.
+
+        ``output_population`` is lower than ``input_population`` for hexagons
+        partly outside every admin polygon (coasts, borders); failed chunks
+        are the population that was never apportioned at all.
+        """
+        entries = self.summary()
+        if entries.empty:
+            print("Chunk ledger is empty")
+            return entries
+        final = entries[entries['status'].isin(['ok', 'failed'])]
+        ok = final[final['status'] == 'ok']
+        failed = final[final['status'] == 'failed']
+        retried = entries.loc[entries['attempt'] != 'initial', 'key'].nunique()
+        reused = int(entries['reused'].eq(True).sum()) if 'reused' in entries else 0
+
+        input_pop = final['input_population'].sum()
+        print("\n=== Population conservation ===")
+        print(f"Chunks: {len(ok):,} ok ({reused:,} reused from ledger), "
+              f"{retried:,} retried, {len(failed):,} failed")
+        print(f"Input population:       {input_pop:,.0f}")
+        print(f"Apportioned population: {ok['output_population'].sum():,.0f} "
+              f"({ok['input_population'].sum() - ok['output_population'].sum():,.0f} outside admin polygons)")
+        print(f"Failed population:      {failed['input_population'].sum():,.0f} "
+              f"in {failed['rows'].sum():,} hexagons")
+
+        if len(failed):
+            print(failed[['key', 'rows', 'input_population', 'error']].to_string(index=False))
+            if self.ledger_dir is not None:
+                print(f"Rerun to retry only these chunks (ledger: {self.ledger_dir})")
+            if raise_on_failure:
+                raise ConservationError(
+                    f"{len(failed)} chunks failed; {failed['input_population'].sum():,.0f} "
+                    f"population was not apportioned"
+                )
+        return entries
+
+
+def _next_attempts(chunk, error, ledger, seconds):
+    """Repair first, then split in halves; record a leaf that cannot be split as failed."""
+    if chunk['attempt'] == 'initial':
+        ledger.record(chunk['key'], 'retry', chunk['hexes'], attempt='initial', error=error,
+                      seconds=seconds)
+        return [{
+            **chunk,
+            'hexes': repair_geometries(load_hexes(chunk['hexes'])),
+            # None: the worker's shared admin layer, already repaired on load
+            'admin': None if chunk['admin'] is None else repair_geometries(chunk['admin']),
+            'attempt': 'repaired',
+        }]
+
+    if len(chunk['hexes']) > 1:
+        ledger.record(chunk['key'], 'split', chunk['hexes'], attempt=chunk['attempt'],
+                      error=error, seconds=seconds)
+        return [
+            {**chunk, 'key': f"{chunk['key']}.{i}", 'hexes': part, 'attempt': 'split'}
+            for i, part in enumerate(split_hexes(chunk['hexes']))
+        ]
+
+    ledger.record(chunk['key'], 'failed', chunk['hexes'], attempt=chunk['attempt'],
+                  error=error, seconds=seconds)
+    return []
+
+
+def run_chunks(pool, runner, func, chunks, ledger, on_result=None):
+    """
+    Run chunks on ``pool`` with failure isolation and retries.
+
+    Args:
+        pool: ``multiprocessing.Pool``
+        runner: ``timed_call`` or a profiling runner (must return ``error``)
+        func: Worker function taking ``(hexes, admin)``
+        chunks (list): Dicts with ``key``, ``hexes`` (GeoDataFrame or ``HexRange``)
+            and ``admin``
+        ledger (ChunkLedger): Receives every outcome; finished keys are reused
+        on_result (callable): Called as ``on_result(timing, chunk, result)``
+            for every attempt (instrumentation, progress)
+
+    Returns:
+        list: Non-empty results of all chunks that succeeded
+    """
+    results = []
+    pending = []
+    for chunk in chunks:
+        if ledger.done(chunk['key']):
+            result = ledger.load(chunk['key'])
+            if result is not None:
+                results.append(result)
+        else:
+            pending.append({**chunk, 'attempt': 'initial'})
+
+    while pending:
+        tasks = [(func, (chunk['hexes'], chunk['admin']), i) for i, chunk in enumerate(pending)]
+        retries = []
+        for timing in pool.imap_unordered(runner, tasks):
+            chunk = pending[timing['tag']]
+            result = timing.pop('result')
+            if on_result is not None:
+                on_result(timing, chunk, result)
+            if timing['error'] is None:
+                ledger.record(chunk['key'], 'ok', chunk['hexes'], result=result,
+                              attempt=chunk['attempt'], seconds=timing['seconds'])
+                if result is not None:
+                    results.append(result)
+            else:
+                print(f"Chunk {chunk['key']} ({len(chunk['hexes'])} rows, {chunk['attempt']}) "
+                      f"failed: {timing['error']}")
+                retries.extend(_next_attempts(chunk, timing['error'], ledger, timing['seconds']))
+
+        pending = []
+        for chunk in retries:
+            if ledger.done(chunk['key']):
+                result = ledger.load(chunk['key'])
+                if result is not None:
+                    results.append(result)
+            else:
+                pending.append(chunk)
+    return results
@@ -0,0 +1,166 @@
+"""
+Cost-aware chunking of hexagons for the overlay pool.
+
+Fixed-size chunks in file order mix cheap interior hexagons with expensive
+boundary ones, so a few chunks along coastlines or dense borders finish long
+after the others and the pool idles at the tail. Here every hexagon gets an
+estimated overlay cost (the vertex count of the admin polygons whose bounding
+boxes it touches), the batch is cut into coarse spatial tiles, and any tile
+above the cost threshold is split recursively at its cost-weighted median
+until it fits. Tasks are dispatched most expensive first to a pool that pulls
+one task at a time, so idle workers take the remaining small tasks while the
+long ones run. Each task carries only the admin polygons it can touch.
+
+``report_chunk_runtimes`` summarizes the per-chunk runtimes (percentiles,
+worker idle time at the tail, cost/runtime correlation).
+"""
+import numpy as np
+import pandas as pd
+import shapely
+
+TASKS_PER_WORKER = 4  # target number of tasks per worker after splitting
+MIN_TASK_ROWS = 50    # never split below this many hexagons
+
+
+def hexagon_costs(hexes, admin):
+    """
+    Estimate the overlay cost of each hexagon.
+
+    Args:
+        hexes (GeoDataFrame): Hexagons, in the admin CRS
+        admin (GeoDataFrame): Admin polygons
+
+    Returns:
+        tuple: (cost per hexagon, hexagon positions, admin positions) where the
+        last two are the bounding-box candidate pairs from the admin sindex
+    """
+    hex_pos, admin_pos = admin.sindex.query(hexes.geometry.values)
+    vertices = shapely.get_num_coordinates(admin.geometry.values).astype('float64')
+    cost = np.bincount(hex_pos, weights=vertices[admin_pos], minlength=len(hexes))
+    return cost, hex_pos, admin_pos
+
+
+def _split(positions, x, y, cost):
+    """Halve a tile along its longer axis at the cost-weighted median."""
+    px, py = x[positions], y[positions]
+    coord = px if np.ptp(px) >= np.ptp(py) else py
+    order = np.argsort(coord, kind='stable')
+    cumulative = np.cumsum(cost[positions][order])
+    cut = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+    cut = min(max(cut, 1), len(positions) - 1)
+    return positions[order[:cut]], positions[order[cut:]]
+
+
+def plan_tasks(hexes, admin, num_workers, max_rows=5000, cost_threshold=None,
+               tiles_per_axis=None, min_rows=MIN_TASK_ROWS):
+    """
+    Cut hexagons into spatial tasks of bounded estimated cost.
+
+    Args:
+        hexes (GeoDataFrame): Hexagons to overlay (same CRS as ``admin``)
+        admin (GeoDataFrame): Admin polygons
+        num_workers (int): Pool size
+        max_rows (int): Upper bound on hexagons per task
+        cost_threshold (float): Split tiles whose estimated cost exceeds this
+            (default: total cost / (num_workers * TASKS_PER_WORKER))
+        tiles_per_axis (int): Coarse tiles per axis before splitting
+            (default: ceil(sqrt(num_workers)))
+        min_rows (int): Tiles with this many hexagons or fewer are never split
+
+    Returns:
+        list: Dicts with ``rows`` (positions in ``hexes``), ``admin_rows``
+        (positions in ``admin``) and ``cost``, most expensive first.
+        Hexagons touching no admin bounding box are left out.
+    """
+    cost, hex_pos, admin_pos = hexagon_costs(hexes, admin)
+    covered = np.zeros(len(hexes), dtype=bool)
+    covered[hex_pos] = True
+    # Every hexagon also pays a fixed per-row cost (pandas, pickling)
+    cost = np.where(covered, cost + 1, 0)
+
+    centroids = shapely.centroid(hexes.geometry.values)
+    x, y = shapely.get_x(centroids), shapely.get_y(centroids)
+    candidates = np.flatnonzero(covered)
+    if len(candidates) == 0:
+        return []
+
+    tiles_per_axis = tiles_per_axis or max(1, int(np.ceil(np.sqrt(num_workers))))
+    threshold = cost_threshold or cost.sum() / (num_workers * TASKS_PER_WORKER)
+
+    xmin, xmax = x[candidates].min(), x[candidates].max()
+    ymin, ymax = y[candidates].min(), y[candidates].max()
+    tile_w = (xmax - xmin) / tiles_per_axis or 1.0
+    tile_h = (ymax - ymin) / tiles_per_axis or 1.0
+    tx = np.clip(((x[candidates] - xmin) // tile_w).astype(int), 0, tiles_per_axis - 1)
+    ty = np.clip(((y[candidates] - ymin) // tile_h).astype(int), 0, tiles_per_axis - 1)
+    tile_ids = tx * tiles_per_axis + ty
+    order = np.argsort(tile_ids, kind='stable')
+    boundaries = np.flatnonzero(np.diff(tile_ids[order])) + 1
+    pending = np.split(candidates[order], boundaries)
+
+    tiles = []
+    while pending:
+        positions = pending.pop()
+        too_big = cost[positions].sum() > threshold or len(positions) > max_rows
+        if too_big and len(positions) > min_rows:
+            pending.extend(_split(positions, x, y, cost))
+        else:
+            tiles.append(positions)
+
+    # Admin candidates per task from the (hexagon, admin) bbox pairs
+    task_of = np.full(len(hexes), -1)
+    for task_id, positions in enumerate(tiles):
+        task_of[positions] = task_id
+    pairs = np.unique(np.column_stack([task_of[hex_pos], admin_pos]), axis=0)
+    admin_split = np.split(pairs[:, 1], np.flatnonzero(np.diff(pairs[:, 0])) + 1)
+
+    tasks = [
+        {'rows': positions, 'admin_rows': admin_rows, 'cost': float(cost[positions].sum())}
+        for positions, admin_rows in zip(tiles, admin_split)
+    ]
+    tasks.sort(key=lambda task: task['cost'], reverse=True)
+
+    costs = np.array([task['cost'] for task in tasks])
+    print(f"Planned {len(tasks)} tasks from {tiles_per_axis}x{tiles_per_axis} tiles "
+          f"(cost threshold {threshold:,.0f}; max/median task cost "
+          f"{costs.max() / max(np.median(costs), 1):.1f}x)")
+    return tasks
+
+
+def report_chunk_runtimes(timings, costs=None, label='overlay'):
+    """
+    Print per-chunk runtime statistics and the tail idle time of the pool.
+
+    Args:
+        timings (list): ``timed_call`` dictionaries (``tag``, ``pid``,
+            ``start``, ``seconds``)
+        costs (list): Estimated cost per task, indexed by ``tag``
+        label (str): Name used in the printout
+
+    Returns:
+        DataFrame: One row per chunk with its worker, runtime and cost
+    """
+    runtimes = pd.DataFrame([
+        {'tag': t['tag'], 'pid': t['pid'], 'start': t['start'], 'seconds': t['seconds']}
+        for t in timings
+    ])
+    if runtimes.empty:
+        return runtimes
+    runtimes['end'] = runtimes['start'] + runtimes['seconds']
+    if costs is not None:
+        runtimes['cost'] = [costs[tag] for tag in runtimes['tag']]
+
+    seconds = runtimes['seconds']
+    wall = runtimes['end'].max() - runtimes['start'].min()
+    # Time each worker sat idle between its last chunk and the end of the pool
+    last_end = runtimes.groupby('pid')['end'].max()
+    tail_idle = (runtimes['end'].max() - last_end).mean()
+
+    print(f"\n{label} chunks: {len(runtimes)} on {runtimes['pid'].nunique()} workers, "
+          f"wall {wall:.2f}s")
+    print(f"  runtime p50 {seconds.median():.3f}s, p95 {seconds.quantile(0.95):.3f}s, "
+          f"max {seconds.max():.3f}s (max/p50 {seconds.max() / max(seconds.median(), 1e-9):.1f}x)")
+    print(f"  mean worker idle at tail: {tail_idle:.2f}s ({100 * tail_idle / max(wall, 1e-9):.0f}% of wall)")
+    if 'cost' in runtimes and len(runtimes) > 2:
+        print(f"  cost/runtime correlation: {runtimes['cost'].corr(seconds):.2f}")
+    return runtimes
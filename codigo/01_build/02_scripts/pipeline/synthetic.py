@@ -0,0 +1,127 @@
+"""
+Synthetic Kontur-like hexagons and GADM-like admin polygons for benchmarks.
+
+Hexagons are real H3 cells (resolution 8, as in Kontur) when ``h3`` is
+installed and a regular hexagon lattice of the same size otherwise; both are
+written in EPSG:3857 like the Kontur files. Admin units are a Voronoi
+tessellation of the hexagon extent whose edges are densified and then
+displaced by a smooth noise field. Because the displacement only depends on
+the coordinates, neighbouring units move their shared vertices identically
+and the tessellation stays gap-free while boundaries get as many vertices as
+requested.
+"""
+import geopandas as gpd
+import numpy as np
+import shapely
+
+KONTUR_CRS = 'EPSG:3857'
+GADM_CRS = 'EPSG:4326'
+H3_RESOLUTION = 8
+HEX_EDGE_M = 530  # approx. H3 resolution-8 edge length (metres)
+CENTER_LATLNG = (4.6, -74.1)  # Bogotá
+
+
+def synthetic_hexagons(n_hexagons, seed=0, use_h3=True):
+    """
+    Build about ``n_hexagons`` hexagons with a log-normal population.
+
+    Returns:
+        GeoDataFrame: ``h3`` and ``population`` columns in EPSG:3857
+    """
+    rng = np.random.default_rng(seed)
+    try:
+        if not use_h3:
+            raise ImportError
+        import h3
+
+        # grid_disk(k) holds 3k(k+1) + 1 cells
+        k = int(np.ceil((-3 + np.sqrt(9 + 12 * (n_hexagons - 1))) / 6))
+        center = h3.latlng_to_cell(*CENTER_LATLNG, H3_RESOLUTION)
+        cells = sorted(h3.grid_disk(center, k))[:n_hexagons]
+        polygons = [
+            shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(cell)])
+            for cell in cells
+        ]
+        hexes = gpd.GeoDataFrame({'h3': cells}, geometry=polygons, crs=GADM_CRS).to_crs(KONTUR_CRS)
+    except ImportError:
+        hexes = _hexagon_lattice(n_hexagons)
+
+    hexes['population'] = np.round(rng.lognormal(mean=2.0, sigma=1.5, size=len(hexes)), 1)
+    return hexes
+
+
+def _hexagon_lattice(n_hexagons):
+    """Pointy-top hexagon lattice centred on CENTER_LATLNG (no h3 needed)."""
+    side = int(np.ceil(np.sqrt(n_hexagons)))
+    dx = np.sqrt(3) * HEX_EDGE_M
+    dy = 1.5 * HEX_EDGE_M
+    rows, cols = np.divmod(np.arange(n_hexagons), side)
+    x0, y0 = gpd.GeoSeries(
+        [shapely.Point(CENTER_LATLNG[1], CENTER_LATLNG[0])], crs=GADM_CRS
+    ).to_crs(KONTUR_CRS).iloc[0].coords[0]
+    cx = x0 + (cols - side / 2) * dx + (rows % 2) * dx / 2
+    cy = y0 + (rows - side / 2) * dy
+
+    angles = np.deg2rad(30 + 60 * np.arange(7))
+    ring_x = cx[:, None] + HEX_EDGE_M * np.cos(angles)[None, :]
+    ring_y = cy[:, None] + HEX_EDGE_M * np.sin(angles)[None, :]
+    polygons = shapely.polygons(np.stack([ring_x, ring_y], axis=-1))
+    return gpd.GeoDataFrame(
+        {'h3': [f"lattice_{i:x}" for i in range(n_hexagons)]},
+        geometry=polygons, crs=KONTUR_CRS,
+    )
+
+
+def synthetic_admin(hexagons, n_units, vertices_per_edge=20, seed=0, country='SYN'):
+    """
+    Tessellate the hexagons' extent into ``n_units`` GADM-like ADM1 polygons.
+
+    Args:
+        hexagons (GeoDataFrame): Output of ``synthetic_hexagons``
+        n_units (int): Number of admin units
+        vertices_per_edge (int): Boundary complexity (vertices added per Voronoi edge)
+        seed (int): Random seed
+
+    Returns:
+        GeoDataFrame: GID_0, GID_1, NAME_1 columns in EPSG:4326
+    """
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = hexagons.total_bounds
+    extent = shapely.box(xmin, ymin, xmax, ymax)
+    seeds = shapely.multipoints(np.column_stack([
+        rng.uniform(xmin, xmax, n_units),
+        rng.uniform(ymin, ymax, n_units),
+    ]))
+    cells = shapely.get_parts(shapely.voronoi_polygons(seeds, extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+
+    # Densify, then displace with a smooth field shared by neighbouring units
+    mean_edge = np.sqrt((xmax - xmin) * (ymax - ymin) / max(n_units, 1)) / 3
+    cells = shapely.segmentize(cells, max(mean_edge / max(vertices_per_edge, 1), 1.0))
+    amplitude = mean_edge * 0.1
+    frequency = 2 * np.pi / max(mean_edge, 1.0)
+
+    def wiggle(coords):
+        on_frame = (
+            np.isclose(coords[:, 0], xmin) | np.isclose(coords[:, 0], xmax)
+            | np.isclose(coords[:, 1], ymin) | np.isclose(coords[:, 1], ymax)
+        )
+        shift = amplitude * np.column_stack([
+            np.sin(coords[:, 1] * frequency * 3.1),
+            np.cos(coords[:, 0] * frequency * 2.7),
+        ])
+        shift[on_frame] = 0
+        return coords + shift
+
+    cells = shapely.make_valid(shapely.transform(cells, wiggle))
+
+    admin = gpd.GeoDataFrame(
+        {
+            'GID_0': country,
+            'GID_1': [f"{country}.{i + 1}_1" for i in range(len(cells))],
+            'NAME_1': [f"Unit {i + 1}" for i in range(len(cells))],
+        },
+        geometry=cells,
+        crs=hexagons.crs,
+    )
+    return admin.to_crs(GADM_CRS)
@@ -0,0 +1,104 @@
+"""
+Population conservation checks for the overlay engine.
+
+Every hexagon carries ``hex_id`` (its row number in the Kontur file) and
+``hex_area`` into the overlay, so each piece knows which hexagon it came from
+and what share of it it covers. Summing those shares per hexagon with
+``np.bincount`` tells, without touching any geometry again, whether a
+hexagon was apportioned exactly once (coverage 1), partly fell outside every
+admin polygon (coverage < 1: coasts, borders with countries not in the
+layer), was counted twice by overlapping polygons (coverage > 1), or was
+dropped altogether (coverage 0). Input population is read from the Kontur
+file's attribute table only.
+"""
+import numpy as np
+import pandas as pd
+import pyogrio
+
+COVERAGE_TOLERANCE = 1e-4  # slack on the summed area fractions of a hexagon
+
+
+def hexagon_coverage(pieces, n_hexagons, hex_id='hex_id', fraction_col='area_fraction'):
+    """Sum of area fractions per hexagon (0 for hexagons with no piece)."""
+    return np.bincount(pieces[hex_id].to_numpy(), weights=pieces[fraction_col].to_numpy(),
+                       minlength=n_hexagons)
+
+
+def validate_population(pieces, pop_path, admin, zone_id='GID_1', country_col='GID_0',
+                        pop_col='population', tolerance=COVERAGE_TOLERANCE):
+    """
+    Compare Kontur input population with the apportioned overlay pieces, per country.
+
+    Args:
+        pieces (DataFrame): Overlay pieces with ``hex_id``, ``area_fraction``,
+            ``adjusted_population``, ``zone_id`` and ``country_col``
+        pop_path (Path): Kontur file the pieces were computed from
+        admin (DataFrame): Admin units that should all receive population
+        zone_id (str): Admin identifier column
+        country_col (str): Country column (hexagons are assigned to the
+            country holding their largest piece)
+        pop_col (str): Population column
+        tolerance (float): Allowed deviation of a hexagon's coverage from 1
+
+    Returns:
+        DataFrame: Per country input, apportioned, outside, double-counted
+        and dropped population, plus a TOTAL row
+    """
+    population = pyogrio.read_dataframe(pop_path, columns=[pop_col], read_geometry=False)[pop_col]
+    population = population.to_numpy(dtype='float64')
+    coverage = hexagon_coverage(pieces, len(population))
+
+    # Country of each hexagon: the one holding its largest piece
+    largest = (
+        pieces[['hex_id', 'area_fraction', country_col]]
+        .sort_values('area_fraction', kind='stable')
+        .drop_duplicates('hex_id', keep='last')
+    )
+    country = np.full(len(population), 'outside', dtype=object)
+    country[largest['hex_id'].to_numpy()] = largest[country_col].to_numpy()
+
+    dropped = coverage == 0
+    partial = ~dropped & (coverage < 1 - tolerance)
+    double = coverage > 1 + tolerance
+
+    per_hex = pd.DataFrame({
+        'country': country,
+        'input_population': population,
+        'outside_population': np.where(partial, population * (1 - coverage), 0.0),
+        'double_counted_population': np.where(double, population * (coverage - 1), 0.0),
+        'dropped_population': np.where(dropped, population, 0.0),
+        'partial_hexagons': partial,
+        'double_counted_hexagons': double,
+        'dropped_hexagons': dropped & (population > 0),
+    })
+    apportioned = pieces.groupby(country_col)['adjusted_population'].sum()
+    report = per_hex.groupby('country').sum().join(
+        apportioned.rename('apportioned_population'), how='outer'
+    ).fillna(0)
+    # Nonzero per country only for hexagons straddling a border; ~0 in TOTAL
+    report['balance'] = (
+        report['input_population'] - report['apportioned_population']
+        - report['outside_population'] - report['dropped_population']
+        + report['double_counted_population']
+    )
+    report = report[[
+        'input_population', 'apportioned_population', 'outside_population',
+        'double_counted_population', 'dropped_population', 'balance',
+        'partial_hexagons', 'double_counted_hexagons', 'dropped_hexagons',
+    ]]
+    report.loc['TOTAL'] = report.sum()
+
+    missing = pd.Index(admin[zone_id].unique()).difference(pieces[zone_id].unique())
+
+    print("\n=== Population validation ===")
+    print(report.round(0).to_string())
+    if report.loc['TOTAL', 'double_counted_hexagons']:
+        print(f"WARNING: {int(report.loc['TOTAL', 'double_counted_hexagons']):,} hexagons are "
+              f"covered more than once (overlapping admin polygons)")
+    if report.loc['TOTAL', 'dropped_hexagons']:
+        print(f"WARNING: {int(report.loc['TOTAL', 'dropped_hexagons']):,} populated hexagons fall "
+              f"outside every admin polygon")
+    if len(missing):
+        print(f"WARNING: {len(missing)} admin areas received no population: "
+              f"{list(missing[:5])}{'...' if len(missing) > 5 else ''}")
+    return report
@@ -0,0 +1,183 @@
+"""
+Multi-layer zonal statistics over admin units or H3 cells.
+
+``ZonalEngine`` projects the zones once to an equal-area CRS and builds one
+spatial index over them. Every added layer is assigned to zones through that
+same index, and the per-layer results are collected in one wide table:
+
+- points:   ``<name>_count`` (plus ``<name>_<col>`` sums of weight columns)
+- lines:    ``<name>_length_km``
+- polygons: ``<name>_<col>`` area-weighted sums of the value columns
+
+Geometries that fall entirely inside a single zone are taken whole; only the
+ones crossing a zone boundary are clipped.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+AREA_CRS = 'esri:102033'  # South America Albers Equal Area Conic
+
+POINT_TYPES = {'Point', 'MultiPoint'}
+LINE_TYPES = {'LineString', 'MultiLineString', 'LinearRing'}
+POLYGON_TYPES = {'Polygon', 'MultiPolygon'}
+
+
+def zones_from_h3(cells, crs=AREA_CRS):
+    """
+    Build a zone layer from H3 cell ids (strings or integers).
+
+    Returns:
+        GeoDataFrame: One hexagon polygon per cell with an ``h3`` column
+    """
+    import h3
+
+    cells = pd.Series(cells).drop_duplicates()
+    cells = cells.map(lambda c: h3.int_to_str(c) if not isinstance(c, str) else c)
+    polygons = [
+        shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(cell)])
+        for cell in cells
+    ]
+    zones = gpd.GeoDataFrame({'h3': cells.values}, geometry=polygons, crs='EPSG:4326')
+    return zones.to_crs(crs)
+
+
+def _layer_kind(gdf):
+    geom_types = set(gdf.geom_type.dropna().unique())
+    if geom_types <= POINT_TYPES:
+        return 'point'
+    if geom_types <= LINE_TYPES:
+        return 'line'
+    if geom_types <= POLYGON_TYPES:
+        return 'polygon'
+    raise ValueError(f"Layer mixes geometry types {sorted(geom_types)}; split it by type first")
+
+
+class ZonalEngine:
+    """
+    Zonal statistics for any number of point, line and polygon layers.
+
+    Args:
+        zones (GeoDataFrame): Admin units or H3 cells
+        zone_id (str): Column identifying each zone (e.g. 'GID_1', 'dpto_ccdgo', 'h3')
+        crs (str): Equal-area CRS in which lengths and areas are measured
+    """
+
+    def __init__(self, zones, zone_id='GID_1', crs=AREA_CRS):
+        if zones[zone_id].duplicated().any():
+            zones = zones.dissolve(by=zone_id, as_index=False)
+
+        self.zone_id = zone_id
+        self.crs = crs
+        self.zones = zones[[zone_id, zones.geometry.name]].to_crs(crs).reset_index(drop=True)
+        self._geoms = self.zones.geometry.values
+        shapely.prepare(self._geoms)
+
+        # Built once and shared by every layer
+        self.sindex = self.zones.sindex
+
+        self.table = pd.DataFrame(
+            {'area_km2': shapely.area(self._geoms) / 1e6},
+            index=pd.Index(self.zones[zone_id], name=zone_id),
+        )
+
+    def _assign(self, geoms, predicate='intersects'):
+        """Return (layer_idx, zone_idx) candidate pairs from the shared index."""
+        layer_idx, zone_idx = self.sindex.query(geoms, predicate=predicate)
+        return layer_idx, zone_idx
+
+    def _split_inside(self, geoms, layer_idx, zone_idx):
+        """Flag pairs where the geometry lies wholly inside the zone."""
+        return shapely.contains_properly(self._geoms[zone_idx], geoms[layer_idx])
+
+    def _sum_by_zone(self, zone_idx, values):
+        return np.bincount(zone_idx, weights=values, minlength=len(self.zones))
+
+    def add_points(self, name, gdf, weight_cols=()):
+        geoms = gdf.geometry.to_crs(self.crs).values
+        layer_idx, zone_idx = self._assign(geoms)
+
+        # A point on a shared border is counted once, in the first zone found
+        layer_idx, first = np.unique(layer_idx, return_index=True)
+        zone_idx = zone_idx[first]
+
+        self.table[f'{name}_count'] = self._sum_by_zone(zone_idx, np.ones(len(zone_idx)))
+        for col in weight_cols:
+            values = gdf[col].to_numpy(dtype='float64')[layer_idx]
+            self.table[f'{name}_{col}'] = self._sum_by_zone(zone_idx, values)
+
+    def add_lines(self, name, gdf):
+        geoms = gdf.geometry.to_crs(self.crs).values
+        layer_idx, zone_idx = self._assign(geoms)
+        inside = self._split_inside(geoms, layer_idx, zone_idx)
+
+        lengths = np.empty(len(layer_idx))
+        lengths[inside] = shapely.length(geoms[layer_idx[inside]])
+        edge = ~inside
+        lengths[edge] = shapely.length(
+            shapely.intersection(geoms[layer_idx[edge]], self._geoms[zone_idx[edge]])
+        )
+
+        self.table[f'{name}_length_km'] = self._sum_by_zone(zone_idx, lengths / 1000)
+
+    def add_polygons(self, name, gdf, value_cols):
+        geoms = gdf.geometry.to_crs(self.crs).values
+        layer_idx, zone_idx = self._assign(geoms)
+        inside = self._split_inside(geoms, layer_idx, zone_idx)
+
+        fractions = np.ones(len(layer_idx))
+        edge = ~inside
+        clipped = shapely.intersection(geoms[layer_idx[edge]], self._geoms[zone_idx[edge]])
+        full_area = shapely.area(geoms[layer_idx[edge]])
+        fractions[edge] = np.divide(
+            shapely.area(clipped), full_area,
+            out=np.zeros(edge.sum()), where=full_area > 0,
+        )
+
+        for col in value_cols:
+            values = gdf[col].to_numpy(dtype='float64')[layer_idx] * fractions
+            self.table[f'{name}_{col}'] = self._sum_by_zone(zone_idx, values)
+
+    def add_layer(self, name, gdf, value_cols=()):
+        """
+        Add a layer, dispatching on its geometry type.
+
+        Args:
+            name (str): Prefix for the output columns
+            gdf (GeoDataFrame): Point, line or polygon layer
+            value_cols (iterable): Weight columns (points) or values to apportion (polygons)
+        """
+        kind = _layer_kind(gdf)
+        print(f"Zonal stats: {name} ({kind}, {len(gdf):,} features)")
+        if kind == 'point':
+            self.add_points(name, gdf, weight_cols=value_cols)
+        elif kind == 'line':
+            self.add_lines(name, gdf)
+        else:
+            self.add_polygons(name, gdf, value_cols=value_cols)
+        return self
+
+    def result(self):
+        """Return the wide table, one row per zone."""
+        return self.table.reset_index()
+
+
+def zonal_statistics(zones, layers, zone_id='GID_1', crs=AREA_CRS):
+    """
+    One-call wrapper around ``ZonalEngine``.
+
+    Args:
+        zones (GeoDataFrame): Admin units or H3 cells
+        layers (dict): name -> GeoDataFrame, or name -> (GeoDataFrame, value_cols)
+        zone_id (str): Zone identifier column
+        crs (str): Equal-area CRS
+
+    Returns:
+        DataFrame: One row per zone with ``area_km2`` and every layer's columns
+    """
+    engine = ZonalEngine(zones, zone_id=zone_id, crs=crs)
+    for name, layer in layers.items():
+        gdf, value_cols = layer if isinstance(layer, tuple) else (layer, ())
+        engine.add_layer(name, gdf, value_cols=value_cols)
+    return engine.result()
@@ -1,11 +1,31 @@
 from pathlib import Path
-import geopandas as gpd
-import pandas as pd
-from tqdm import tqdm
-import multiprocessing
 import numpy as np
 import os
 from functools import partial
+import shutil
+
+from pipeline.admin_layer import AdminLayer
+from pipeline.batch_overlay import process_population_in_batches
+from pipeline.cache import SpatialCache
+from pipeline.density_sketch import DensitySketch, distribution_rollups
+from pipeline.instrumentation import configure
+from pipeline.partitioned import run_partitioned
+from pipeline.point_assignment import centroid_population_totals, h3_population_totals
+from pipeline.profiling import configure_profiler
+from pipeline.releases import cell_shares
+from pipeline.resilience import ChunkLedger
+from pipeline.validation import validate_population
+from pipeline.admin_hierarchy import (
+    attach_rollups,
+    gid_columns,
+    load_admin_hierarchy,
+    rollup_hierarchy,
+)
+from pipeline.raster_zones import (
+    compare_with_exact,
+    load_or_build_zone_raster,
+    raster_population_totals,
+)
 
 # Set up paths and directories
 work_dir = Path(Path(__file__).parent.parent.parent.parent)
@@ -15,285 +35,250 @@ data_path = Path(work_dir, 'datos')
 # Define specific data paths
 ADMIN_DIVISIONS_PATH = work_dir / 'codigo' / '01_build' / '03_output'/ 'gadm41_COL.gpkg'
 POPULATION_DATA_PATH = data_path / 'spatial' / 'kontur_population_CO_20231101.gpkg'
+CACHE_PATH = output_path / 'cache'
+LEDGER_PATH = output_path / 'ledgers'  # per-chunk outcomes; finished chunks are reused on rerun
+TRACE_PATH = output_path / 'traces' / 'population_density_COL.jsonl'  # '.json' for a Chrome trace
 RESULTS_PATH = output_path / 'population_density_results_colombia.gpkg'
+VALIDATION_PATH = output_path / 'population_validation_colombia.csv'
 
-# Hypatia-optimized settings
-BATCH_SIZE = 5000  # Increased for 32GB RAM
-CHUNK_SIZE = 1500  # Increased for 32 cores
+# Admin levels reported from a single scan; the overlay runs against the finest one
+ADMIN_LEVELS = [0, 1, 2]
 
-def print_diagnostic(phase, gdf, group_col='GID_1', pop_col='population'):
-    """
-    Print diagnostic information about the GeoDataFrame at various stages.
-    
-    Args:
-        phase (str): Name of the processing phase
-        gdf (GeoDataFrame): Data to analyze
-        group_col (str): Column to group by (e.g., 'GID_1' for admin divisions)
-        pop_col (str): Column containing population data
-    """
-    print(f"\n=== Diagnostic Report: {phase} ===")
-    print(f"Total rows: {len(gdf):,}")
-    print(f"Memory usage: {gdf.memory_usage(deep=True).sum() / 1024**2:.2f} MB")
-    print(f"Columns: {gdf.columns.tolist()}")
-    
-    if pop_col in gdf.columns:
-        print(f"\nPopulation statistics:")
-        print(f"Total population: {gdf[pop_col].sum():,.0f}")
-        print(f"Non-zero population rows: {(gdf[pop_col] > 0).sum():,}")
-        print(f"Zero population rows: {(gdf[pop_col] == 0).sum():,}")
-        print(f"NaN population rows: {gdf[pop_col].isna().sum():,}")
-    
-    if group_col in gdf.columns:
-        print(f"\nUnique {group_col} values: {gdf[group_col].nunique()}")
-        
-    print("\nSample of data:")
-    print(gdf.head(2))
-    print("=" * 50)
+# 'overlay' intersects hexagons with the admin polygons (exact); 'raster'
+# rasterizes the admin layer once and assigns hexagons by array lookup;
+# 'centroid' and 'h3' give each hexagon wholly to one unit (by centroid or by
+# H3 polyfill); 'partitioned' apportions spatial tiles out of core
+ENGINE = 'overlay'
+AREA_CRS = 'esri:102033'  # South America Albers Equal Area Conic
+RASTER_RESOLUTION = 250        # metres, equal-area grid
+RASTER_SAMPLES = 'subsample'   # 'centroid' or 'subsample' points per hexagon
+RASTER_VALIDATE = False        # also run the overlay and report the differences
 
-def validate_intersection_result(result, admin_gdf, phase=""):
-    """
-    Validate intersection results and print diagnostics.
-    """
-    print(f"\n>>> Validation Report for {phase}")
-    
-    # Check for empty result
-    if result is None or len(result) == 0:
-        print("WARNING: Empty intersection result!")
-        return False
-        
-    # Check for missing admin areas
-    missing_admins = set(admin_gdf['GID_1']) - set(result['GID_1'])
-    if missing_admins:
-        print(f"WARNING: {len(missing_admins)} admin areas have no intersection:")
-        print(f"Missing GID_1s: {sorted(list(missing_admins))[:5]}...")
-        
-        # Get names of missing admin areas
-        missing_names = admin_gdf[admin_gdf['GID_1'].isin(missing_admins)][['GID_1', 'NAME_1']]
-        print("\nMissing areas:")
-        print(missing_names.head())
-    
-    return True
+# Overlay sizing: None lets MemoryTuner pick the batch and chunk sizes from
+# MEMORY_BUDGET (default: 80% of the available memory) and adjust them between
+# batches; a number pins the setting
+MEMORY_BUDGET = None
+BATCH_SIZE = None
+CHUNK_SIZE = None
 
-def process_chunk(chunk_data):
-    """
-    Process a chunk of data with diagnostic information.
-    """
-    df_chunk, admin_divisions = chunk_data
-    try:
-        result = gpd.overlay(df_chunk, admin_divisions, how='intersection')
-        if result is not None and len(result) > 0:
-            print(f"Chunk 
-                  processed successfully: {len(result)} intersections found")
-            return result
-        else:
-            print(f"Warning: Empty result for chunk of size {len(df_chunk)}")
-            return None
-    except Exception as e:
-        print(f"Error processing chunk: {str(e)}")
-        return None
+# 'off', 'basic' (timings, RSS, row counts), 'detailed' or 'debug'
+INSTRUMENTATION_LEVEL = 'basic'
+
+# 'adaptive' (cost-balanced spatial chunks, slowest first) or 'fixed' row chunks
+SCHEDULER = 'adaptive'
+
+# Per-worker profiling of the overlay pool: None (off), 'cprofile' or 'sampling'
+PROFILE_WORKERS = None
+PROFILE_PATH = output_path / 'profiles' / 'population_density_COL'
 
-def chunk_geodataframe(gdf, num_chunks):
+# Worker processes (default: cpu_count - 2) and the per-worker memory cap of
+# the partitioned engine, which spills its tiles to PARTITIONS_PATH
+NUM_WORKERS = None
+WORKER_MEMORY_LIMIT = '4GB'
+PARTITIONS_PATH = output_path / 'partitions' / 'population_density_COL'
+
+def overlay_population(admin_divisions, finest_level, cache, sketch=None):
     """
-    Split a GeoDataFrame into roughly equal chunks for parallel processing.
+    Exact engine: overlay every hexagon with the finest admin level.
     
     Args:
-        gdf (GeoDataFrame): Input GeoDataFrame to split
-        num_chunks (int): Number of chunks to split the data into
+        sketch (DensitySketch): Receives the density distribution of the pieces
     
     Returns:
-        list: List of GeoDataFrame chunks
+        GeoDataFrame: Overlay pieces with GID columns and adjusted_population
     """
-    # Calculate chunk size
-    chunk_size = len(gdf) // num_chunks
-    remainder = len(gdf) % num_chunks
+    inputs = [POPULATION_DATA_PATH, ADMIN_DIVISIONS_PATH]
+    params = {'layer': f'ADM_ADM_{finest_level}', 'columns': ['hex_area', 'hex_id']}
     
-    chunks = []
-    start_idx = 0
+    # Chunk outcomes survive a failed run, so a rerun only redoes failed chunks
+    ledger_dir = LEDGER_PATH / cache.make_key('pop_admin_ledger', inputs=inputs,
+                                              crs=admin_divisions.crs, params=params)
+    intersected = cache.cached(
+        'pop_admin_intersect',
+        lambda: process_population_in_batches(POPULATION_DATA_PATH, admin_divisions,
+                                              batch_size=BATCH_SIZE,
+                                              chunk_size=CHUNK_SIZE,
+                                              num_cores=NUM_WORKERS,
+                                              memory_budget=MEMORY_BUDGET,
+                                              scheduler=SCHEDULER,
+                                              ledger=ChunkLedger(ledger_dir),
+                                              admin_layer=AdminLayer(admin_divisions),
+                                              sketch=sketch,
+                                              area_crs=AREA_CRS,
+                                              intermediate_dir=output_path),
+        inputs=inputs,
+        crs=admin_divisions.crs,
+        params=params,
+    )
+    shutil.rmtree(ledger_dir, ignore_errors=True)
     
-    for i in range(num_chunks):
-        # Add one extra row to some chunks if there's a remainder
-        current_chunk_size = chunk_size + (1 if i < remainder else 0)
-        end_idx = start_idx + current_chunk_size
-        
-        # Extract chunk using iloc
-        chunk = gdf.iloc[start_idx:end_idx].copy()
-        chunks.append(chunk)
-        
-        start_idx = end_idx
+    if intersected is None:
+        raise ValueError("No intersecting population data found")
+    if sketch is not None and sketch.pieces == 0:
+        # Cache hit: the batches did not run, the cached pieces fill the sketch
+        sketch.update_pieces(intersected, AREA_CRS)
     
-    return chunks
-
+    # Calculate population density
+    print("\nCalculating population density...")
+    intersected['intersected_area'] = intersected.geometry.area
+    intersected['area_fraction'] = intersected['intersected_area'] / intersected['hex_area']
+    intersected['adjusted_population'] = intersected['population'] * intersected['area_fraction']
+    return intersected
 
-def parallel_intersection(df1, df2, chunk_size=5000):
+def cell_admin_shares(admin_divisions, finest_level, cache, population_path=None, compute=None):
     """
-    Parallel intersection with enhanced diagnostics.
-    """
-    print(f"\nStarting parallel intersection:")
-    print(f"Input data size: {len(df1):,} rows")
-    print(f"Number of admin areas: {len(df2):,}")
+    Share of every hexagon's population per finest unit, cached per release.
     
-    num_cores = max(1, multiprocessing.cpu_count() - 2)
-    num_chunks = max(num_cores * 2, len(df1) // chunk_size)
+    Used to update totals between Kontur releases (see pipeline/releases.py).
+    On a miss the shares come from the (cached) overlay unless ``compute`` is given.
     
-    # Prepare chunks with admin divisions
-    df_split = chunk_geodataframe(df1, num_chunks) 
-    chunk_data = [(chunk, df2) for chunk in df_split]
+    Returns:
+        DataFrame: uint64 h3, GID_<finest_level> and share
+    """
+    gid_col = f'GID_{finest_level}'
+    if compute is None:
+        compute = lambda: cell_shares(overlay_population(admin_divisions, finest_level, cache), gid_col)
+    return cache.cached(
+        'cell_admin_shares',
+        compute,
+        inputs=[population_path or POPULATION_DATA_PATH, ADMIN_DIVISIONS_PATH],
+        crs=admin_divisions.crs,
+        params={'layer': f'ADM_ADM_{finest_level}'},
+    )
 
-    results = []
-    try:
-        with multiprocessing.Pool(num_cores) as pool:
-            for result in tqdm(
-                pool.imap_unordered(process_chunk, chunk_data),
-                total=len(chunk_data),
-                desc="Processing chunks"
-            ):
-                if result is not None:
-                    results.append(result)
-                    if len(results) % 10 == 0:  # Print progress every 10 chunks
-                        print(f"Processed {len(results)} chunks successfully")
-    
-    except Exception as e:
-        print(f"Error in parallel processing: {str(e)}")
-        raise
-    
-    if not results:
-        raise ValueError("No valid results obtained from parallel processing")
+def raster_population(admin_divisions, finest_level, cache):
+    """
+    Raster engine: assign hexagons to the rasterized finest admin level.
     
-    combined_result = pd.concat(results, ignore_index=True)
-    print(f"\nParallel processing completed:")
-    print(f"Total intersections found: {len(combined_result):,}")
-    return combined_result
-
-def process_population_in_batches(pop_path, admin_divisions, batch_size=500000):
+    Returns:
+        DataFrame: One row per finest unit with GID columns and adjusted_population
     """
-    Process population data in batches with comprehensive diagnostics.
+    gid_col = f'GID_{finest_level}'
+    raster = load_or_build_zone_raster(
+        admin_divisions, ADMIN_DIVISIONS_PATH, cache,
+        zone_id=gid_col, resolution=RASTER_RESOLUTION,
+    )
+    totals = raster_population_totals(POPULATION_DATA_PATH, raster, samples=RASTER_SAMPLES)
+    totals = totals.rename(columns={'zone_id': gid_col})
+    return with_ancestors(admin_divisions, finest_level, totals)
+
+def assigned_population(admin_divisions, finest_level, cache):
     """
-    # Initial diagnostic of admin divisions
-    print_diagnostic("Admin Divisions Input", admin_divisions)
+    Centroid, H3 and partitioned engines: population totals per finest unit.
     
-    total_rows = sum(1 for _ in gpd.read_file(pop_path, rows=1))
-    print(f"\nTotal population hexagons to process: {total_rows:,}")
-    
-    all_results = []
-    total_population = 0
-    
-    for batch_start in tqdm(range(0, total_rows, batch_size), desc="Processing batches"):
-        print(f"\n{'='*80}")
-        print(f"Processing batch starting at row {batch_start:,}")
-        
-        # Load batch
-        world_pop_batch = gpd.read_file(
-            pop_path,
-            rows=batch_size,
-            skiprows=range(1, batch_start + 1) if batch_start > 0 else None
+    Returns:
+        DataFrame: One row per finest unit with GID columns and adjusted_population
+    """
+    gid_col = f'GID_{finest_level}'
+    if ENGINE == 'partitioned':
+        # Tiles and per-tile partials are reused on rerun
+        totals = run_partitioned(
+            POPULATION_DATA_PATH,
+            ADMIN_DIVISIONS_PATH,
+            PARTITIONS_PATH,
+            zone_id=gid_col,
+            admin_layer=f'ADM_ADM_{finest_level}',
+            n_workers=NUM_WORKERS,
+            memory_limit=WORKER_MEMORY_LIMIT,
+            area_crs=AREA_CRS,
+            cache=cache,
         )
-        
-        print_diagnostic("Batch Input", world_pop_batch)
-        
-        # CRS alignment
-        if world_pop_batch.crs != admin_divisions.crs:
-            world_pop_batch = world_pop_batch.to_crs(admin_divisions.crs)
-        
-        # Find intersecting hexagons
-        intersecting = gpd.sjoin(
-            world_pop_batch,
-            admin_divisions,
-            predicate='intersects',
-            how='inner'
+    else:
+        assign = {'centroid': centroid_population_totals, 'h3': h3_population_totals}[ENGINE]
+        totals = cache.cached(
+            f'pop_admin_{ENGINE}',
+            lambda: assign(POPULATION_DATA_PATH, admin_divisions, zone_id=gid_col),
+            inputs=[POPULATION_DATA_PATH, ADMIN_DIVISIONS_PATH],
+            crs=admin_divisions.crs,
+            params={'layer': f'ADM_ADM_{finest_level}'},
         )
-        
-        print_diagnostic("After Spatial Join", intersecting)
-        
-        if len(intersecting) > 0:
-            batch_result = parallel_intersection(
-                world_pop_batch.loc[intersecting.index],
-                admin_divisions
-            )
-            
-            if batch_result is not None:
-                print_diagnostic("Batch Result", batch_result)
-                all_results.append(batch_result)
-                
-                # Update total population
-                total_population += batch_result['population'].sum()
-                print(f"Cumulative total population: {total_population:,.0f}")
-                
-                # Save intermediate results
-                if len(all_results) % 5 == 0:
-                    intermediate = pd.concat(all_results, ignore_index=True)
-                    intermediate_path = output_path / f'intermediate_results_batch_{len(all_results)}.gpkg'
-                    print(f"Saving intermediate results to {intermediate_path}")
-                    intermediate.to_file(intermediate_path, driver="GPKG")
-        else:
-            print(f"WARNING: No intersecting hexagons found in batch starting at {batch_start}")
-    
-    if not all_results:
-        print("ERROR: No results generated from any batch!")
-        return None
-    
-    final_result = pd.concat(all_results, ignore_index=True)
-    print("\nFinal Processing Summary:")
-    print_diagnostic("Final Combined Results", final_result)
-    return final_result
+    return with_ancestors(admin_divisions, finest_level, totals)
+
+def with_ancestors(admin_divisions, finest_level, totals):
+    """Attach the ancestor GIDs so the hierarchy roll-up works unchanged."""
+    gid_col = f'GID_{finest_level}'
+    return admin_divisions[gid_columns(finest_level)].drop_duplicates(gid_col).merge(
+        totals, on=gid_col, how='left'
+    )
 
 def main():
     """Main execution function with enhanced error checking and diagnostics"""
     try:
         print("Loading data...")
         output_path.mkdir(parents=True, exist_ok=True)
+        instr = configure(path=TRACE_PATH, level=INSTRUMENTATION_LEVEL)
+        profiler = configure_profiler(PROFILE_PATH, mode=PROFILE_WORKERS)
         
-        # Load and validate admin divisions
+        # Load and validate admin divisions (all requested levels)
         print(f"Loading admin divisions from: {ADMIN_DIVISIONS_PATH}")
-        admin_divisions = gpd.read_file(ADMIN_DIVISIONS_PATH, layer='ADM_ADM_1')
-        print_diagnostic("Initial Admin Divisions", admin_divisions)
-        
-        # Process population data
-        intersected = process_population_in_batches(POPULATION_DATA_PATH, admin_divisions)
-        
-        if intersected is None:
-            raise ValueError("No intersecting population data found")
-        
-        # Calculate population density
-        print("\nCalculating population density...")
-        intersected['intersected_area'] = intersected.geometry.area
-        intersected['area_fraction'] = intersected['intersected_area'] / intersected.geometry.area
-        intersected['adjusted_population'] = intersected['population'] * intersected['area_fraction']
-        
-        # Aggregate by admin area
-        population_by_admin = (
-            intersected.groupby('GID_1')['adjusted_population']
-            .sum()
-            .reset_index()
-        )
+        admin_levels = load_admin_hierarchy(ADMIN_DIVISIONS_PATH, ADMIN_LEVELS, area_crs=AREA_CRS)
+        finest_level = max(ADMIN_LEVELS)
+        admin_divisions = admin_levels[finest_level]
+        instr.diagnostic("Initial Admin Divisions", admin_divisions, group_col=f'GID_{finest_level}')
         
-        print("\nPopulation by admin area:")
-        print(population_by_admin.sort_values('adjusted_population', ascending=False).head(10))
-        
-        # Final merge and density calculation
-        result = admin_divisions.merge(
-            population_by_admin,
-            on='GID_1',
-            how='left'
-        )
-        #result['population_density'] = result['adjusted_population'] / result['area_km2']
+        # Process population data once against the finest level
+        # (reused while the input files are unchanged)
+        cache = SpatialCache(CACHE_PATH)
+        sketch = None
+        if ENGINE == 'raster':
+            intersected = raster_population(admin_divisions, finest_level, cache)
+            
+            if RASTER_VALIDATE:
+                exact = rollup_hierarchy(
+                    overlay_population(admin_divisions, finest_level, cache), [finest_level]
+                )[finest_level]
+                compare_with_exact(intersected, exact, zone_id=f'GID_{finest_level}')
+        elif ENGINE in ('centroid', 'h3', 'partitioned'):
+            intersected = assigned_population(admin_divisions, finest_level, cache)
+        else:
+            sketch = DensitySketch(admin_divisions[f'GID_{finest_level}'], f'GID_{finest_level}')
+            intersected = overlay_population(admin_divisions, finest_level, cache, sketch=sketch)
+            
+            # Population in vs out per country, from columns only (always on)
+            with instr.stage('validate', rows_in=len(intersected)):
+                validation = validate_population(intersected, POPULATION_DATA_PATH, admin_divisions,
+                                                 zone_id=f'GID_{finest_level}')
+                validation.to_csv(VALIDATION_PATH)
         
-        # Final diagnostics
-        print("\nFinal Results Summary:")
-        zero_pop = result[result['adjusted_population'] == 0]
-        if len(zero_pop) > 0:
-            print(f"\nWARNING: {len(zero_pop)} areas have zero population:")
-            print(zero_pop[['GID_1', 'NAME_1', 'area_km2']])
+        # Aggregate at the finest level and roll up GID_2 -> GID_1 -> GID_0
+        with instr.stage('aggregate', rows_in=len(intersected)) as rec:
+            rollups = rollup_hierarchy(intersected, ADMIN_LEVELS)
+            if sketch is not None:
+                # Density percentiles and sparse shares within each unit
+                distributions = distribution_rollups(sketch, admin_divisions, finest_level, ADMIN_LEVELS)
+                for level, distribution in distributions.items():
+                    rollups[level] = rollups[level].merge(distribution, on=f'GID_{level}', how='left')
+            results = attach_rollups(admin_levels, rollups)
+            rec['rows_out'] = sum(len(result) for result in results.values())
         
-        nan_pop = result[result['adjusted_population'].isna()]
-        if len(nan_pop) > 0:
-            print(f"\nWARNING: {len(nan_pop)} areas have NaN population:")
-            print(nan_pop[['GID_1', 'NAME_1', 'area_km2']])
+        for level, result in results.items():
+            gid_col = f'GID_{level}'
+            name_col = 'COUNTRY' if level == 0 else f'NAME_{level}'
+            
+            print(f"\nPopulation by admin area (ADM{level}):")
+            print(result[[gid_col, name_col, 'adjusted_population']]
+                  .sort_values('adjusted_population', ascending=False).head(10))
+            
+            # Final diagnostics
+            zero_pop = result[result['adjusted_population'] == 0]
+            if len(zero_pop) > 0:
+                print(f"\nWARNING: {len(zero_pop)} ADM{level} areas have zero population:")
+                print(zero_pop[[gid_col, name_col, 'area_km2']])
+            
+            nan_pop = result[result['adjusted_population'].isna()]
+            if len(nan_pop) > 0:
+                print(f"\nWARNING: {len(nan_pop)} ADM{level} areas have NaN population:")
+                print(nan_pop[[gid_col, name_col, 'area_km2']])
         
-        # Save results
+        # Save one layer per admin level
         print(f"\nSaving results to: {RESULTS_PATH}")
-        result.to_file(RESULTS_PATH, driver="GPKG")
+        with instr.stage('write'):
+            for level, result in results.items():
+                result.to_file(RESULTS_PATH, layer=f'ADM_{level}', driver="GPKG")
         
-        return result
+        profiler.summary()
+        instr.close()
+        return results
         
     except Exception as e:
         print(f"Error in main execution: {str(e)}")
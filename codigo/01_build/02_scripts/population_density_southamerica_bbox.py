@@ -11,6 +11,12 @@ import sys
 import multiprocessing
 from functools import partial
 
+from pipeline.admin_layer import load_valid_admin
+from pipeline.hexstore import HexStore, load_hexes
+from pipeline.instrumentation import configure, get_instrumentation
+from pipeline.pools import pool_context
+from pipeline.profiling import configure_profiler, get_profiler
+
 # Set up logging
 def setup_logging():
     """Set up logging to both file and console"""
@@ -48,6 +54,14 @@ data_path = Path(work_dir, 'datos')
 ADMIN_DIVISIONS_PATH = work_dir / 'codigo' / '01_build' / '03_output' / 'south_america_admin_divisions.gpkg'
 POPULATION_DATA_PATH = data_path / 'spatial' / 'kontur_population_20231101.gpkg'
 RESULTS_PATH = output_path / 'country_results'
+TRACE_PATH = output_path / 'traces' / 'population_density_southamerica_bbox.jsonl'  # '.json' for a Chrome trace
+
+# 'off', 'basic' (timings, RSS, row counts), 'detailed' or 'debug'
+INSTRUMENTATION_LEVEL = 'basic'
+
+# Per-worker profiling of the spatial join pool: None (off), 'cprofile' or 'sampling'
+PROFILE_WORKERS = None
+PROFILE_PATH = output_path / 'profiles' / 'population_density_southamerica_bbox'
 
 # Create results directory if it doesn't exist
 RESULTS_PATH.mkdir(parents=True, exist_ok=True)
@@ -69,43 +83,11 @@ COUNTRIES = {
     'VEN': 'Venezuela'
 }
 
-def print_diagnostics(gdf, stage, country_code=None):
-    """Print diagnostic information about the GeoDataFrame."""
-    logging.info(f"\n{'='*50}")
-    logging.info(f"DIAGNOSTICS - {stage}")
-    if country_code:
-        logging.info(f"Country: {COUNTRIES.get(country_code, country_code)}")
-    
-    logging.info(f"CRS: {gdf.crs}")
-    logging.info(f"Number of features: {len(gdf):,}")
-    
-    if 'population' in gdf.columns:
-        total_pop = gdf['population'].sum()
-        logging.info(f"Total population: {total_pop:,.0f}")
-        
-        # Additional population diagnostics
-        non_zero = (gdf['population'] > 0).sum()
-        zero_pop = (gdf['population'] == 0).sum()
-        nan_pop = gdf['population'].isna().sum()
-        logging.info(f"Population features > 0: {non_zero:,}")
-        logging.info(f"Population features = 0: {zero_pop:,}")
-        logging.info(f"Population features NaN: {nan_pop:,}")
-    
-    if gdf.geometry is not None:
-        bounds = gdf.total_bounds
-        logging.info(f"Bounding Box:")
-        logging.info(f"  West:  {bounds[0]:.4f}")
-        logging.info(f"  South: {bounds[1]:.4f}")
-        logging.info(f"  East:  {bounds[2]:.4f}")
-        logging.info(f"  North: {bounds[3]:.4f}")
-    
-    logging.info(f"Memory usage: {gdf.memory_usage(deep=True).sum() / 1024**2:.2f} MB")
-    logging.info("="*50 + "\n")
-
 def parallel_spatial_join(args):
     """Execute spatial join for a chunk of data"""
     pop_chunk, admin_gdf = args
     try:
+        pop_chunk = load_hexes(pop_chunk)
         result = gpd.sjoin(
             admin_gdf,
             pop_chunk,
@@ -120,13 +102,17 @@ def parallel_spatial_join(args):
 def process_country(country_code, target_crs="esri:102033"):
     """Process population density for a single country."""
     logging.info(f"\nProcessing {COUNTRIES.get(country_code, country_code)}...")
+    instr = get_instrumentation()
+    profiler = get_profiler()
     
     try:
         # 1. Load and filter admin divisions for the country
         logging.info("Loading admin divisions...")
-        admin_divisions = gpd.read_file(ADMIN_DIVISIONS_PATH)
-        country_admin = admin_divisions[admin_divisions['GID_0'] == country_code].copy()
-        print_diagnostics(country_admin, "Admin Divisions", country_code)
+        with instr.stage('read_admin', country=country_code) as rec:
+            admin_divisions = load_valid_admin(ADMIN_DIVISIONS_PATH)
+            country_admin = admin_divisions[admin_divisions['GID_0'] == country_code].copy()
+            rec['rows_out'] = len(country_admin)
+        instr.diagnostic(f"Admin Divisions ({country_code})", country_admin)
         
         if len(country_admin) == 0:
             logging.error(f"No admin divisions found for {country_code}")
@@ -138,11 +124,13 @@ def process_country(country_code, target_crs="esri:102033"):
         
         # 3. Load population data for country bounds
         logging.info("Loading population data...")
-        country_pop = gpd.read_file(
-            POPULATION_DATA_PATH,
-            bbox=country_bounds
-        )
-        print_diagnostics(country_pop, "Population Hexagons", country_code)
+        with instr.stage('read', country=country_code) as rec:
+            country_pop = gpd.read_file(
+                POPULATION_DATA_PATH,
+                bbox=country_bounds
+            )
+            rec['rows_out'] = len(country_pop)
+        instr.diagnostic(f"Population Hexagons ({country_code})", country_pop)
         
         if len(country_pop) == 0:
             logging.error(f"No population hexagons found for {country_code}")
@@ -150,8 +138,10 @@ def process_country(country_code, target_crs="esri:102033"):
             
         # 4. Transform both datasets to target CRS
         logging.info(f"Converting to target CRS: {target_crs}")
-        country_admin = country_admin.to_crs(target_crs)
-        country_pop = country_pop.to_crs(target_crs)
+        with instr.stage('reproject', rows_in=len(country_pop), country=country_code) as rec:
+            country_admin = country_admin.to_crs(target_crs)
+            country_pop = country_pop.to_crs(target_crs)
+            rec['rows_out'] = len(country_pop)
         
         # 5. Parallel Spatial join
         logging.info("Performing parallel spatial join...")
@@ -159,22 +149,37 @@ def process_country(country_code, target_crs="esri:102033"):
         # Split population data into chunks
         num_cores = multiprocessing.cpu_count() - 1  # Leave one core free
         chunk_size = max(1, len(country_pop) // num_cores)
-        pop_chunks = [country_pop.iloc[i:i + chunk_size] for i in range(0, len(country_pop), chunk_size)]
+        # Written once; workers map their (start, stop) range instead of unpickling rows
+        store = HexStore.write(country_pop)
+        pop_chunks = [store.range(i, min(i + chunk_size, len(country_pop)))
+                      for i in range(0, len(country_pop), chunk_size)]
         
         # Prepare arguments for parallel processing
-        args = [(chunk, country_admin) for chunk in pop_chunks]
+        tasks = [(parallel_spatial_join, (chunk, country_admin), i)
+                 for i, chunk in enumerate(pop_chunks)]
         
         # Execute parallel spatial join
-        with multiprocessing.Pool(num_cores) as pool:
-            results = list(tqdm(
-                pool.imap(parallel_spatial_join, args),
-                total=len(args),
-                desc="Processing chunks"
-            ))
-        
-        # Combine results
-        result = pd.concat([r for r in results if r is not None], ignore_index=True)
-        print_diagnostics(result, "After Spatial Join", country_code)
+        with instr.stage('sjoin', rows_in=len(country_pop), country=country_code) as rec:
+            results = []
+            try:
+                with pool_context().Pool(num_cores) as pool:
+                    for timing in tqdm(
+                        pool.imap(profiler.runner(), tasks),
+                        total=len(tasks),
+                        desc="Processing chunks"
+                    ):
+                        chunk_result = timing.pop('result')
+                        profiler.record(timing, pool=f'sjoin_{country_code}')
+                        instr.chunk('sjoin_chunk', timing, rows_in=len(pop_chunks[timing['tag']]),
+                                    rows_out=0 if chunk_result is None else len(chunk_result))
+                        results.append(chunk_result)
+            finally:
+                store.remove()
+            
+            # Combine results
+            result = pd.concat([r for r in results if r is not None], ignore_index=True)
+            rec['rows_out'] = len(result)
+        instr.diagnostic(f"After Spatial Join ({country_code})", result)
         
         # 6. Calculate population density
         logging.info("Calculating population density...")
@@ -188,12 +193,13 @@ def process_country(country_code, target_crs="esri:102033"):
         final_result['area_km2'] = final_result.geometry.area / 1_000_000
         final_result['pop_density'] = final_result['population'] / final_result['area_km2']
         
-        print_diagnostics(final_result, "Final Results", country_code)
+        instr.diagnostic(f"Final Results ({country_code})", final_result)
         
         # 7. Export results
         output_file = RESULTS_PATH / f"{country_code}_popdens_bbox.gpkg"
         logging.info(f"Saving results to {output_file}")
-        final_result.to_file(output_file, driver="GPKG")
+        with instr.stage('write', rows_in=len(final_result), country=country_code):
+            final_result.to_file(output_file, driver="GPKG")
         
         return {
             'country_code': country_code,
@@ -212,6 +218,8 @@ def process_country(country_code, target_crs="esri:102033"):
 def main():
     """Main execution function"""
     logger = setup_logging()
+    instr = configure(path=TRACE_PATH, level=INSTRUMENTATION_LEVEL, echo=logging.info)
+    profiler = configure_profiler(PROFILE_PATH, mode=PROFILE_WORKERS)
     logger.info("Starting population density calculation for South American countries")
     
     results = []
@@ -228,6 +236,8 @@ def main():
         else:
             logger.info(f"{COUNTRIES[result['country_code']]}: Failed - "
                       f"{result.get('error', 'Unknown error')}")
+    profiler.summary()
+    instr.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,46 @@
+"""
+The uint64 bit operations on H3 ids against the h3 library.
+
+``cell_to_parent`` and the string <-> uint64 conversions avoid a per-cell
+h3 call; these tests check them on random resolution-8 cells and the
+pentagons, at every parent resolution.
+"""
+import numpy as np
+import pytest
+
+from pipeline.h3_pyramid import cell_resolution, cell_to_parent
+from pipeline.hextable import H3_RESOLUTION, h3_to_uint64, uint64_to_h3
+
+h3 = pytest.importorskip('h3')
+
+
+@pytest.fixture(scope='module')
+def cells():
+    """Random resolution-8 cells (hex strings) over the whole globe, plus the pentagons."""
+    rng = np.random.default_rng(8)
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, 2000)))
+    lngs = rng.uniform(-180, 180, 2000)
+    cells = [h3.latlng_to_cell(lat, lng, H3_RESOLUTION) for lat, lng in zip(lats, lngs)]
+    return np.array(cells + list(h3.get_pentagons(H3_RESOLUTION)))
+
+
+def test_string_round_trip(cells):
+    ids = h3_to_uint64(cells)
+    assert ids.tolist() == [h3.str_to_int(cell) for cell in cells]
+    np.testing.assert_array_equal(uint64_to_h3(ids), cells)
+
+
+def test_uppercase_strings(cells):
+    np.testing.assert_array_equal(h3_to_uint64(np.char.upper(cells)), h3_to_uint64(cells))
+
+
+def test_cell_resolution(cells):
+    assert (cell_resolution(h3_to_uint64(cells)) == H3_RESOLUTION).all()
+
+
+@pytest.mark.parametrize('resolution', range(H3_RESOLUTION + 1))
+def test_cell_to_parent(cells, resolution):
+    parents = cell_to_parent(h3_to_uint64(cells), resolution)
+    expected = [h3.cell_to_parent(cell, resolution) for cell in cells]
+    assert parents.tolist() == [h3.str_to_int(cell) for cell in expected]
+    np.testing.assert_array_equal(uint64_to_h3(parents), expected)
@@ -6,84 +6,71 @@ from shapely.geometry import shape
 import pyproj
 import pyarrow as pa
 import pyarrow.parquet as pq
-from tqdm import tqdm
-import multiprocessing
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / '01_build' / '02_scripts'))
+from pipeline.cache import SpatialCache
+from pipeline.zonal import ZonalEngine
 
 # 2. Data Import
 # Load the spatial datasets
-pop_hex = gpd.read_file("datos/population/colombia/kontur_population_CO_20231101.gpkg")
-col_dpto = gpd.read_file("datos/spatial/MGN2023_DPTO_POLITICO/MGN_ADM_DPTO_POLITICO.shp")
-roads_colombia = gpd.read_file("datos/spatial/colombia_roads.gpkg")
-
-# 3. Coordinate Transformation
-# Ensure all datasets use the same CRS (coordinate reference system)
-if pop_hex.crs != col_dpto.crs:
-    pop_hex = pop_hex.to_crs(col_dpto.crs)
-
-if roads_colombia.crs != col_dpto.crs:
-    roads_colombia = roads_colombia.to_crs(col_dpto.crs)
-
-# 4. Spatial Intersections
-# Helper function for spatial intersection using parallel processing
-def parallel_intersection(df1, df2):
-    # Split the data for parallel processing
-    num_cores = multiprocessing.cpu_count()
-    df_split = np.array_split(df1, num_cores)
-    
-    with multiprocessing.Pool(num_cores) as pool:
-        # Use tqdm to track progress
-        result = list(tqdm(pool.imap(lambda x: gpd.overlay(x, df2, how='intersection'), df_split), total=len(df_split)))
-    
-    # Concatenate the results back together
-    return pd.concat(result, ignore_index=True)
+POP_HEX_PATH = "datos/population/colombia/kontur_population_CO_20231101.gpkg"
+COL_DPTO_PATH = "datos/spatial/MGN2023_DPTO_POLITICO/MGN_ADM_DPTO_POLITICO.shp"
+ROADS_PATH = "datos/spatial/colombia_roads.gpkg"
+PEAJES_PATH = "datos/spatial/Peajes_data.csv"  # Optional toll booth locations
 
-# Roads with Departments
-try:
-    # If the file already exists, load it
-    roads_dpto_intersect = gpd.read_parquet("datos/spatial/roads_dpto_intersect.rds")
-except FileNotFoundError:
-    # Perform the spatial intersection
-    roads_dpto_intersect = parallel_intersection(roads_colombia, col_dpto)
-    # Save to a file
-    roads_dpto_intersect.to_parquet("datos/spatial/roads_dpto_intersect.rds", index=False)
+pop_hex = gpd.read_file(POP_HEX_PATH)
+col_dpto = gpd.read_file(COL_DPTO_PATH)
+roads_colombia = gpd.read_file(ROADS_PATH)
 
-# Population with Departments
-try:
-    # If the file already exists, load it
-    pop_dpto_intersect = gpd.read_parquet("datos/spatial/pop_dpto_intersect.rds")
-except FileNotFoundError:
-    # Perform the spatial intersection
-    pop_dpto_intersect = parallel_intersection(pop_hex, col_dpto)
-    # Save to a file
-    pop_dpto_intersect.to_parquet("datos/spatial/pop_dpto_intersect.rds", index=False)
+peajes = None
+if Path(PEAJES_PATH).exists():
+    peajes_df = pd.read_csv(PEAJES_PATH).dropna(subset=['latitud', 'longitud'])
+    peajes = gpd.GeoDataFrame(
+        peajes_df,
+        geometry=gpd.points_from_xy(peajes_df['longitud'], peajes_df['latitud']),
+        crs="EPSG:4686",
+    )
 
-# 5. Road Density Calculation
-# Road Length Calculation
-roads_dpto_intersect['length_km'] = roads_dpto_intersect.geometry.length / 1000  # Convert to kilometers
+# 3. Zonal Statistics
+# Every layer is assigned to departments through one spatial index over the
+# departments, projected once to an equal-area CRS. Population hexagons are
+# apportioned by area, roads are clipped only where they cross a boundary.
+def compute_dpto_stats():
+    engine = ZonalEngine(col_dpto, zone_id='dpto_ccdgo')
+    engine.add_layer('road', roads_colombia)
+    engine.add_layer('pop', pop_hex, value_cols=['population'])
+    if peajes is not None:
+        engine.add_layer('peajes', peajes)
+    return engine.result()
 
-# Department Area Calculation
-col_dpto['area_km2'] = col_dpto.geometry.area / 1e6  # Convert to square kilometers
+# Cached by input file contents, CRS and parameters, so editing the roads or
+# the MGN shapefile triggers a recomputation
+cache = SpatialCache("datos/spatial/cache")
+dpto_stats = cache.cached(
+    "dpto_zonal_stats",
+    compute_dpto_stats,
+    inputs=[ROADS_PATH, COL_DPTO_PATH, POP_HEX_PATH]
+           + ([PEAJES_PATH] if peajes is not None else []),
+    params={"zone_id": "dpto_ccdgo", "crs": "esri:102033"},
+)
+dpto_stats = dpto_stats.rename(columns={
+    'road_length_km': 'total_road_length_km',
+    'pop_population': 'total_population',
+})
 
-# Aggregate Road Lengths
-road_length_by_dpto = roads_dpto_intersect.groupby('dpto_ccdgo')['length_km'].sum().reset_index()
-road_length_by_dpto.columns = ['dpto_ccdgo', 'total_road_length_km']
-
-# Compute Road Density
-col_dpto = col_dpto.merge(road_length_by_dpto, on='dpto_ccdgo', how='left')
+# 4. Road and Population Density Calculation
+col_dpto = col_dpto.merge(dpto_stats, on='dpto_ccdgo', how='left')
 col_dpto['road_density'] = col_dpto['total_road_length_km'] / col_dpto['area_km2']
-
-# 6. Population Density Calculation
-# Aggregate Population by Department
-pop_by_dpto = pop_dpto_intersect.groupby('dpto_ccdgo')['population'].sum().reset_index()
-pop_by_dpto.columns = ['dpto_ccdgo', 'total_population']
-
-# Compute Population Density
-col_dpto = col_dpto.merge(pop_by_dpto, on='dpto_ccdgo', how='left')
 col_dpto['pop_density'] = col_dpto['total_population'] / col_dpto['area_km2']
 
-# 7. Data Export
+# 5. Data Export
 # Select and reorder the columns for final output
-final_df = col_dpto[['dpto_ccdgo', 'area_km2', 'total_road_length_km', 'road_density', 'pop_density']].copy()
+output_cols = ['dpto_ccdgo', 'area_km2', 'total_road_length_km', 'road_density', 'pop_density']
+if 'peajes_count' in col_dpto.columns:
+    output_cols.append('peajes_count')
+final_df = col_dpto[output_cols].copy()
 
 # Export the final DataFrame to a Parquet file
 final_df.to_parquet('colombia-departments_road_pop.parquet', index=False)
@@ -31,6 +31,9 @@ install_package "numpy" "numpy"
 install_package "shapely" "shapely"
 install_package "pyproj" "pyproj"
 install_package "pyarrow" "pyarrow"
+install_package "h3" "h3-py>=4.1" "h3>=4.1"
+install_package "psutil" "psutil"
+install_package "dask" "distributed" "dask[distributed]"
 install_package "tqdm" "tqdm"
 install_package "multiprocessing" "multiprocessing-logging" # Note: multiprocessing is part of Python's standard library
 